@@ -0,0 +1,146 @@
+import pygame
+
+from layerio import flatten
+from memory import surface_bytes
+
+class Frame:
+    """One frame of an animation.  It owns its own layer stack, and caches its flattened image and onion-skin tints."""
+
+    def __init__(self, layers, layer_buttons, current_layer, layer_label_cnt):
+        """
+        Initializes the frame.
+
+        :param layers: The layer stack of the frame, bottom to top.
+        :param layer_buttons: The eye and layer buttons of the layers.
+        :param current_layer: The layer being drawn on in this frame.
+        :param layer_label_cnt: The label the next new layer of this frame gets.
+        """
+
+        self.layers = layers
+        self.layer_buttons = layer_buttons
+        self.current_layer = current_layer
+        self.layer_label_cnt = layer_label_cnt
+        self.current_layer_history = []
+        self.undo_history = []
+        self.redo_history = []
+
+        self.composite_surface = None
+        self.composite_signature = None
+        self.onion_surfaces = {}  # (tint, alpha) -> tinted copy of composite_surface
+
+    def signature(self):
+        """Changes whenever the flattened image would, using the layers' change counters."""
+        return tuple((id(layer), layer.version, layer.is_visible) for layer in self.layers)
+
+    def composite(self, size):
+        """Returns the visible layers flattened, redoing it only if a layer changed since the last call."""
+        signature = self.signature()
+        if self.composite_surface is None or signature != self.composite_signature:
+            self.composite_surface = flatten([layer.surface for layer in self.layers if layer.is_visible and not layer.is_empty()], size)
+            self.composite_signature = signature
+            self.onion_surfaces = {}
+        return self.composite_surface
+
+    def onion_skin(self, size, tint, alpha):
+        """Returns the flattened frame tinted towards tint and faded to alpha, for showing under a neighbouring frame."""
+        composite = self.composite(size)
+        surface = self.onion_surfaces.get((tint, alpha))
+        if surface is None:
+            # The pixels are premultiplied, so the tint is scaled by each pixel's alpha first: white with the alpha of the
+            # frame, premultiplied, is the alpha in all four channels.  Dark strokes then take on the tint, and
+            # transparent pixels stay (0, 0, 0, 0).
+            coverage = composite.copy()
+            coverage.fill((255, 255, 255, 0), special_flags=pygame.BLEND_RGBA_MAX)
+            surface = coverage.premul_alpha()
+            surface.fill(tint + (255,), special_flags=pygame.BLEND_RGBA_MULT)
+            surface.blit(composite, (0, 0), special_flags=pygame.BLEND_RGB_MAX)
+            surface.fill((alpha, alpha, alpha, alpha), special_flags=pygame.BLEND_RGBA_MULT)
+            self.onion_surfaces[(tint, alpha)] = surface
+        return surface
+
+    def nbytes(self):
+        """Returns the RAM held by the cached images of the frame."""
+        return surface_bytes(self.composite_surface) + sum(surface_bytes(surface) for surface in self.onion_surfaces.values())
+
+class Timeline:
+    """The frames of an animation, the onion-skin settings, and playback."""
+
+    def __init__(self, first_frame, fps=12, onion_before=1, onion_after=1, onion_alpha=110):
+        """
+        Initializes the timeline.
+
+        :param first_frame: The Frame holding the layers there are when the program starts.
+        :param fps: The playback speed in frames per second.
+        :param onion_before: The number of previous frames shown as onion skins.
+        :param onion_after: The number of next frames shown as onion skins.
+        :param onion_alpha: The opacity of the nearest onion skins.  Frames further away are fainter.
+        """
+
+        self.frames = [first_frame]
+        self.current = 0
+        self.fps = fps
+        self.onion_before = onion_before
+        self.onion_after = onion_after
+        self.onion_alpha = onion_alpha
+        self.onion_enabled = False
+        self.before_tint = (255, 80, 80)   # Previous frames are shown in red
+        self.after_tint = (80, 160, 255)   # Next frames are shown in blue
+        self.playing = False
+        self.play_start = 0
+        self.play_start_index = 0
+
+    def current_frame(self):
+        return self.frames[self.current]
+
+    def play(self):
+        self.playing = True
+        self.play_start = pygame.time.get_ticks()
+        self.play_start_index = self.current
+
+    def stop(self):
+        self.playing = False
+
+    def playback_index(self):
+        """Returns the frame to show now while playing.  It depends on the time since playback started, not on the frame rate reached."""
+        elapsed = pygame.time.get_ticks() - self.play_start
+        return (self.play_start_index + elapsed * self.fps // 1000) % len(self.frames)
+
+    def onion_skins(self, size):
+        """Returns the onion skins to draw under the current frame, furthest first."""
+        skins = []
+        if not self.onion_enabled:
+            return skins
+        for distance in range(self.onion_before, 0, -1):
+            if self.current - distance >= 0:
+                skins.append(self.frames[self.current - distance].onion_skin(size, self.before_tint, self.onion_alpha // distance))
+        for distance in range(self.onion_after, 0, -1):
+            if self.current + distance < len(self.frames):
+                skins.append(self.frames[self.current + distance].onion_skin(size, self.after_tint, self.onion_alpha // distance))
+        return skins
+
+    def cell_rect(self, rect, index, cell_width=24):
+        return pygame.Rect(rect.x + 90 + index * cell_width, rect.y, cell_width - 2, rect.height)
+
+    def frame_at(self, rect, pos):
+        """Returns the index of the frame cell at pos in the strip drawn in rect, or None."""
+        for index in range(len(self.frames)):
+            if self.cell_rect(rect, index).collidepoint(pos):
+                return index
+        return None
+
+    def draw(self, screen, rect, font, text_color, background_color, highlight_color):
+        """Draws a strip with a cell per frame, the current (or playing) frame highlighted."""
+        shown = self.playback_index() if self.playing else self.current
+        strip_rect = pygame.Rect(rect.x, rect.y, self.cell_rect(rect, len(self.frames) - 1).right - rect.x + 4, rect.height)
+        pygame.draw.rect(screen, background_color, strip_rect)
+        pygame.draw.rect(screen, text_color, strip_rect, 1)
+        label = f"{'Playing' if self.playing else 'Frame'} {shown + 1}/{len(self.frames)}"
+        screen.blit(font.render(label, True, text_color), (rect.x + 5, rect.y + 4))
+        for index in range(len(self.frames)):
+            cell = self.cell_rect(rect, index).inflate(0, -6)
+            if index == shown:
+                pygame.draw.rect(screen, highlight_color, cell)
+            pygame.draw.rect(screen, text_color, cell, 1)
+
+    def nbytes(self):
+        return sum(frame.nbytes() for frame in self.frames)
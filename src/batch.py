@@ -0,0 +1,104 @@
+"""
+Headless batch conversion of project files.
+
+Flattens the layers of saved multipage TIFF projects into one image each (like Save to a non-TIFF file), or writes
+every layer to its own image (like Export), using one worker process per file.  No window or dialog is opened.
+
+Examples:
+    python batch.py drawings/*.tiff --format png
+    python batch.py "drawings/**/*.tiff" --split --format bmp --output-dir renders --workers 4
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Must be set before pygame is imported, here and in the worker processes
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame
+
+from layerio import tiff_pages, place_pages, flatten, encode_image
+
+OUTPUT_FORMATS = ["png", "jpg", "bmp"]
+
+def expand_inputs(patterns):
+    """Expands the glob patterns (shells on Windows don't) into a sorted list of files, keeping plain file names as is."""
+    files = []
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True)
+        if matches:
+            files.extend(match for match in matches if os.path.isfile(match))
+        else:
+            files.append(pattern)  # Reported as a failure by the worker
+    return sorted(set(files), key=files.index)
+
+def convert_file(file_path, output_dir, output_format, split):
+    """
+    Converts one project file.  Runs in a worker process.
+
+    :param file_path: The project file to read.
+    :param output_dir: The folder to write to, or None to write next to the project file.
+    :param output_format: One of OUTPUT_FORMATS.
+    :param split: When True, write each layer to its own file instead of flattening them.
+    :return: A (file_path, output_paths, seconds, error) tuple.  error is None on success.
+    """
+
+    start_time = time.perf_counter()
+    output_paths = []
+    try:
+        base = os.path.splitext(os.path.basename(file_path))[0]
+        folder = output_dir if output_dir is not None else os.path.dirname(file_path)
+        surfaces = place_pages(tiff_pages(file_path))  # Pages are cropped to their layer's pixels, so they are put back in place
+        if split:
+            for number, surface in enumerate(surfaces, start=1):
+                output_path = os.path.join(folder, f"{base}_layer{number}.{output_format}")
+                encode_image(output_path, surface.get_size(), pygame.image.tostring(surface, "RGBA", False))
+                output_paths.append(output_path)
+        else:
+            output_path = os.path.join(folder, f"{base}.{output_format}")
+            flat_surface = flatten(surfaces, surfaces[0].get_size())
+            encode_image(output_path, flat_surface.get_size(), pygame.image.tostring(flat_surface, "RGBA", False))
+            output_paths.append(output_path)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return file_path, output_paths, time.perf_counter() - start_time, error
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flatten or split saved project files without opening the drawing window.")
+    parser.add_argument("files", nargs="+", help="Project files or glob patterns (e.g. 'drawings/*.tiff')")
+    parser.add_argument("--format", dest="output_format", choices=OUTPUT_FORMATS, default="png", help="Output image format (default: png)")
+    parser.add_argument("--split", action="store_true", help="Write each layer to its own file instead of flattening the layers")
+    parser.add_argument("--output-dir", default=None, help="Folder for the output files (default: next to each project file)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: number of CPUs)")
+    args = parser.parse_args(argv)
+
+    files = expand_inputs(args.files)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    start_time = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(convert_file, file_path, args.output_dir, args.output_format, args.split) for file_path in files]
+        for future in as_completed(futures):
+            file_path, output_paths, seconds, error = future.result()
+            results.append((file_path, output_paths, seconds, error))
+            if error is None:
+                print(f"{seconds:8.3f}s  OK    {file_path} -> {', '.join(output_paths)}")
+            else:
+                print(f"{seconds:8.3f}s  FAIL  {file_path}: {error}", file=sys.stderr)
+
+    failures = [result for result in results if result[3] is not None]
+    busy_seconds = sum(result[2] for result in results)
+    print(f"{len(results) - len(failures)} converted, {len(failures)} failed, "
+          f"{busy_seconds:.3f}s of work in {time.perf_counter() - start_time:.3f}s wall time")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
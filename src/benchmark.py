@@ -0,0 +1,236 @@
+"""
+Benchmarks for the drawing program's rendering paths.
+
+Examples:
+    python benchmark.py composite
+    python benchmark.py composite --layers 10 --frames 100
+    python benchmark.py present
+    python benchmark.py vector --shapes 1000
+    python benchmark.py pool
+    SDL_VIDEODRIVER=dummy python benchmark.py present   # Without a display, SDL's software renderer only
+"""
+
+import argparse
+import os
+import random
+import time
+
+# Must be set before pygame is imported
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame
+
+from layerio import premultiply_color
+from present import PRESENTERS
+from surfacepool import SurfacePool
+from vector import VectorShape, VectorLayer
+
+CANVAS_SIZE = (1440, 840)
+SCREEN_SIZE = (1600, 900)
+
+def make_layer(seed, premultiplied, colorkey=False, stroke_count=200):
+    """Returns a canvas-sized layer with random strokes, some of them half transparent."""
+    surface = pygame.Surface(CANVAS_SIZE, pygame.SRCALPHA)
+    if colorkey:
+        # How layers were set up before they were premultiplied
+        surface.set_colorkey((255, 255, 255, 0))
+        surface.fill((255, 255, 255, 0))
+    rng = random.Random(seed)
+    for i in range(stroke_count):
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.choice([255, 128]))
+        if premultiplied:
+            color = premultiply_color(color)
+        start = (rng.randrange(CANVAS_SIZE[0]), rng.randrange(CANVAS_SIZE[1]))
+        end = (rng.randrange(CANVAS_SIZE[0]), rng.randrange(CANVAS_SIZE[1]))
+        pygame.draw.line(surface, color, start, end, rng.randrange(2, 20))
+    return surface
+
+def time_frames(screen, layers, special_flags, frame_count):
+    """Returns the milliseconds per frame it takes to draw the canvas and blit every layer onto it."""
+    start_time = time.perf_counter()
+    for i in range(frame_count):
+        screen.fill((255, 255, 255))
+        for layer in layers:
+            screen.blit(layer, (80, 0), special_flags=special_flags)
+    return (time.perf_counter() - start_time) / frame_count * 1000
+
+def bench_composite(layer_count, frame_count):
+    """Compares drawing the layers onto the screen the way they were stored before and the way they are stored now."""
+    screen = pygame.Surface(SCREEN_SIZE)
+    paths = [
+        ("straight alpha + colorkey (before)", [make_layer(i, False, colorkey=True) for i in range(layer_count)], 0),
+        ("premultiplied (now)", [make_layer(i, True) for i in range(layer_count)], pygame.BLEND_PREMULTIPLIED),
+        ("straight alpha, no colorkey (reference)", [make_layer(i, False) for i in range(layer_count)], 0),
+    ]
+    print(f"{layer_count} layers of {CANVAS_SIZE[0]} x {CANVAS_SIZE[1]}, {frame_count} frames")
+    results = []
+    for name, layers, special_flags in paths:
+        time_frames(screen, layers, special_flags, 2)  # Warm up
+        results.append((name, time_frames(screen, layers, special_flags, frame_count)))
+    before = results[0][1]
+    for name, ms in results:
+        print(f"{name:42} {ms:7.2f} ms/frame  {before / ms:5.1f}x")
+
+def time_presenting(presenter, frame_count, full_frames):
+    """
+    Returns the milliseconds per frame and the pixels uploaded per frame to show frames in which a brush stroke moves
+    across the canvas, with the mouse position text redrawn, as in the drawing window.
+    """
+    screen = presenter.screen
+    rng = random.Random(0)
+    for y in range(0, screen.get_height(), 30):
+        pygame.draw.rect(screen, (rng.randrange(256), rng.randrange(256), rng.randrange(256)), (0, y, screen.get_width(), 30))
+    presenter.present([screen.get_rect()])
+    uploaded_before = presenter.uploaded_pixels
+    start_time = time.perf_counter()
+    for i in range(frame_count):
+        pygame.event.pump()  # As the main loop does, and so the window stays responsive
+        brush_rect = pygame.draw.circle(screen, (0, 0, 0), (100 + i * 5 % 1400, 400 + i % 100), 10)
+        text_rect = pygame.draw.rect(screen, (128, 128, 128), (15, screen.get_height() - 15, 60, 12))
+        presenter.present([screen.get_rect()] if full_frames else [brush_rect, text_rect])
+    ms = (time.perf_counter() - start_time) / frame_count * 1000
+    return ms, (presenter.uploaded_pixels - uploaded_before) / frame_count
+
+def bench_present(frame_count):
+    """Compares flipping the whole display with uploading the whole frame, or only the changed parts, to a texture."""
+    cases = [
+        ("display flip (default)", "display", True),
+        ("renderer, whole frame", "renderer", True),
+        ("renderer, changed parts", "renderer", False),
+    ]
+    print(f"{SCREEN_SIZE[0]} x {SCREEN_SIZE[1]}, {frame_count} frames, video driver {pygame.display.get_driver()}")
+    if pygame.display.get_driver() == "dummy":
+        print("The dummy driver shows nothing, so its flip costs nothing.  Run with a display for a fair comparison.")
+    for name, backend, full_frames in cases:
+        presenter = PRESENTERS[backend]("benchmark", SCREEN_SIZE)
+        ms, pixels = time_presenting(presenter, frame_count, full_frames)
+        print(f"{name:42} {ms:7.2f} ms/frame  {pixels * 4 / 1024:9.1f} KB uploaded/frame")
+        # Close the window before the next one
+        del presenter
+        pygame.display.quit()
+        pygame.display.init()
+
+def make_shapes(shape_count, seed=0):
+    """Returns shape_count random shapes of every kind, up to 120 pixels across, spread over the canvas."""
+    rng = random.Random(seed)
+    shapes = []
+    for i in range(shape_count):
+        kind = rng.choice(["square", "rect", "oval", "circle", "triangle", "polyline"])
+        x, y = rng.randrange(CANVAS_SIZE[0]), rng.randrange(CANVAS_SIZE[1])
+        if kind in ("square", "rect", "oval"):
+            geometry = (x, y, rng.randrange(1, 120), rng.randrange(1, 120))
+        elif kind == "circle":
+            geometry = (x, y, rng.randrange(1, 60))
+        else:
+            geometry = tuple((x + rng.randrange(-60, 60), y + rng.randrange(-60, 60)) for j in range(3 if kind == "triangle" else 8))
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.choice([255, 128]))
+        shapes.append(VectorShape(kind, geometry, color, color[::-1], rng.randrange(1, 10), rng.choice([0, 3])))
+    return shapes
+
+def bench_vector(shape_count, move_count):
+    """
+    Compares moving one shape of a vector layer and redrawing every shape with redrawing only the tiles under it, and
+    finding the shape under the mouse by checking every shape with asking the R-tree.
+    """
+
+    rng = random.Random(1)
+    vector = VectorLayer(CANVAS_SIZE)
+    for shape in make_shapes(shape_count):
+        vector.add(shape)
+    surface = pygame.Surface(CANVAS_SIZE, pygame.SRCALPHA)
+    vector.render(surface)
+    print(f"{shape_count} shapes on {CANVAS_SIZE[0]} x {CANVAS_SIZE[1]}, {move_count} moves")
+
+    start_time = time.perf_counter()
+    for i in range(move_count):
+        shape = rng.choice(vector.shapes)
+        vector.replace(shape, shape.moved(rng.randrange(-20, 21), rng.randrange(-20, 21)))
+        surface.fill((0, 0, 0, 0))
+        for shape in vector.shapes:
+            shape.draw(surface)
+    vector.dirty_tiles.clear()
+    full_ms = (time.perf_counter() - start_time) / move_count * 1000
+
+    tiles_before = vector.tiles_rendered
+    start_time = time.perf_counter()
+    for i in range(move_count):
+        shape = rng.choice(vector.shapes)
+        vector.replace(shape, shape.moved(rng.randrange(-20, 21), rng.randrange(-20, 21)))
+        vector.render(surface)
+    tiles_ms = (time.perf_counter() - start_time) / move_count * 1000
+    print(f"{'move, redraw every shape':42} {full_ms:7.2f} ms/move")
+    print(f"{'move, redraw the tiles under it':42} {tiles_ms:7.2f} ms/move  {full_ms / tiles_ms:5.1f}x  {(vector.tiles_rendered - tiles_before) / move_count:.1f} tiles/move")
+
+    points = [(rng.randrange(CANVAS_SIZE[0]), rng.randrange(CANVAS_SIZE[1])) for i in range(1000)]
+    start_time = time.perf_counter()
+    for point in points:
+        for shape in reversed(vector.shapes):
+            if shape.rect.collidepoint(point) and shape.hit(pygame.Rect(point, (1, 1)).inflate(6, 6)):
+                break
+    scan_us = (time.perf_counter() - start_time) / len(points) * 1e6
+    start_time = time.perf_counter()
+    for point in points:
+        vector.shape_at(point)
+    tree_us = (time.perf_counter() - start_time) / len(points) * 1e6
+    print(f"{'pick, check every shape':42} {scan_us:7.1f} us/click")
+    print(f"{'pick, R-tree':42} {tree_us:7.1f} us/click  {scan_us / tree_us:5.1f}x")
+
+def bench_pool(segment_count):
+    """
+    Compares drawing pen segments the way the pen tool does, on a canvas-sized scratch surface allocated for each
+    segment, with taking the scratch surface from a SurfacePool.
+    """
+
+    rng = random.Random(2)
+    layer = pygame.Surface(CANVAS_SIZE, pygame.SRCALPHA)
+    color = premultiply_color((200, 40, 40, 128))
+    points = [(rng.randrange(CANVAS_SIZE[0]), rng.randrange(CANVAS_SIZE[1])) for i in range(segment_count + 1)]
+    print(f"{segment_count} pen segments on {CANVAS_SIZE[0]} x {CANVAS_SIZE[1]}")
+
+    start_time = time.perf_counter()
+    for start, end in zip(points, points[1:]):
+        tmp_surface = pygame.Surface(CANVAS_SIZE, pygame.SRCALPHA)
+        line_rect = pygame.draw.line(tmp_surface, color, start, end, 5)
+        layer.blit(tmp_surface, line_rect, line_rect, special_flags=pygame.BLEND_PREMULTIPLIED)
+    new_ms = (time.perf_counter() - start_time) / segment_count * 1000
+
+    pool = SurfacePool(64 * 1024 * 1024)
+    start_time = time.perf_counter()
+    for start, end in zip(points, points[1:]):
+        tmp_surface = pool.acquire(CANVAS_SIZE)
+        line_rect = pygame.draw.line(tmp_surface, color, start, end, 5)
+        layer.blit(tmp_surface, line_rect, line_rect, special_flags=pygame.BLEND_PREMULTIPLIED)
+        pool.release(tmp_surface, line_rect)
+    pool_ms = (time.perf_counter() - start_time) / segment_count * 1000
+    print(f"{'new surface per segment':42} {new_ms:7.3f} ms/segment")
+    print(f"{'pooled surface':42} {pool_ms:7.3f} ms/segment  {new_ms / pool_ms:5.1f}x  {pool.stats()}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the drawing program's rendering paths.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    composite_parser = subparsers.add_parser("composite", help="Time drawing the layers onto the screen.")
+    composite_parser.add_argument("--layers", type=int, default=5, help="Number of layers.")
+    composite_parser.add_argument("--frames", type=int, default=60, help="Number of frames to time.")
+    present_parser = subparsers.add_parser("present", help="Time showing the frames in the window with each presentation backend.")
+    present_parser.add_argument("--frames", type=int, default=300, help="Number of frames to time.")
+    vector_parser = subparsers.add_parser("vector", help="Time moving and picking shapes on a vector layer.")
+    vector_parser.add_argument("--shapes", type=int, default=500, help="Number of shapes.")
+    vector_parser.add_argument("--moves", type=int, default=100, help="Number of moves to time.")
+    pool_parser = subparsers.add_parser("pool", help="Time pen segments with and without the surface pool.")
+    pool_parser.add_argument("--segments", type=int, default=500, help="Number of segments to time.")
+    args = parser.parse_args(argv)
+
+    pygame.init()
+    if args.command == "composite":
+        bench_composite(args.layers, args.frames)
+    elif args.command == "present":
+        bench_present(args.frames)
+    elif args.command == "vector":
+        bench_vector(args.shapes, args.moves)
+    elif args.command == "pool":
+        bench_pool(args.segments)
+    pygame.quit()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,76 @@
+import pygame
+
+from memory import surface_bytes
+
+class ChromeCache:
+    """
+    Keeps the window around the canvas (the background, the section titles and the buttons) pre-rendered in one surface.
+
+    Each frame the surface is blitted in one go.  A button is redrawn into it only when how it looks changed, e.g. on
+    hover or when its label changed, and the whole surface is rebuilt only when the layout changes: buttons added,
+    removed or moved, or a new window size.
+    """
+
+    def __init__(self, background_color, canvas_rect, canvas_color):
+        """
+        Initializes the cache.
+
+        :param background_color: The color behind the buttons.
+        :param canvas_rect: The canvas area, filled with canvas_color for the layers to be drawn on.
+        :param canvas_color: The color of the canvas.
+        """
+
+        self.background_color = background_color
+        self.canvas_rect = canvas_rect
+        self.canvas_color = canvas_color
+        self.labels = []         # (text surface, position) of the section titles
+        self.surface = None
+        self.layout = None       # The window size and button rects the surface was built for
+        self.button_states = {}  # button -> the state it was last drawn in
+        self.rebuilds = 0
+        self.button_redraws = 0
+
+    def add_label(self, text_surface, pos):
+        """Adds a text that never changes, e.g. a section title."""
+        self.labels.append((text_surface, pos))
+        self.layout = None
+
+    def rebuild(self, screen, buttons, layout):
+        if self.surface is None or self.surface.get_size() != screen.get_size():
+            self.surface = pygame.Surface(screen.get_size(), 0, screen)
+        self.surface.fill(self.background_color)
+        pygame.draw.rect(self.surface, self.canvas_color, self.canvas_rect)
+        for text_surface, pos in self.labels:
+            self.surface.blit(text_surface, pos)
+        self.button_states = {}
+        for button in buttons:
+            state = button.state()
+            button.draw(self.surface, state)
+            self.button_states[button] = state
+        self.layout = layout
+        self.rebuilds += 1
+
+    def draw(self, screen, buttons):
+        """
+        Draws the chrome and buttons onto screen, redrawing only the buttons whose look changed since the last call.
+        Returns the areas that look different from the last call.
+        """
+        changed_rects = []
+        layout = (screen.get_size(), tuple((button, tuple(button.rect)) for button in buttons))
+        if layout != self.layout:
+            self.rebuild(screen, buttons, layout)
+            changed_rects.append(self.surface.get_rect())
+        else:
+            for button in buttons:
+                state = button.state()
+                if state != self.button_states[button]:
+                    self.surface.fill(self.background_color, button.rect)
+                    button.draw(self.surface, state)
+                    self.button_states[button] = state
+                    self.button_redraws += 1
+                    changed_rects.append(button.rect)
+        screen.blit(self.surface, (0, 0))
+        return changed_rects
+
+    def nbytes(self):
+        return surface_bytes(self.surface)
@@ -0,0 +1,360 @@
+"""
+Real-time collaboration over a relay.
+
+Edits are sent as compact binary operations (a stroke is its color, width and the moves between its points), never as
+pixels.  The relay gives every operation a sequence number and forwards it to every artist, the one who sent it included,
+so everyone applies the operations in the same order.  It also keeps the operations of the session, so an artist who
+joins late catches up.
+
+Examples:
+    python collab.py relay --port 8765
+    python collab.py bench --clients 3 --ops 20000
+    python collab.py bench --host 192.168.1.20 --port 8765
+"""
+
+import argparse
+import asyncio
+import queue
+import statistics
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import pygame
+
+# Operation codes
+HELLO, STROKE, SHAPE, CLEAR, ADD_LAYER, DELETE_LAYER, MOVE_LAYER, MERGE_DOWN, PING, ERASE, UNDO, REDO = range(12)
+
+SHAPE_TOOLS = ["square", "rect", "circle", "oval", "triangle"]
+
+LENGTH = struct.Struct("!I")    # Number of bytes in the rest of the message
+HEADER = struct.Struct("!BHI")  # Operation code, client id, sequence number (set by the relay)
+HELLO_BODY = struct.Struct("!H")                # Client id given to the new client
+STROKE_BODY = struct.Struct("!I4BHii")          # Layer, RGBA, width, first point.  Followed by the moves to the next points.  Also used by ERASE.
+STROKE_MOVE = struct.Struct("!hh")
+SHAPE_BODY = struct.Struct("!IB4B4BiiiiHH")     # Layer, tool, pen RGBA, fill RGBA, start, end, shape width, line width
+LAYER_BODY = struct.Struct("!I")                # Layer
+MOVE_LAYER_BODY = struct.Struct("!Ib")          # Layer, +1 for up or -1 for down
+PING_BODY = struct.Struct("!d")                 # time.perf_counter() when sent
+# UNDO and REDO have no body.  They undo or redo the last shared edit of the artist who sent them.
+
+Operation = namedtuple("Operation", ["op", "client_id", "seq", "args"])
+
+def pack(op, body=b"", client_id=0, seq=0):
+    return LENGTH.pack(HEADER.size + len(body)) + HEADER.pack(op, client_id, seq) + body
+
+def encode_stroke(layer_id, color, width, points):
+    """Encodes a stroke.  Each point after the first is stored as the move from the previous one, so points take 4 bytes each."""
+    x, y = points[0]
+    parts = [STROKE_BODY.pack(layer_id, *color, width, x, y)]
+    for next_x, next_y in points[1:]:
+        # Moves longer than a 16 bit number are split into several along the same line
+        steps = max(1, -(-max(abs(next_x - x), abs(next_y - y)) // 32767))
+        start_x, start_y = x, y
+        for step in range(1, steps + 1):
+            step_x = start_x + (next_x - start_x) * step // steps
+            step_y = start_y + (next_y - start_y) * step // steps
+            parts.append(STROKE_MOVE.pack(step_x - x, step_y - y))
+            x, y = step_x, step_y
+    return b"".join(parts)
+
+def encode_shape(layer_id, tool, pen_color, fill_color, start_pos, end_pos, shape_width, line_width):
+    return SHAPE_BODY.pack(layer_id, SHAPE_TOOLS.index(tool), *pen_color, *fill_color, *start_pos, *end_pos, shape_width, line_width)
+
+def decode(op, body):
+    """Returns the arguments of an operation as a tuple."""
+    if op == HELLO:
+        return HELLO_BODY.unpack(body)
+    elif op in (STROKE, ERASE):
+        layer_id, r, g, b, a, width, x, y = STROKE_BODY.unpack_from(body)
+        points = [(x, y)]
+        for dx, dy in STROKE_MOVE.iter_unpack(body[STROKE_BODY.size:]):
+            x += dx
+            y += dy
+            points.append((x, y))
+        return layer_id, (r, g, b, a), width, points
+    elif op == SHAPE:
+        values = SHAPE_BODY.unpack(body)
+        return values[0], SHAPE_TOOLS[values[1]], values[2:6], values[6:10], values[10:12], values[12:14], values[14], values[15]
+    elif op in (CLEAR, ADD_LAYER, DELETE_LAYER, MERGE_DOWN):
+        return LAYER_BODY.unpack(body)
+    elif op == MOVE_LAYER:
+        return MOVE_LAYER_BODY.unpack(body)
+    elif op == PING:
+        return PING_BODY.unpack(body)
+    return ()
+
+async def read_message(reader):
+    """Returns the next (op, client id, seq, body) from the stream."""
+    length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+    data = await reader.readexactly(length)
+    op, client_id, seq = HEADER.unpack_from(data)
+    return op, client_id, seq, data[HEADER.size:]
+
+class Relay:
+    """
+    Forwards the operations of each client to all the clients, numbered in the one order everyone applies them in.  The
+    sender gets its own operations back too, which tells it where they fall in that order.
+
+    Each client has its own queue of messages to send and its own task writing them, so a slow client or one whose
+    connection broke only holds up or drops itself, never the senders or the other clients.
+    """
+
+    def __init__(self, keep_log=True):
+        """
+        Initializes the relay.
+
+        :param keep_log: When True, the operations are kept and sent to clients that join later, so they start from the same document.
+        """
+
+        self.keep_log = keep_log
+        self.clients = {}  # client id -> asyncio.Queue of the messages waiting to be sent to it
+        self.next_client_id = 1
+        self.seq = 0
+        self.log = []
+
+    async def handle(self, reader, writer):
+        client_id = self.next_client_id
+        self.next_client_id += 1
+        outgoing = asyncio.Queue()
+        outgoing.put_nowait(pack(HELLO, HELLO_BODY.pack(client_id), client_id, self.seq))
+        for message in self.log:
+            outgoing.put_nowait(message)
+        self.clients[client_id] = outgoing
+        sender = asyncio.create_task(self.send_to(client_id, writer, outgoing))
+        try:
+            while True:
+                op, _, _, body = await read_message(reader)
+                # Nothing else runs between numbering and queueing the message, so every client gets the messages in number order
+                self.seq += 1
+                message = pack(op, body, client_id, self.seq)
+                if self.keep_log and op != PING:
+                    self.log.append(message)
+                for client in self.clients.values():
+                    client.put_nowait(message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.pop(client_id, None)
+            sender.cancel()
+            writer.close()
+
+    async def send_to(self, client_id, writer, outgoing):
+        """Writes the messages queued for one client, waiting only on its own connection."""
+        try:
+            while True:
+                messages = [await outgoing.get()]
+                while not outgoing.empty():
+                    messages.append(outgoing.get_nowait())
+                writer.writelines(messages)
+                await writer.drain()
+        except ConnectionError:
+            # Stop forwarding to it.  Its handler sees the closed connection and finishes.
+            self.clients.pop(client_id, None)
+            writer.close()
+
+async def serve(host, port):
+    relay = Relay()
+    server = await asyncio.start_server(relay.handle, host, port)
+    print(f"Relay listening on {', '.join(str(sock.getsockname()) for sock in server.sockets)}")
+    async with server:
+        await server.serve_forever()
+
+class CollabSession:
+    """
+    Connects the drawing program to a relay.
+
+    The network runs on an asyncio loop in a background thread.  Operations to send and operations received are passed
+    to and from the UI thread through queues, so the main loop never waits on the network.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.client_id = 0
+        self.status = "connecting"
+        self.incoming = queue.Queue()  # Operations of everyone, this client's own included, in relay order
+        self.backlog = []              # Messages sent before the connection was up
+        self.sent = 0
+        self.received = 0
+        self.lock = threading.Lock()
+        self.loop = None
+        self.outgoing = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncio.run, args=(self.run(),), daemon=True)
+        self.thread.start()
+
+    def wait_connected(self, timeout=5):
+        """Waits until the relay gave this client its id.  Returns False if it didn't within timeout seconds."""
+        deadline = time.perf_counter() + timeout
+        while self.status == "connecting" and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        return self.status == "connected"
+
+    async def run(self):
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            op, client_id, seq, body = await read_message(reader)
+            self.client_id, = decode(op, body)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            self.status = f"couldn't connect: {e}"
+            return
+
+        with self.lock:
+            self.loop = asyncio.get_running_loop()
+            self.outgoing = asyncio.Queue()
+            for message in self.backlog:
+                self.outgoing.put_nowait(message)
+            self.backlog = []
+        self.status = "connected"
+
+        sender = asyncio.create_task(self.send_messages(writer))
+        try:
+            while True:
+                op, client_id, seq, body = await read_message(reader)
+                self.incoming.put(Operation(op, client_id, seq, decode(op, body)))
+                self.received += 1
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.status = "disconnected"
+        finally:
+            sender.cancel()
+            writer.close()
+
+    async def send_messages(self, writer):
+        while True:
+            writer.write(await self.outgoing.get())
+            # Send whatever else is queued in the same write
+            while not self.outgoing.empty():
+                writer.write(self.outgoing.get_nowait())
+            await writer.drain()
+
+    def send(self, op, body=b""):
+        """Queues an operation for the relay.  Can be called from the UI thread."""
+        message = pack(op, body, self.client_id)
+        self.sent += 1
+        with self.lock:
+            if self.loop is None:
+                self.backlog.append(message)
+            else:
+                self.loop.call_soon_threadsafe(self.outgoing.put_nowait, message)
+
+    def poll(self):
+        """Returns the operations received since the last call, in the order they are to be applied."""
+        operations = []
+        while True:
+            try:
+                operations.append(self.incoming.get_nowait())
+            except queue.Empty:
+                return operations
+
+    def draw(self, screen, pos, font, text_color, background_color):
+        """Draws the connection status and the number of operations sent and received.  Returns the box drawn."""
+        if self.status == "connected":
+            text = f"Drawing together as artist {self.client_id}  ({self.sent} sent, {self.received} received)"
+        else:
+            text = f"Drawing together: {self.status}"
+        text_surface = font.render(text, True, text_color)
+        box_rect = text_surface.get_rect(topleft=pos).inflate(10, 10)
+        box_rect.topleft = pos
+        pygame.draw.rect(screen, background_color, box_rect)
+        pygame.draw.rect(screen, text_color, box_rect, 1)
+        screen.blit(text_surface, (box_rect.x + 5, box_rect.y + 5))
+        return box_rect
+
+async def bench(host, port, client_count, op_count, points_per_stroke, ping_count):
+    """Measures operations per second and end-to-end latency through a relay, with one client sending and every client (the sender too) receiving."""
+    server = None
+    if port is None:
+        # Run a relay in this process
+        relay = Relay(keep_log=False)
+        server = await asyncio.start_server(relay.handle, "127.0.0.1", 0)
+        host, port = server.sockets[0].getsockname()[:2]
+
+    connections = []
+    for i in range(client_count):
+        reader, writer = await asyncio.open_connection(host, port)
+        await read_message(reader)  # HELLO
+        connections.append((reader, writer))
+    sender_writer = connections[0][1]
+    receivers = [reader for reader, writer in connections]  # The relay echoes to the sender as well, which has to keep reading
+
+    # Throughput: strokes sent as fast as the relay takes them
+    points = [(100 + i * 3, 100 + (i * 7) % 50) for i in range(points_per_stroke)]
+    stroke = pack(STROKE, encode_stroke(1, (0, 0, 0, 255), 2, points))
+
+    async def receive(reader, count):
+        received = []
+        for i in range(count):
+            op, client_id, seq, body = await read_message(reader)
+            received.append((op, seq, body, time.perf_counter()))
+        return received
+
+    start_time = time.perf_counter()
+    receiving = [asyncio.create_task(receive(reader, op_count)) for reader in receivers]
+    for i in range(op_count):
+        sender_writer.write(stroke)
+        if i % 256 == 0:
+            await sender_writer.drain()
+    await sender_writer.drain()
+    results = await asyncio.gather(*receiving)
+    seconds = time.perf_counter() - start_time
+    in_order = all([seq for op, seq, body, t in received] == sorted(seq for op, seq, body, t in received) for received in results)
+
+    # Latency: pings spaced out so they don't queue behind each other
+    latencies = []
+    receiving = [asyncio.create_task(receive(reader, ping_count)) for reader in receivers]
+    for i in range(ping_count):
+        sender_writer.write(pack(PING, PING_BODY.pack(time.perf_counter())))
+        await sender_writer.drain()
+        await asyncio.sleep(0.002)
+    for received in await asyncio.gather(*receiving):
+        for op, seq, body, receive_time in received:
+            sent_time, = PING_BODY.unpack(body)
+            latencies.append((receive_time - sent_time) * 1000)
+
+    for reader, writer in connections:
+        writer.close()
+        await writer.wait_closed()
+    if server is not None:
+        # Let the relay notice the clients are gone before stopping it
+        while relay.clients:
+            await asyncio.sleep(0.01)
+        server.close()
+        await server.wait_closed()
+
+    latencies.sort()
+    print(f"{client_count} clients, {op_count} strokes of {points_per_stroke} points ({len(stroke)} bytes each)")
+    print(f"throughput: {op_count / seconds:,.0f} operations/s sent, {op_count * len(receivers) / seconds:,.0f} delivered (echoes included), "
+          f"{len(stroke) * op_count * len(receivers) / seconds / 1e6:.1f} MB/s, in order: {in_order}")
+    print(f"latency: median {statistics.median(latencies):.3f} ms, "
+          f"95th percentile {latencies[int(len(latencies) * 0.95) - 1]:.3f} ms, max {latencies[-1]:.3f} ms")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Relay for drawing together, and its benchmark.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    relay_parser = subparsers.add_parser("relay", help="Run a relay.")
+    relay_parser.add_argument("--host", default="0.0.0.0", help="Address to listen on (default: every interface).")
+    relay_parser.add_argument("--port", type=int, default=8765)
+    bench_parser = subparsers.add_parser("bench", help="Measure operations per second and latency.")
+    bench_parser.add_argument("--host", default="127.0.0.1")
+    bench_parser.add_argument("--port", type=int, default=None, help="Port of a running relay.  Without it, a relay is started in this process.")
+    bench_parser.add_argument("--clients", type=int, default=3, help="Number of clients, one sending and all of them receiving.")
+    bench_parser.add_argument("--ops", type=int, default=20000, help="Number of strokes to send.")
+    bench_parser.add_argument("--points", type=int, default=32, help="Points per stroke.")
+    bench_parser.add_argument("--pings", type=int, default=200, help="Number of latency samples.")
+    args = parser.parse_args(argv)
+
+    if args.command == "relay":
+        try:
+            asyncio.run(serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        asyncio.run(bench(args.host, args.port, max(2, args.clients), args.ops, args.points, args.pings))
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,98 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+class LayerExporter:
+    """Writes a batch of layers to image files on a thread pool and keeps track of the progress."""
+
+    def __init__(self, snapshot, workers=None):
+        """
+        Initializes the exporter.
+
+        :param snapshot: A function returning (encode, args) for a layer, e.g. (encode_image, (size, premultiplied RGBA bytes)).
+                         It is called on the UI thread, one layer per frame, and encode(file path, *args) runs on a worker,
+                         so args should be a copy of the pixels (or a memory-mapped file), and the layers can keep being edited.
+        :param workers: The number of encoding threads (the ThreadPoolExecutor default if None).
+        """
+
+        self.snapshot = snapshot
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.queued = []         # (file path, source, snapshot function) still to be handed to the workers
+        self.running = {}        # future -> file path
+        self.total = 0
+        self.done = 0
+        self.errors = []         # (file path, error message)
+        self.directory = None
+        self.what = "layers"
+        self.start_time = 0
+        self.finish_time = None  # time.perf_counter() when the last file was written
+
+    def is_busy(self):
+        return bool(self.queued or self.running)
+
+    def start(self, items, directory, snapshot=None, what="layers"):
+        """
+        Starts writing layers.
+
+        :param items: (file name, layer) for every layer to write.
+        :param directory: The folder the files are written to.
+        :param snapshot: Replaces the snapshot function given to the constructor for this batch, e.g. to write other things than layers.
+        :param what: What is being written, for the progress text.
+        """
+
+        if not self.is_busy():
+            # Otherwise the files are added to the running batch
+            self.total = 0
+            self.done = 0
+            self.errors = []
+            self.start_time = time.perf_counter()
+            self.finish_time = None
+        if snapshot is None:
+            snapshot = self.snapshot
+        self.queued.extend((os.path.join(directory, file_name), source, snapshot) for file_name, source in items)
+        self.total += len(items)
+        self.directory = directory
+        self.what = what
+
+    def update(self):
+        """Hands the next layer to the workers and collects the files that were written.  Call once per frame."""
+        if self.queued:
+            file_path, source, snapshot = self.queued.pop(0)
+            encode, args = snapshot(source)
+            self.running[self.executor.submit(encode, file_path, *args)] = file_path
+
+        for future in [future for future in self.running if future.done()]:
+            file_path = self.running.pop(future)
+            self.done += 1
+            error = future.exception()
+            if error is not None:
+                self.errors.append((file_path, str(error)))
+
+        if self.total > 0 and not self.is_busy() and self.finish_time is None:
+            self.finish_time = time.perf_counter()
+
+    def draw(self, screen, rect, font, text_color, background_color, bar_color, linger_seconds=4):
+        """Draws a progress bar in rect while exporting, and the result for linger_seconds after.  Returns rect if drawn."""
+        if self.total == 0:
+            return
+        if self.finish_time is not None:
+            if time.perf_counter() - self.finish_time > linger_seconds:
+                return
+            text = f"Exported {self.done - len(self.errors)} of {self.total} {self.what} to {self.directory} in {self.finish_time - self.start_time:.1f} s"
+            if self.errors:
+                file_path, message = self.errors[0]
+                text += f".  Failed: {os.path.basename(file_path)} ({message})"
+                if len(self.errors) > 1:
+                    text += f" and {len(self.errors) - 1} more"
+        else:
+            text = f"Exporting {self.what}: {self.done} / {self.total}"
+
+        pygame.draw.rect(screen, background_color, rect)
+        bar_rect = pygame.Rect(rect.x, rect.y, rect.width * self.done // self.total, rect.height)
+        pygame.draw.rect(screen, bar_color, bar_rect)
+        pygame.draw.rect(screen, text_color, rect, 1)
+        text_surface = font.render(text, True, text_color)
+        screen.blit(text_surface, text_surface.get_rect(midleft=(rect.x + 5, rect.centery)))
+        return rect
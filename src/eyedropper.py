@@ -0,0 +1,115 @@
+import numpy as np
+import pygame
+
+from filters import read_pixels
+from layerio import unpremultiply_color
+from memory import surface_bytes
+
+SAMPLE_SIZES = (1, 3, 5, 11)
+SAMPLE_MODES = ("all layers", "current layer")
+
+class Eyedropper:
+    """
+    Picks colors from the canvas.  "all layers" reads the visible layers blended the way they are shown, from a
+    flattened copy that is only redone where layers changed, so a pick costs the same however many layers there are.
+    "current layer" reads the current layer alone.  The color can be averaged over a square around the mouse.
+    """
+
+    def __init__(self, size):
+        """
+        Initializes the eyedropper.
+
+        :param size: The (width, height) of the layers.
+        """
+
+        self.size = size
+        self.sample_size = SAMPLE_SIZES[0]
+        self.mode = SAMPLE_MODES[0]
+        self.composite = None      # The visible layers flattened, or None until it is needed
+        self.composite_key = None  # Which layers the composite holds, and whether they are visible
+
+    def next_sample_size(self):
+        self.sample_size = SAMPLE_SIZES[(SAMPLE_SIZES.index(self.sample_size) + 1) % len(SAMPLE_SIZES)]
+
+    def next_mode(self):
+        self.mode = SAMPLE_MODES[(SAMPLE_MODES.index(self.mode) + 1) % len(SAMPLE_MODES)]
+
+    def refresh(self, layers, key):
+        """
+        Brings the composite up to date with layers.  Only the areas changed since the last refresh are blended again,
+        unless key (e.g. the layers' ids and visibility) changed.
+        """
+
+        dirty_rect = None
+        for layer in layers:
+            layer_dirty_rect = layer.take_dirty("eyedropper")
+            if layer_dirty_rect is not None:
+                dirty_rect = layer_dirty_rect if dirty_rect is None else dirty_rect.union(layer_dirty_rect)
+        if self.composite is None or key != self.composite_key:
+            if self.composite is None:
+                self.composite = pygame.Surface(self.size, pygame.SRCALPHA)
+            self.composite_key = key
+            dirty_rect = self.composite.get_rect()
+        if dirty_rect is None or dirty_rect.width == 0 or dirty_rect.height == 0:
+            return
+        self.composite.fill((0, 0, 0, 0), dirty_rect)
+        for layer in layers:
+            if layer.is_visible:
+                area = dirty_rect.clip(layer.content_rect())
+                if area.width > 0 and area.height > 0:
+                    self.composite.blit(layer.surface, area, area, special_flags=pygame.BLEND_PREMULTIPLIED)
+
+    def sample(self, layers, current_layer, pos, key):
+        """
+        Returns the straight RGBA color under pos, averaged over the sample size, or None if pos is off the layers.
+
+        :param layers: The layers, bottom to top.
+        :param current_layer: The layer read in "current layer" mode.
+        :param pos: The position on the layers.
+        :param key: Passed to refresh().
+        """
+
+        if self.mode == "current layer":
+            surface = current_layer.surface
+        else:
+            self.refresh(layers, key)
+            surface = self.composite
+        half = self.sample_size // 2
+        rect = pygame.Rect(pos[0] - half, pos[1] - half, self.sample_size, self.sample_size).clip(surface.get_rect())
+        if rect.width == 0 or rect.height == 0:
+            return None
+        # The pixels are premultiplied, so averaging them weighs each color by its alpha, the way blurring does
+        pixels = read_pixels(surface, rect).reshape(-1, 4).astype(np.float32)
+        color = tuple(int(channel) for channel in np.rint(pixels.mean(axis=0)))
+        return unpremultiply_color(color)
+
+    def nbytes(self):
+        return surface_bytes(self.composite)
+
+    def release(self):
+        """Frees the composite, which is redone the next time it is needed.  Returns False if there was none, so it can be used as a memory evictor."""
+        if self.composite is None:
+            return False
+        self.composite = None
+        return True
+
+    def draw_readout(self, screen, pos, color, font, text_color, background_color):
+        """Draws the color that would be picked next to pos, with its values and the sample settings.  Returns the rect drawn."""
+        if color is None:
+            text = f"-  ({self.sample_size}x{self.sample_size}, {self.mode})"
+        else:
+            r, g, b, a = color
+            text = f"#{r:02X}{g:02X}{b:02X}  alpha {a}  ({self.sample_size}x{self.sample_size}, {self.mode})"
+        text_surface = font.render(text, True, text_color)
+        box_rect = pygame.Rect(pos[0] + 16, pos[1] + 16, text_surface.get_width() + 36, max(24, text_surface.get_height() + 10))
+        box_rect.clamp_ip(screen.get_rect())
+        pygame.draw.rect(screen, background_color, box_rect)
+        pygame.draw.rect(screen, text_color, box_rect, 1)
+        swatch_rect = pygame.Rect(box_rect.x + 5, box_rect.y + 5, 18, box_rect.height - 10)
+        if color is not None:
+            swatch = pygame.Surface(swatch_rect.size, pygame.SRCALPHA)
+            swatch.fill(color)
+            screen.blit(swatch, swatch_rect)
+        pygame.draw.rect(screen, text_color, swatch_rect, 1)
+        screen.blit(text_surface, (swatch_rect.right + 8, box_rect.y + (box_rect.height - text_surface.get_height()) // 2))
+        return box_rect
@@ -0,0 +1,508 @@
+import hashlib
+import os
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+from memory import surface_bytes
+from startup import LazyModule
+
+Image = LazyModule("PIL.Image")  # Pillow is imported the first time a thumbnail is decoded
+
+THUMBNAIL_SIZE = 96  # Width and height of the box a file preview has to fit in
+DOUBLE_CLICK_MS = 400
+
+def draw_button(screen, rect, text, font, text_color, background_color):
+    """Draws a plain text button for the overlays drawn over the canvas."""
+    pygame.draw.rect(screen, background_color, rect)
+    pygame.draw.rect(screen, text_color, rect, 1)
+    text_surface = font.render(text, True, text_color)
+    screen.blit(text_surface, text_surface.get_rect(center=rect.center))
+
+FileEntry = namedtuple("FileEntry", ["name", "path", "is_dir", "mtime_ns", "size"])
+
+class DirectoryScanner:
+    """Lists directories on a worker thread, and remembers each listing until the directory changes.
+
+    Overwriting a file doesn't change the modification time of its directory, so a remembered listing is
+    returned right away but its files are stat'ed again in the background, and poll() hands back the fresh
+    sizes and times.
+    """
+
+    def __init__(self):
+        self.listings = {}  # directory -> (modification time of the directory, sorted entries)
+        self.results = queue.Queue()
+
+    def scan(self, directory):
+        """Starts listing directory.  Returns the remembered entries right away if the directory hasn't changed since it was last listed, otherwise None."""
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        listing = self.listings.get(directory)
+        if listing is not None and listing[0] == mtime_ns:
+            threading.Thread(target=self.restat_entries, args=(directory, mtime_ns, listing[1]), daemon=True).start()
+            return listing[1]
+        threading.Thread(target=self.list_directory, args=(directory, mtime_ns), daemon=True).start()
+        return None
+
+    def list_directory(self, directory, mtime_ns):
+        # Runs on the worker thread.  On Windows, scandir gets the file sizes and times with the listing itself.
+        entries = []
+        error = None
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name.startswith("."):
+                        continue
+                    try:
+                        is_dir = entry.is_dir()
+                        stat = entry.stat()
+                    except OSError:
+                        continue  # e.g. a broken link
+                    entries.append(FileEntry(entry.name, entry.path, is_dir, stat.st_mtime_ns, stat.st_size))
+        except OSError as e:
+            error = e
+        entries.sort(key=lambda entry: (not entry.is_dir, entry.name.lower()))
+        self.results.put((directory, mtime_ns, entries, error))
+
+    def restat_entries(self, directory, mtime_ns, entries):
+        # Runs on the worker thread.  Same names in the same order, only the times and sizes are refreshed.
+        fresh = []
+        for entry in entries:
+            try:
+                stat = os.stat(entry.path)
+            except OSError:
+                fresh.append(entry)  # Removed since; the next listing drops it
+                continue
+            fresh.append(entry._replace(mtime_ns=stat.st_mtime_ns, size=stat.st_size))
+        self.results.put((directory, mtime_ns, fresh, None))
+
+    def poll(self):
+        """Returns the (directory, entries, error) of every listing that finished since the last call."""
+        finished = []
+        while True:
+            try:
+                directory, mtime_ns, entries, error = self.results.get_nowait()
+            except queue.Empty:
+                return finished
+            if error is None:
+                self.listings[directory] = (mtime_ns, entries)
+            finished.append((directory, entries, error))
+
+class ThumbnailCache:
+    """Decodes previews of image files on a thread pool, and keeps them on disk keyed by path, modification time and size."""
+
+    def __init__(self, cache_folder, size=THUMBNAIL_SIZE, workers=None):
+        """
+        Initializes the thumbnail cache.
+
+        :param cache_folder: The folder the previews are saved in between runs.
+        :param size: The width and height of the box a preview has to fit in.
+        :param workers: The number of decoding threads (the ThreadPoolExecutor default if None).
+        """
+
+        self.cache_folder = cache_folder
+        os.makedirs(cache_folder, exist_ok=True)
+        self.size = size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.surfaces = {}  # key -> preview surface, or False if the file couldn't be decoded
+        self.pending = {}   # key -> future of a preview being decoded
+
+    def key(self, entry):
+        # A file that was changed gets a new key, so stale previews are never shown
+        return hashlib.sha1(f"{os.path.abspath(entry.path)}|{entry.mtime_ns}|{entry.size}".encode()).hexdigest()
+
+    def get(self, entry):
+        """Returns the preview of entry, or None if it isn't ready (decoding it in the background) or can't be decoded."""
+        key = self.key(entry)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            return surface or None
+        if key not in self.pending:
+            self.pending[key] = self.executor.submit(self.decode, entry.path, os.path.join(self.cache_folder, key + ".png"))
+        return None
+
+    def decode(self, file_path, cache_file):
+        """Returns the (size, RGBA bytes) of the preview of file_path, or None.  Runs on a worker thread."""
+        try:
+            with Image.open(cache_file) as img:
+                return img.size, img.convert("RGBA").tobytes()
+        except OSError:
+            pass
+
+        try:
+            with Image.open(file_path) as img:
+                if img.format == "JPEG":
+                    # Let the decoder scale down by 1/2, 1/4 or 1/8 as it goes, which skips most of the work
+                    img.draft("RGB", (self.size, self.size))
+                img.thumbnail((self.size, self.size))
+                preview = img.convert("RGBA")
+        except Exception:
+            return None
+
+        try:
+            preview.save(cache_file + ".tmp", "PNG")
+            os.replace(cache_file + ".tmp", cache_file)
+        except OSError:
+            pass  # Without the cache file, the preview is decoded again next time
+        return preview.size, preview.tobytes()
+
+    def poll(self):
+        """Turns the previews that finished decoding into surfaces.  Returns True if there were any."""
+        finished = [key for key, future in self.pending.items() if future.done()]
+        for key in finished:
+            future = self.pending.pop(key)
+            if future.cancelled():
+                continue
+            result = future.result()
+            if result is None:
+                self.surfaces[key] = False
+            else:
+                size, raw = result
+                self.surfaces[key] = pygame.image.fromstring(raw, size, "RGBA")
+        return len(finished) > 0
+
+    def cancel_pending(self):
+        """Drops the previews that haven't started decoding, e.g. after leaving their folder."""
+        for future in self.pending.values():
+            future.cancel()
+
+    def nbytes(self):
+        return sum(surface_bytes(surface or None) for surface in self.surfaces.values())
+
+class FileBrowser:
+    """A file browser drawn inside the pygame window, so the canvas keeps rendering while a file is picked."""
+
+    def __init__(self, rect, thumbnail_cache, start_directory=None):
+        """
+        Initializes the file browser.
+
+        :param rect: The area of the screen the browser covers when it is open.
+        :param thumbnail_cache: The ThumbnailCache the file previews come from.
+        :param start_directory: The folder shown the first time the browser opens (the home folder if None).
+        """
+
+        self.rect = pygame.Rect(rect)
+        self.thumbnails = thumbnail_cache
+        self.scanner = DirectoryScanner()
+        if start_directory is None:
+            start_directory = os.path.expanduser("~")
+        self.directory = os.path.abspath(start_directory)
+
+        self.is_open = False
+        self.title = ""
+        self.save_mode = False
+        self.extensions = None       # Lowercase extensions of the files to list, or None for every file
+        self.default_extension = ""
+        self.on_select = None
+        self.entries = []
+        self.scanning = False
+        self.message = ""
+        self.selected = None         # Index into self.entries
+        self.scroll_row = 0
+        self.file_name = ""          # The name typed in save mode
+        self.option_label = None     # Text of the checkbox shown next to the buttons, or None for no checkbox
+        self.option_checked = False
+        self.confirm_message = None  # Shown when a file is picked, which then has to be picked again to go ahead
+        self.confirm_path = None     # Set when the user was warned about picking this file (or that saving replaces it)
+        self.last_click = (None, 0)  # (index, time) of the last click on an entry, to detect double clicks
+        self.labels = {}             # Rendered file names
+
+        self.cell_width = THUMBNAIL_SIZE + 24
+        self.cell_height = THUMBNAIL_SIZE + 30
+        self.header_height = 60
+        self.footer_height = 45
+
+    # --- Opening and closing ---
+
+    def open(self, title, filetypes, on_select, save_mode=False, default_extension=".tiff", file_name="", option_label=None, option_checked=False, confirm_message=None):
+        """
+        Opens the browser in the current folder.
+
+        :param title: The text shown at the top of the browser.
+        :param filetypes: The file types to list, as (description, pattern) pairs like the ones given to tkinter's dialogs.
+        :param on_select: The function called with the full path of the file that was picked.  It isn't called on cancel.
+        :param save_mode: When True, a file name can be typed and files that don't exist yet can be picked.
+        :param default_extension: Added to typed names that don't have an extension, in save mode.
+        :param file_name: The name filled in to start with, in save mode.
+        :param option_label: The text of a checkbox shown next to the buttons, or None for no checkbox.  on_select can read
+                             whether it was checked from self.option_checked.
+        :param option_checked: Whether the checkbox starts checked.
+        :param confirm_message: A warning shown in the browser when a file is picked, e.g. that unsaved work is lost.
+                                The file has to be picked again (Open or Enter) to go ahead.  None to pick right away.
+        """
+
+        self.is_open = True
+        self.title = title
+        self.save_mode = save_mode
+        self.default_extension = default_extension
+        self.on_select = on_select
+        extensions = [pattern[1:].lower() for description, pattern in filetypes if pattern.startswith("*.") and pattern != "*.*"]
+        self.extensions = tuple(extensions) if extensions else None
+        self.file_name = file_name
+        self.option_label = option_label
+        self.option_checked = option_checked
+        self.confirm_message = confirm_message
+        if save_mode:
+            pygame.key.start_text_input()
+        self.navigate(self.directory)
+
+    def close(self):
+        self.is_open = False
+        self.thumbnails.cancel_pending()
+        if self.save_mode:
+            pygame.key.stop_text_input()
+
+    def finish(self, file_path):
+        """Closes the browser and hands file_path to the caller."""
+        self.close()
+        self.on_select(file_path)
+
+    def navigate(self, directory):
+        """Shows directory, from the listing cache if it hasn't changed, otherwise once the worker has listed it."""
+        self.directory = os.path.abspath(directory)
+        self.selected = None
+        self.scroll_row = 0
+        self.message = ""
+        self.confirm_path = None
+        self.labels = {}
+        self.thumbnails.cancel_pending()
+        entries = self.scanner.scan(self.directory)
+        if entries is None:
+            self.scanning = True
+            self.entries = []
+        else:
+            self.set_entries(entries)
+
+    def set_entries(self, entries):
+        self.scanning = False
+        self.entries = [entry for entry in entries if entry.is_dir or self.extensions is None or entry.name.lower().endswith(self.extensions)]
+
+    # --- Layout ---
+
+    def grid_rect(self):
+        return pygame.Rect(self.rect.x, self.rect.y + self.header_height, self.rect.width, self.rect.height - self.header_height - self.footer_height)
+
+    def columns(self):
+        return max(1, self.grid_rect().width // self.cell_width)
+
+    def visible_rows(self):
+        return max(1, self.grid_rect().height // self.cell_height)
+
+    def cell_rect(self, index):
+        grid = self.grid_rect()
+        columns = self.columns()
+        # Center the columns in the grid
+        x_margin = (grid.width - columns * self.cell_width) // 2
+        row = index // columns - self.scroll_row
+        return pygame.Rect(grid.x + x_margin + (index % columns) * self.cell_width, grid.y + row * self.cell_height, self.cell_width, self.cell_height)
+
+    def visible_range(self):
+        first = self.scroll_row * self.columns()
+        return range(first, min(len(self.entries), first + self.visible_rows() * self.columns()))
+
+    def up_rect(self):
+        return pygame.Rect(self.rect.x + 10, self.rect.y + 32, 40, 22)
+
+    def ok_rect(self):
+        return pygame.Rect(self.rect.right - 180, self.rect.bottom - 35, 80, 26)
+
+    def cancel_rect(self):
+        return pygame.Rect(self.rect.right - 90, self.rect.bottom - 35, 80, 26)
+
+    def option_rect(self):
+        return pygame.Rect(self.rect.right - 400, self.rect.bottom - 30, 16, 16)
+
+    def scroll_to(self, index):
+        row = index // self.columns()
+        if row < self.scroll_row:
+            self.scroll_row = row
+        elif row >= self.scroll_row + self.visible_rows():
+            self.scroll_row = row - self.visible_rows() + 1
+
+    def scroll(self, rows):
+        last_row = max(0, (len(self.entries) - 1) // self.columns() - self.visible_rows() + 1)
+        self.scroll_row = min(max(0, self.scroll_row + rows), last_row)
+
+    # --- Events ---
+
+    def select(self, index):
+        self.selected = index
+        self.scroll_to(index)
+        entry = self.entries[index]
+        if self.save_mode and not entry.is_dir:
+            self.file_name = entry.name
+
+    def activate(self, index):
+        """Opens the folder at index, or picks the file at index."""
+        entry = self.entries[index]
+        if entry.is_dir:
+            self.navigate(entry.path)
+        elif self.save_mode:
+            self.file_name = entry.name
+            self.confirm()
+        elif self.confirm_message is not None and self.confirm_path != entry.path:
+            self.confirm_path = entry.path
+            self.message = f"{self.confirm_message}  Press Open again to load {entry.name}."
+        else:
+            self.finish(entry.path)
+
+    def confirm(self):
+        """Does what the OK button does."""
+        if not self.save_mode:
+            if self.selected is not None:
+                self.activate(self.selected)
+            return
+
+        name = self.file_name.strip()
+        if name == "":
+            return
+        if os.path.splitext(name)[1] == "":
+            name += self.default_extension
+        file_path = os.path.join(self.directory, os.path.expanduser(name))
+        if os.path.isdir(file_path):
+            self.file_name = ""
+            self.navigate(file_path)
+        elif os.path.exists(file_path) and self.confirm_path != file_path:
+            self.confirm_path = file_path
+            self.message = f"{os.path.basename(file_path)} already exists.  Press Save again to replace it."
+        else:
+            self.finish(file_path)
+
+    def handle_event(self, event):
+        """Handles an event while the browser is open."""
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            if self.up_rect().collidepoint(event.pos):
+                self.navigate(os.path.dirname(self.directory))
+            elif self.ok_rect().collidepoint(event.pos):
+                self.confirm()
+            elif self.cancel_rect().collidepoint(event.pos):
+                self.close()
+            elif self.option_label is not None and self.option_rect().collidepoint(event.pos):
+                self.option_checked = not self.option_checked
+            elif self.grid_rect().collidepoint(event.pos):
+                for index in self.visible_range():
+                    if self.cell_rect(index).collidepoint(event.pos):
+                        now = pygame.time.get_ticks()
+                        if self.last_click[0] == index and now - self.last_click[1] < DOUBLE_CLICK_MS:
+                            self.last_click = (None, 0)
+                            self.activate(index)
+                        else:
+                            self.last_click = (index, now)
+                            self.select(index)
+                        break
+
+        elif event.type == pygame.MOUSEWHEEL:
+            self.scroll(-event.y)
+
+        elif event.type == pygame.TEXTINPUT and self.save_mode:
+            self.file_name += event.text
+            self.confirm_path = None
+
+        elif event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_ESCAPE:
+                self.close()
+            elif event.key in (pygame.K_RETURN, pygame.K_KP_ENTER):
+                self.confirm()
+            elif event.key == pygame.K_BACKSPACE:
+                if self.save_mode and self.file_name != "":
+                    self.file_name = self.file_name[:-1]
+                    self.confirm_path = None
+                else:
+                    self.navigate(os.path.dirname(self.directory))
+            elif event.key in (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN) and self.entries:
+                step = {pygame.K_LEFT: -1, pygame.K_RIGHT: 1, pygame.K_UP: -self.columns(), pygame.K_DOWN: self.columns()}[event.key]
+                index = 0 if self.selected is None else min(max(0, self.selected + step), len(self.entries) - 1)
+                self.select(index)
+            elif event.key == pygame.K_PAGEUP:
+                self.scroll(-self.visible_rows())
+            elif event.key == pygame.K_PAGEDOWN:
+                self.scroll(self.visible_rows())
+
+    def update(self):
+        """Collects the listings and previews that finished on the worker threads.  Call once per frame."""
+        for directory, entries, error in self.scanner.poll():
+            if directory == self.directory:
+                # Either the listing that was being waited for, or fresh times and sizes for the one shown
+                self.set_entries(entries)
+                if error is not None:
+                    self.message = f"Can't open {directory}: {error.strerror}"
+        self.thumbnails.poll()
+
+    # --- Drawing ---
+
+    def label(self, entry, font, text_color):
+        surface = self.labels.get(entry.path)
+        if surface is None:
+            name = entry.name
+            surface = font.render(name, True, text_color)
+            # Shorten long names to the width of the cell
+            while surface.get_width() > self.cell_width - 8 and len(name) > 1:
+                name = name[:-1]
+                surface = font.render(name + "...", True, text_color)
+            self.labels[entry.path] = surface
+        return surface
+
+    def draw(self, screen, font, title_font, text_color, background_color, highlight_color):
+        """Draws the browser.  Only the previews of the entries in view are asked for, so large folders open quickly."""
+        pygame.draw.rect(screen, background_color, self.rect)
+        pygame.draw.rect(screen, text_color, self.rect, 1)
+
+        # Header: title, up button and the current folder
+        screen.blit(title_font.render(self.title, True, text_color), (self.rect.x + 10, self.rect.y + 6))
+        up_rect = self.up_rect()
+        draw_button(screen, up_rect, "Up", font, text_color, background_color)
+        status = " (scanning...)" if self.scanning else ""
+        screen.blit(font.render(self.directory + status, True, text_color), (up_rect.right + 10, up_rect.y + 4))
+
+        # Grid of folders and files
+        grid = self.grid_rect()
+        previous_clip = screen.get_clip()
+        screen.set_clip(grid)
+        for index in self.visible_range():
+            entry = self.entries[index]
+            cell = self.cell_rect(index)
+            if index == self.selected:
+                pygame.draw.rect(screen, highlight_color, cell.inflate(-4, -4))
+            box = pygame.Rect(0, 0, THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+            box.midtop = (cell.centerx, cell.y + 6)
+            if entry.is_dir:
+                # A plain folder shape
+                pygame.draw.rect(screen, text_color, pygame.Rect(box.x + 8, box.y + 18, 30, 12), 1)
+                pygame.draw.rect(screen, text_color, pygame.Rect(box.x + 8, box.y + 26, box.width - 16, box.height - 40), 1)
+            else:
+                preview = self.thumbnails.get(entry)
+                if preview is not None:
+                    screen.blit(preview, preview.get_rect(center=box.center))
+                else:
+                    pygame.draw.rect(screen, text_color, box.inflate(-16, -16), 1)
+            label = self.label(entry, font, text_color)
+            screen.blit(label, label.get_rect(midtop=(cell.centerx, box.bottom + 4)))
+        screen.set_clip(previous_clip)
+        pygame.draw.line(screen, text_color, grid.topleft, grid.topright)
+        pygame.draw.line(screen, text_color, grid.bottomleft, grid.bottomright)
+
+        # Footer: typed name in save mode, messages, and the OK and Cancel buttons
+        footer_y = self.rect.bottom - 35
+        if self.save_mode:
+            name_rect = pygame.Rect(self.rect.x + 60, footer_y, 300, 26)
+            screen.blit(font.render("Name:", True, text_color), (self.rect.x + 10, footer_y + 6))
+            pygame.draw.rect(screen, text_color, name_rect, 1)
+            screen.blit(font.render(self.file_name + "|", True, text_color), (name_rect.x + 5, name_rect.y + 6))
+            message_x = name_rect.right + 10
+        else:
+            message_x = self.rect.x + 10
+        if self.message:
+            screen.blit(font.render(self.message, True, text_color), (message_x, footer_y + 6))
+        if self.option_label is not None:
+            option_rect = self.option_rect()
+            pygame.draw.rect(screen, text_color, option_rect, 1)
+            if self.option_checked:
+                pygame.draw.rect(screen, text_color, option_rect.inflate(-6, -6))
+            screen.blit(font.render(self.option_label, True, text_color), (option_rect.right + 6, option_rect.y + 2))
+        draw_button(screen, self.ok_rect(), "Save" if self.save_mode else "Open", font, text_color, background_color)
+        draw_button(screen, self.cancel_rect(), "Cancel", font, text_color, background_color)
@@ -0,0 +1,195 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+from filebrowser import draw_button
+from filters import FILTERS, FilterJob, preview_filter, write_pixels
+from history import RegionSnapshot, CompoundEdit
+
+class FilterDialog:
+    """
+    Picks a filter and its settings while a quick preview is shown in place of the layer, then applies the filter in
+    tiles on a thread pool with a progress bar.  The canvas keeps being drawn, and Esc cancels.
+    """
+
+    def __init__(self, pos, workers=None):
+        """
+        Initializes the filter dialog.
+
+        :param pos: The screen position of the top-left corner of the dialog.
+        :param workers: The number of filtering threads (the ThreadPoolExecutor default if None).
+        """
+
+        self.rect = pygame.Rect(pos, (440, 200))
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.is_open = False
+        self.filter = FILTERS[0]
+        self.values = {filter.name: filter.defaults() for filter in FILTERS}  # Kept between uses
+        self.layer = None
+        self.preview_layer = None
+        self.area = None
+        self.mask = None
+        self.on_done = None
+        self.preview_pending = False
+        self.job = None  # The FilterJob running on the thread pool
+        self.message = ""
+
+    def open(self, layer, preview_layer, area, mask, on_done):
+        """
+        Opens the dialog.
+
+        :param layer: The layer to filter.
+        :param preview_layer: A layer the size of layer.  It gets a copy of layer with the preview, to show instead of layer.
+        :param area: The area of the layer to filter, e.g. the bounds of the selection.
+        :param mask: Which pixels of area to filter as a bool array indexed [y, x], or None for all of them.
+        :param on_done: Called with the undo entry once the filter is applied.  It holds only the tiles that changed.
+        """
+
+        self.is_open = True
+        self.layer = layer
+        self.preview_layer = preview_layer
+        self.area = pygame.Rect(area)
+        self.mask = mask
+        self.on_done = on_done
+        self.preview_pending = True
+        self.message = ""
+
+    def close(self):
+        self.is_open = False
+        self.job = None
+        self.preview_layer.clear()
+
+    def start(self):
+        self.job = FilterJob(self.executor, self.layer.surface, self.area, self.filter, dict(self.values[self.filter.name]))
+
+    def cancel(self):
+        if self.job is not None:
+            self.job.cancel()  # Tiles already being filtered finish on their own, and their results are dropped
+        self.close()
+
+    def filter_rects(self):
+        return [pygame.Rect(self.rect.x + 10 + i * 84, self.rect.y + 32, 78, 26) for i in range(len(FILTERS))]
+
+    def param_rects(self, index):
+        """Returns the rects of the - and + buttons of the index-th setting."""
+        y = self.rect.y + 68 + index * 30
+        return pygame.Rect(self.rect.x + 150, y, 26, 26), pygame.Rect(self.rect.x + 260, y, 26, 26)
+
+    def apply_rect(self):
+        return pygame.Rect(self.rect.right - 180, self.rect.bottom - 36, 80, 26)
+
+    def cancel_rect(self):
+        return pygame.Rect(self.rect.right - 90, self.rect.bottom - 36, 80, 26)
+
+    def select_filter(self, filter):
+        self.filter = filter
+        self.preview_pending = True
+
+    def change(self, index, steps):
+        name, lowest, highest, step, default = self.filter.params[index]
+        values = self.values[self.filter.name]
+        values[name] = round(min(highest, max(lowest, values[name] + step * steps)), 2)
+        self.preview_pending = True
+
+    def handle_event(self, event):
+        """Handles an event while the dialog is open.  While the filter runs, only cancelling is possible."""
+        if self.job is not None:
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+                self.cancel()
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.cancel_rect().collidepoint(event.pos):
+                self.cancel()
+            return
+
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            for filter, rect in zip(FILTERS, self.filter_rects()):
+                if rect.collidepoint(event.pos):
+                    self.select_filter(filter)
+            for index in range(len(self.filter.params)):
+                minus_rect, plus_rect = self.param_rects(index)
+                if minus_rect.collidepoint(event.pos):
+                    self.change(index, -1)
+                elif plus_rect.collidepoint(event.pos):
+                    self.change(index, 1)
+            if self.apply_rect().collidepoint(event.pos):
+                self.start()
+            elif self.cancel_rect().collidepoint(event.pos):
+                self.close()
+        elif event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_ESCAPE:
+                self.close()
+            elif event.key in (pygame.K_RETURN, pygame.K_KP_ENTER):
+                self.start()
+            elif event.key == pygame.K_TAB:
+                self.select_filter(FILTERS[(FILTERS.index(self.filter) + 1) % len(FILTERS)])
+
+    def update(self):
+        """Redraws the preview after a change, and writes the filtered tiles into the layer once they are all done.  Call once per frame."""
+        if self.job is None:
+            if self.preview_pending:
+                # Done here rather than on every click, so clicking + several times in one frame previews once
+                self.preview_pending = False
+                pixels = preview_filter(self.layer.surface, self.area, self.filter, self.values[self.filter.name])
+                self.preview_layer.clear()
+                self.preview_layer.surface.blit(self.layer.surface, (0, 0))
+                write_pixels(self.preview_layer.surface, self.area, pixels, self.mask)
+                self.preview_layer.mark_dirty()
+            return
+
+        if not self.job.is_done():
+            return
+        job = self.job
+        self.job = None
+        if job.error() is not None:
+            self.message = f"Failed: {job.error()}"
+            return
+        entries = []
+        for tile, pixels in job.changed_tiles():
+            tile_mask = None
+            if self.mask is not None:
+                tile_mask = self.mask[tile.y - self.area.y:tile.bottom - self.area.y, tile.x - self.area.x:tile.right - self.area.x]
+                if not tile_mask.any():
+                    continue
+            entries.append(RegionSnapshot(self.layer, tile))
+            write_pixels(self.layer.surface, tile, pixels, tile_mask)
+            self.layer.mark_dirty(tile)
+        if entries:
+            self.layer.content_may_shrink()  # Filters can make pixels transparent
+            self.on_done(CompoundEdit(entries))
+        self.close()
+
+    def draw(self, screen, font, text_color, background_color, highlight_color):
+        """Draws the dialog, or the progress while the filter runs.  Returns the dialog's rect."""
+        pygame.draw.rect(screen, background_color, self.rect)
+        pygame.draw.rect(screen, text_color, self.rect, 1)
+        area_text = f"{self.area.width} x {self.area.height}"
+        screen.blit(font.render(f"Filter {area_text}  (Tab: next filter, Enter: apply, Esc: cancel)", True, text_color), (self.rect.x + 10, self.rect.y + 10))
+        for filter, rect in zip(FILTERS, self.filter_rects()):
+            if filter is self.filter:
+                pygame.draw.rect(screen, highlight_color, rect)
+                pygame.draw.rect(screen, text_color, rect, 1)
+                text_surface = font.render(filter.name, True, text_color)
+                screen.blit(text_surface, text_surface.get_rect(center=rect.center))
+            else:
+                draw_button(screen, rect, filter.name, font, text_color, background_color)
+
+        values = self.values[self.filter.name]
+        for index, (name, lowest, highest, step, default) in enumerate(self.filter.params):
+            minus_rect, plus_rect = self.param_rects(index)
+            screen.blit(font.render(name, True, text_color), (self.rect.x + 10, minus_rect.y + 6))
+            draw_button(screen, minus_rect, "-", font, text_color, background_color)
+            value_text = font.render(f"{values[name]:g}", True, text_color)
+            screen.blit(value_text, value_text.get_rect(center=(minus_rect.right + (plus_rect.x - minus_rect.right) // 2, minus_rect.centery)))
+            draw_button(screen, plus_rect, "+", font, text_color, background_color)
+
+        if self.job is not None:
+            bar_rect = pygame.Rect(self.rect.x + 10, self.rect.bottom - 36, self.rect.width - 120, 26)
+            pygame.draw.rect(screen, highlight_color, (bar_rect.x, bar_rect.y, int(bar_rect.width * self.job.progress()), bar_rect.height))
+            pygame.draw.rect(screen, text_color, bar_rect, 1)
+            text_surface = font.render(f"Applying {self.filter.name}: {int(self.job.progress() * 100)}%", True, text_color)
+            screen.blit(text_surface, text_surface.get_rect(midleft=(bar_rect.x + 5, bar_rect.centery)))
+        else:
+            if self.message:
+                screen.blit(font.render(self.message, True, text_color), (self.rect.x + 10, self.rect.bottom - 30))
+            draw_button(screen, self.apply_rect(), "Apply", font, text_color, background_color)
+        draw_button(screen, self.cancel_rect(), "Cancel", font, text_color, background_color)
+        return self.rect
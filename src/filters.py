@@ -0,0 +1,273 @@
+import math
+import sys
+import threading
+
+import numpy as np
+import pygame
+
+# Image filters.  Pixels are float32 arrays indexed [y, x, channel] holding premultiplied RGBA.  Each filter returns
+# the pixels it was given minus margin() pixels on every side, so a tile is filtered from the tile plus a margin of its
+# neighbours and comes out the same as if the whole layer was filtered at once.
+
+TILE_SIZE = 256
+
+def box_sizes(sigma, count=3):
+    """Returns the widths of count box blurs that together come close to a Gaussian blur of sigma."""
+    ideal = math.sqrt(12 * sigma * sigma / count + 1)
+    lower = int(ideal)
+    if lower % 2 == 0:
+        lower -= 1
+    lower_count = round((12 * sigma * sigma - count * lower * lower - 4 * count * lower - 3 * count) / (-4 * lower - 4))
+    return [lower if i < lower_count else lower + 2 for i in range(count)]
+
+def box_blur(pixels, width, axis):
+    """Averages width pixels along axis with a running sum.  The result is width - 1 pixels shorter along axis."""
+    if width <= 1:
+        return pixels
+    sums = np.cumsum(np.swapaxes(pixels, 0, axis), axis=0, dtype=np.float32)
+    blurred = sums[width - 1:].copy()
+    blurred[1:] -= sums[:-width]
+    blurred *= 1 / width
+    return np.swapaxes(blurred, 0, axis)
+
+def gaussian_margin(sigma):
+    return sum(width // 2 for width in box_sizes(sigma)) if sigma >= 0.5 else 0
+
+def gaussian_blur(pixels, sigma):
+    """Blurs in x and then in y with three box blurs each, which takes the same time for any sigma."""
+    if sigma < 0.5:
+        return pixels
+    for axis in (0, 1):
+        for width in box_sizes(sigma):
+            pixels = box_blur(pixels, width, axis)
+    return pixels
+
+def crop(pixels, margin):
+    if margin == 0:
+        return pixels
+    return pixels[margin:-margin, margin:-margin]
+
+def unpremultiply(pixels):
+    """Returns the straight (r, g, b) of premultiplied pixels, and their alpha."""
+    alpha = pixels[..., 3:]
+    rgb = np.divide(pixels[..., :3] * 255, alpha, out=np.zeros_like(pixels[..., :3]), where=alpha > 0)
+    return rgb, alpha
+
+def premultiply(rgb, alpha):
+    return np.concatenate([np.clip(rgb, 0, 255) * (alpha / 255), alpha], axis=-1)
+
+def rgb_to_hsl(rgb):
+    """Returns the hue (0 to 1), saturation and lightness of straight rgb in 0 to 1."""
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    high = rgb.max(axis=-1)
+    low = rgb.min(axis=-1)
+    delta = high - low
+    lightness = (high + low) / 2
+    saturation = np.divide(delta, 1 - np.abs(2 * lightness - 1), out=np.zeros_like(delta), where=(delta > 0) & (lightness > 0) & (lightness < 1))
+    safe_delta = np.where(delta > 0, delta, 1)
+    hue = np.select([high == r, high == g], [((g - b) / safe_delta) % 6, (b - r) / safe_delta + 2], (r - g) / safe_delta + 4) / 6
+    return np.where(delta > 0, hue, 0), saturation, lightness
+
+def hsl_to_rgb(hue, saturation, lightness):
+    chroma = (1 - np.abs(2 * lightness - 1)) * saturation
+    sector = (hue % 1.0) * 6
+    second = chroma * (1 - np.abs(sector % 2 - 1))
+    zero = np.zeros_like(chroma)
+    sector = sector.astype(np.int32)
+    r = np.choose(sector % 6, [chroma, second, zero, zero, second, chroma])
+    g = np.choose(sector % 6, [second, chroma, chroma, second, zero, zero])
+    b = np.choose(sector % 6, [zero, zero, second, chroma, chroma, second])
+    low = (lightness - chroma / 2)[..., None]
+    return np.stack([r, g, b], axis=-1) + low
+
+def blur(pixels, values, scale):
+    return gaussian_blur(pixels, values["Radius"] * scale)
+
+def sharpen(pixels, values, scale):
+    """Unsharp mask: pushes each pixel away from the blurred image around it.  The alpha is left as it was."""
+    margin = gaussian_margin(values["Radius"] * scale)
+    blurred = gaussian_blur(pixels, values["Radius"] * scale)
+    pixels = crop(pixels, margin)
+    amount = values["Amount"] / 100
+    rgb = pixels[..., :3] + amount * (pixels[..., :3] - blurred[..., :3])
+    alpha = pixels[..., 3:]
+    return np.concatenate([np.clip(rgb, 0, alpha), alpha], axis=-1)
+
+def hue_saturation(pixels, values, scale):
+    rgb, alpha = unpremultiply(pixels)
+    hue, saturation, lightness = rgb_to_hsl(rgb / 255)
+    hue = hue + values["Hue"] / 360
+    saturation = np.clip(saturation * (1 + values["Saturation"] / 100), 0, 1)
+    change = values["Lightness"] / 100
+    if change > 0:
+        lightness = lightness + (1 - lightness) * change
+    else:
+        lightness = lightness * (1 + change)
+    return premultiply(hsl_to_rgb(hue, saturation, lightness) * 255, alpha)
+
+def levels(pixels, values, scale):
+    rgb, alpha = unpremultiply(pixels)
+    black = values["Black"]
+    white = max(values["White"], black + 1)
+    rgb = np.clip((rgb - black) / (white - black), 0, 1) ** (1 / values["Gamma"]) * 255
+    return premultiply(rgb, alpha)
+
+def invert(pixels, values, scale):
+    # Inverting the straight color is alpha - color when premultiplied
+    alpha = pixels[..., 3:]
+    return np.concatenate([alpha - pixels[..., :3], alpha], axis=-1)
+
+class Filter:
+    """A filter and its settings."""
+
+    def __init__(self, name, kernel, params=(), margin=None):
+        """
+        Initializes the filter.
+
+        :param name: The name shown in the filter dialog.
+        :param kernel: A function (pixels, values, scale) returning the filtered pixels.  values maps the param names to
+                       their values, and scale is less than 1 when the pixels were scaled down for a preview.
+        :param params: (name, lowest, highest, step, default) for each setting.
+        :param margin: A function (values, scale) returning how many pixels the kernel takes off each side, None for none.
+        """
+
+        self.name = name
+        self.kernel = kernel
+        self.params = params
+        self.margin = margin if margin is not None else lambda values, scale: 0
+
+    def defaults(self):
+        return {name: default for name, lowest, highest, step, default in self.params}
+
+FILTERS = [
+    Filter("Blur", blur, [("Radius", 0.5, 50, 0.5, 3)], margin=lambda values, scale: gaussian_margin(values["Radius"] * scale)),
+    Filter("Sharpen", sharpen, [("Amount", 10, 300, 10, 100), ("Radius", 0.5, 10, 0.5, 1.5)],
+           margin=lambda values, scale: gaussian_margin(values["Radius"] * scale)),
+    Filter("Hue/Sat", hue_saturation, [("Hue", -180, 180, 10, 0), ("Saturation", -100, 100, 10, 0), ("Lightness", -100, 100, 10, 0)]),
+    Filter("Levels", levels, [("Black", 0, 250, 5, 0), ("White", 5, 255, 5, 255), ("Gamma", 0.1, 5, 0.1, 1)]),
+    Filter("Invert", invert),
+]
+
+def read_pixels(surface, rect):
+    """Returns the pixels of surface in rect as a uint8 array indexed [y, x, channel], with the channels in RGBA order."""
+    raw = pygame.image.tobytes(surface.subsurface(rect), "RGBA")
+    return np.frombuffer(raw, dtype=np.uint8).reshape(rect.height, rect.width, 4)
+
+def write_pixels(surface, rect, pixels, mask=None):
+    """
+    Writes uint8 RGBA pixels into rect of a 32 bit surface through a surfarray view, only where mask (a bool array
+    indexed [y, x]) is set if given.
+    """
+
+    # Put the channels in the order of the bytes of the surface's pixels, then view each pixel as one 32 bit value
+    shifts = surface.get_shifts()
+    packed = np.ascontiguousarray(pixels[..., [shifts.index(8 * i) for i in range(4)]]).view(np.uint32)[..., 0]
+    if sys.byteorder == "big":
+        packed = packed.byteswap()
+    view = pygame.surfarray.pixels2d(surface.subsurface(rect)).T
+    if mask is None:
+        view[...] = packed
+    else:
+        view[mask] = packed[mask]
+    del view  # Unlocks the surface
+
+def to_uint8(pixels):
+    pixels = np.clip(pixels + 0.5, 0, 255)
+    pixels[..., :3] = np.minimum(pixels[..., :3], pixels[..., 3:])  # Premultiplied color can't be more than its alpha
+    return pixels.astype(np.uint8)
+
+def apply_filter(source, source_rect, rect, filter, values, scale=1.0):
+    """
+    Filters rect out of source, a uint8 array of the pixels in source_rect.  Pixels the filter needs from outside
+    source_rect repeat the nearest edge pixel.  Returns the uint8 pixels of rect.
+    """
+
+    margin = filter.margin(values, scale)
+    wanted = rect.inflate(margin * 2, margin * 2)
+    available = wanted.clip(source_rect)
+    pixels = source[available.y - source_rect.y:available.bottom - source_rect.y, available.x - source_rect.x:available.right - source_rect.x]
+    pixels = pixels.astype(np.float32)
+    if available != wanted:
+        pad = ((available.y - wanted.y, wanted.bottom - available.bottom), (available.x - wanted.x, wanted.right - available.right), (0, 0))
+        pixels = np.pad(pixels, pad, mode="edge")
+    return to_uint8(filter.kernel(pixels, values, scale))
+
+def tile_rects(rect, tile_size=TILE_SIZE):
+    return [pygame.Rect(x, y, min(tile_size, rect.right - x), min(tile_size, rect.bottom - y))
+            for y in range(rect.y, rect.bottom, tile_size) for x in range(rect.x, rect.right, tile_size)]
+
+class FilterJob:
+    """One filter applied to an area of a layer, a tile per task on a thread pool.  Progress can be followed and the job cancelled."""
+
+    def __init__(self, executor, surface, rect, filter, values):
+        """
+        Copies the pixels the filter needs and starts the tasks.
+
+        :param executor: The thread pool to run the tiles on.
+        :param surface: The layer's surface.  It is only read here, so it can be drawn while the tiles are filtered.
+        :param rect: The area to filter.
+        :param filter: The Filter.
+        :param values: The filter's settings.
+        """
+
+        margin = filter.margin(values, 1.0)
+        self.source_rect = rect.inflate(margin * 2, margin * 2).clip(surface.get_rect())
+        self.source = read_pixels(surface, self.source_rect)
+        self.rect = rect
+        self.filter = filter
+        self.values = values
+        self.tiles = tile_rects(rect)
+        self.results = {}  # index in self.tiles -> filtered pixels
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.futures = [executor.submit(self.run_tile, index) for index in range(len(self.tiles))]
+
+    def run_tile(self, index):
+        if self.cancelled:
+            return
+        pixels = apply_filter(self.source, self.source_rect, self.tiles[index], self.filter, self.values)
+        with self.lock:
+            self.results[index] = pixels
+
+    def cancel(self):
+        self.cancelled = True
+        for future in self.futures:
+            future.cancel()
+
+    def progress(self):
+        """Returns the fraction of the tiles done."""
+        with self.lock:
+            return len(self.results) / len(self.tiles)
+
+    def is_done(self):
+        return all(future.done() for future in self.futures)
+
+    def error(self):
+        for future in self.futures:
+            if future.done() and not future.cancelled() and future.exception() is not None:
+                return future.exception()
+        return None
+
+    def changed_tiles(self):
+        """Returns (tile rect, filtered pixels) for every tile the filter changed."""
+        changed = []
+        for index, tile in enumerate(self.tiles):
+            before = self.source[tile.y - self.source_rect.y:tile.bottom - self.source_rect.y, tile.x - self.source_rect.x:tile.right - self.source_rect.x]
+            if not np.array_equal(before, self.results[index]):
+                changed.append((tile, self.results[index]))
+        return changed
+
+def preview_filter(surface, rect, filter, values, max_pixels=120000):
+    """
+    Returns the filtered pixels of rect of surface, computed on a scaled down copy and scaled back up, so that it takes
+    about the same time for any size.
+    """
+
+    scale = min(1.0, math.sqrt(max_pixels / (rect.width * rect.height)))
+    small_size = (max(1, round(rect.width * scale)), max(1, round(rect.height * scale)))
+    small = pygame.transform.smoothscale(surface.subsurface(rect), small_size) if scale < 1 else surface.subsurface(rect).copy()
+    small_rect = small.get_rect()
+    write_pixels(small, small_rect, apply_filter(read_pixels(small, small_rect), small_rect, small_rect, filter, values, scale))
+    if scale < 1:
+        small = pygame.transform.smoothscale(small, rect.size)
+    return read_pixels(small, small.get_rect())
@@ -0,0 +1,104 @@
+import math
+
+import numpy as np
+import pygame
+
+GRADIENT_MODES = ["linear", "radial", "angular"]
+
+# 4 x 4 ordered dithering.  Pixel (x, y) of the canvas is rounded up at threshold (BAYER_4X4[x % 4, y % 4] + 0.5) / 16,
+# so the preview and the committed gradient dither the same way.
+BAYER_4X4 = np.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]])
+
+LUT_SIZE = 1024  # Colors computed along the gradient.  Each pixel looks up the nearest one.
+
+def gradient_positions(rect, start, end, mode="linear", step=1):
+    """
+    Returns where each pixel of rect is along the gradient, from 0 at start_color to 1 at end_color, as a float32 array
+    indexed [x, y] the way pygame.surfarray lays out pixels.  Also returns the pixel x and y coordinates used.
+
+    :param rect: The area to compute, in the same coordinates as start and end.
+    :param start: Where the gradient has start_color.  The center for radial and angular gradients.
+    :param end: Where the gradient reaches end_color.  For an angular gradient, the direction where it starts.
+    :param mode: "linear", "radial" or "angular".
+    :param step: Compute only every step-th pixel in each direction, for a quick preview.
+    """
+
+    # Pixel centers, as a column of x and a row of y that broadcast into the whole grid
+    xs = np.arange(rect.x, rect.right, step, dtype=np.float32)[:, None] + (step - 1) / 2
+    ys = np.arange(rect.y, rect.bottom, step, dtype=np.float32)[None, :] + (step - 1) / 2
+    vx = end[0] - start[0]
+    vy = end[1] - start[1]
+    length = math.hypot(vx, vy) or 1.0
+
+    if mode == "linear":
+        t = (xs - start[0]) * (vx / length**2) + (ys - start[1]) * (vy / length**2)
+    elif mode == "radial":
+        t = np.hypot(xs - start[0], ys - start[1]) / length
+    elif mode == "angular":
+        t = ((np.arctan2(ys - start[1], xs - start[0]) - math.atan2(vy, vx)) / (2 * math.pi)) % 1.0
+    else:
+        raise ValueError(f"Unknown gradient mode: {mode}")
+    return np.clip(t, 0.0, 1.0), xs, ys
+
+def gradient_colors(start_color, end_color):
+    """Returns LUT_SIZE premultiplied (r, g, b, a) float32 colors going from start_color to end_color."""
+    t = np.linspace(0.0, 1.0, LUT_SIZE, dtype=np.float32)[:, None]
+    start_color = np.array(start_color, dtype=np.float32)
+    end_color = np.array(end_color, dtype=np.float32)
+    colors = start_color + (end_color - start_color) * t
+    colors[:, :3] *= colors[:, 3:] / 255
+    return colors
+
+def pack_colors(surface, colors):
+    """Returns (..., 4) colors packed into the 32 bit pixel format of surface, the way surfarray.pixels2d shows them."""
+    colors = colors.astype(np.uint32)
+    shifts = surface.get_shifts()
+    return (colors[..., 0] << shifts[0]) | (colors[..., 1] << shifts[1]) | (colors[..., 2] << shifts[2]) | (colors[..., 3] << shifts[3])
+
+def render_gradient(surface, rect, start, end, start_color, end_color, mode="linear", dither=False, step=1):
+    """
+    Writes the gradient over rect into the whole of surface, a 32 bit SRCALPHA surface the size of rect (or smaller by
+    step).  Each pixel is looked up in a table of packed colors and written through a surfarray view of the pixels.
+
+    :param start_color: The (r, g, b, a) color at start, not premultiplied.
+    :param end_color: The (r, g, b, a) color at end, not premultiplied.
+    :param dither: Whether to break up the banding with ordered dithering.
+    """
+
+    t, xs, ys = gradient_positions(rect, start, end, mode, step)
+    index = (t * (LUT_SIZE - 1) + 0.5).astype(np.intp)
+    colors = gradient_colors(start_color, end_color)
+    if dither:
+        # A table per dither threshold, and each pixel uses the one for its place in the 4 x 4 pattern
+        thresholds = (np.arange(16, dtype=np.float32) + 0.5) / 16
+        levels = np.floor(colors[None] + thresholds[:, None, None])
+        table = BAYER_4X4[xs.astype(np.intp) % 4, ys.astype(np.intp) % 4]
+    else:
+        levels = np.floor(colors + 0.5)[None]
+        table = 0
+    levels[..., :3] = np.minimum(levels[..., :3], levels[..., 3:])  # Premultiplied color can't be more than its alpha
+    packed = pack_colors(surface, levels)
+    pixels = pygame.surfarray.pixels2d(surface)
+    pixels[...] = packed[table, index]
+    del pixels  # Unlocks the surface
+
+def draw_gradient(surface, rect, start, end, start_color, end_color, mode="linear", dither=False):
+    """Writes the gradient into rect of surface, replacing what was there.  Returns the part of rect on surface."""
+    rect = pygame.Rect(rect).clip(surface.get_rect())
+    if rect.width > 0 and rect.height > 0:
+        render_gradient(surface.subsurface(rect), rect, start, end, start_color, end_color, mode, dither)
+    return rect
+
+def preview_gradient(rect, start, end, start_color, end_color, mode="linear", dither=False, max_pixels=60000):
+    """
+    Returns a surface the size of rect with the gradient computed at a lower resolution and scaled up, so that it
+    takes about the same time for any size.  Used while dragging.
+    """
+
+    rect = pygame.Rect(rect)
+    step = max(1, math.ceil(math.sqrt(rect.width * rect.height / max_pixels)))
+    small = pygame.Surface((math.ceil(rect.width / step), math.ceil(rect.height / step)), pygame.SRCALPHA)
+    render_gradient(small, rect, start, end, start_color, end_color, mode, dither, step)
+    if step == 1:
+        return small
+    return pygame.transform.smoothscale(small, rect.size)
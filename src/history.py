@@ -0,0 +1,218 @@
+import pygame
+
+from memory import surface_bytes
+
+# Undo/redo entries.  Each entry's apply() puts its saved state back and returns the entry that reverses it,
+# so an undo entry turns into a redo entry and back again.  nbytes() is the memory the entry keeps alive.
+
+class SurfaceSnapshot:
+    """A full copy of a layer's surface."""
+
+    def __init__(self, layer, surface):
+        """
+        Initializes the snapshot.
+
+        :param layer: The layer the surface belongs to.
+        :param surface: The copy of layer.surface to put back.
+        """
+
+        self.layer = layer
+        self.surface = surface
+        self.content_bounds = layer.content_bounds.copy()  # surface is a copy of the layer as it is now, so it has the same bounds
+        self.content_measured = layer.content_measured
+
+    def apply(self):
+        inverse = SurfaceSnapshot(self.layer, self.layer.surface)
+        self.layer.surface = self.surface
+        self.layer.mark_dirty()
+        self.layer.content_bounds = self.content_bounds
+        self.layer.content_measured = self.content_measured
+        return inverse
+
+    def nbytes(self):
+        return surface_bytes(self.surface)
+
+class RegionSnapshot:
+    """A copy of the pixels of a layer inside a rect, for edits that only touch part of the layer."""
+
+    def __init__(self, layer, rect, source=None):
+        """
+        Initializes the snapshot by copying the pixels in rect.
+
+        :param layer: The layer to copy from.
+        :param rect: The area of layer.surface to copy.
+        :param source: A copy of layer.surface made before the edit, to copy from instead.  For edits whose area is only
+                       known once they are done, like a stroke.
+        """
+
+        self.layer = layer
+        self.rect = pygame.Rect(rect).clip(layer.surface.get_rect())
+        if source is None:
+            source = layer.surface
+        self.surface = source.subsurface(self.rect).copy()
+
+    def apply(self):
+        inverse = RegionSnapshot(self.layer, self.rect)
+        # Blitting onto fully transparent pixels copies them as is
+        self.layer.surface.fill(self.layer.bg_color, self.rect)
+        self.layer.surface.blit(self.surface, self.rect)
+        self.layer.mark_dirty(self.rect)
+        self.layer.content_may_shrink()
+        return inverse
+
+    def nbytes(self):
+        return surface_bytes(self.surface)
+
+class LayerRemoval:
+    """
+    Layers that were taken out of the layer stack, e.g. by a merge.  Undoing puts them back at their places, and leaves
+    the layers added, deleted or moved since then as they are.
+    """
+
+    def __init__(self, removed, get_layers, set_layers):
+        """
+        Initializes the entry.
+
+        :param removed: The (index, layer) of each layer taken out, with its index in the stack before any was taken out.
+        :param get_layers: A function returning the current list of layers.
+        :param set_layers: A function that makes a list of layers the current one.
+        """
+
+        self.removed = sorted(removed, key=lambda item: item[0])
+        self.get_layers = get_layers
+        self.set_layers = set_layers
+
+    def apply(self):
+        layers = list(self.get_layers())
+        for index, layer in self.removed:
+            layers.insert(min(index, len(layers)), layer)
+        self.set_layers(layers)
+        return LayerInsertion([layer for index, layer in self.removed], self.get_layers, self.set_layers)
+
+    def nbytes(self):
+        # Layers that are out of the stack are only kept alive by this entry
+        current_layers = self.get_layers()
+        return sum(layer.nbytes() for index, layer in self.removed if layer not in current_layers)
+
+class LayerInsertion:
+    """Layers that were put into the layer stack, e.g. by restoring a version.  Undoing takes them out again."""
+
+    def __init__(self, layers, get_layers, set_layers):
+        """
+        Initializes the entry.
+
+        :param layers: The layers that were put in.
+        :param get_layers: A function returning the current list of layers.
+        :param set_layers: A function that makes a list of layers the current one.
+        """
+
+        self.layers = list(layers)
+        self.get_layers = get_layers
+        self.set_layers = set_layers
+
+    def apply(self):
+        current_layers = list(self.get_layers())
+        removed = [(index, layer) for index, layer in enumerate(current_layers) if layer in self.layers]
+        self.set_layers([layer for layer in current_layers if layer not in self.layers])
+        return LayerRemoval(removed, self.get_layers, self.set_layers)
+
+    def nbytes(self):
+        return 0  # The layers are in the stack
+
+class FrameRemoval:
+    """
+    An animation frame that was deleted.  Undoing puts it back at its place in the timeline, with its layers and its
+    own undo history, and leaves the frame being shown as it is.
+    """
+
+    def __init__(self, timeline, index, frame):
+        """
+        Initializes the entry.
+
+        :param timeline: The Timeline the frame was taken out of.
+        :param index: The index the frame had in the timeline.
+        :param frame: The Frame that was taken out.  Its layers must not be released while this entry can be undone.
+        """
+
+        self.timeline = timeline
+        self.index = index
+        self.frame = frame
+
+    def apply(self):
+        index = min(self.index, len(self.timeline.frames))
+        self.timeline.frames.insert(index, self.frame)
+        if self.timeline.current >= index:
+            self.timeline.current += 1
+        return FrameInsertion(self.timeline, self.frame)
+
+    def nbytes(self):
+        # A frame that is out of the timeline is only kept alive by this entry
+        if self.frame in self.timeline.frames:
+            return 0
+        return sum(layer.nbytes() for layer in self.frame.layers) + self.frame.nbytes()
+
+class FrameInsertion:
+    """An animation frame that was put back into the timeline by an undo.  Undoing takes it out again."""
+
+    def __init__(self, timeline, frame):
+        """
+        Initializes the entry.
+
+        :param timeline: The Timeline the frame is in.
+        :param frame: The Frame that was put in.  It is never the frame being shown when this entry is applied, since
+                      the entry is kept in the undo history of another frame.
+        """
+
+        self.timeline = timeline
+        self.frame = frame
+
+    def apply(self):
+        index = self.timeline.frames.index(self.frame)
+        del self.timeline.frames[index]
+        if self.timeline.current > index:
+            self.timeline.current -= 1
+        return FrameRemoval(self.timeline, index, self.frame)
+
+    def nbytes(self):
+        return 0  # The frame is in the timeline
+
+class VectorSnapshot:
+    """The shapes of a vector layer, or that the layer was a vector layer, for edits of the shapes."""
+
+    def __init__(self, layer):
+        """
+        Initializes the snapshot with the layer's current shapes.
+
+        :param layer: The layer.  Its vector is None for a layer that is only pixels.
+        """
+
+        self.layer = layer
+        self.vector = layer.vector
+        self.shapes = list(layer.vector.shapes) if layer.vector is not None else []
+
+    def apply(self):
+        inverse = VectorSnapshot(self.layer)
+        self.layer.vector = self.vector
+        if self.vector is not None:
+            self.vector.set_shapes(self.shapes)
+            self.layer.render_vector()
+        return inverse
+
+    def nbytes(self):
+        # Shapes that are no longer in the layer are only kept alive by this snapshot
+        if self.vector is None:
+            return 0
+        return sum(shape.nbytes() for shape in self.shapes if shape not in self.vector)
+
+class CompoundEdit:
+    """Several entries that are undone and redone together."""
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def apply(self):
+        inverses = [entry.apply() for entry in reversed(self.entries)]
+        return CompoundEdit(list(reversed(inverses)))
+
+    def nbytes(self):
+        return sum(entry.nbytes() for entry in self.entries)
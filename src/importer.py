@@ -0,0 +1,106 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+from filebrowser import draw_button
+from layerio import decode_placed
+
+PLACEMENT_MODES = [("fit", "Fit"), ("fill", "Fill"), ("crop", "Crop")]
+
+class ImportDialog:
+    """Asks how an image goes onto the canvas, then decodes it on a worker thread while the canvas keeps rendering."""
+
+    def __init__(self, center, canvas_size):
+        """
+        Initializes the import dialog.
+
+        :param center: The screen position the dialog is centered on.
+        :param canvas_size: The size the images are placed in.
+        """
+
+        self.rect = pygame.Rect(0, 0, 420, 110)
+        self.rect.center = center
+        self.canvas_size = canvas_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.is_open = False
+        self.file_path = None
+        self.source_size = None
+        self.on_done = None
+        self.on_error = None
+        self.future = None  # The decode running on the worker thread
+
+    def open(self, file_path, source_size, on_done, on_error):
+        """
+        Opens the dialog for one image.
+
+        :param file_path: The image file.
+        :param source_size: The size of the image, read from its header.
+        :param on_done: Called with (premultiplied surface, pos) once the image is decoded and placed.
+        :param on_error: Called with file_path if the image couldn't be decoded.
+        """
+
+        self.is_open = True
+        self.file_path = file_path
+        self.source_size = source_size
+        self.on_done = on_done
+        self.on_error = on_error
+        self.future = None
+
+    def start(self, mode):
+        self.future = self.executor.submit(decode_placed, self.file_path, self.canvas_size, mode)
+
+    def mode_rects(self):
+        return [pygame.Rect(self.rect.x + 10 + i * 90, self.rect.bottom - 36, 80, 26) for i in range(len(PLACEMENT_MODES))]
+
+    def cancel_rect(self):
+        return pygame.Rect(self.rect.right - 90, self.rect.bottom - 36, 80, 26)
+
+    def handle_event(self, event):
+        """Handles an event while the dialog is open.  Input is ignored while the image is being decoded."""
+        if self.future is not None:
+            return
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            for (mode, label), rect in zip(PLACEMENT_MODES, self.mode_rects()):
+                if rect.collidepoint(event.pos):
+                    self.start(mode)
+            if self.cancel_rect().collidepoint(event.pos):
+                self.is_open = False
+        elif event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_ESCAPE:
+                self.is_open = False
+            elif event.key in (pygame.K_RETURN, pygame.K_KP_ENTER):
+                self.start(PLACEMENT_MODES[0][0])
+
+    def update(self):
+        """Hands the image over once the worker has decoded it.  Call once per frame."""
+        if self.future is None or not self.future.done():
+            return
+        future = self.future
+        self.future = None
+        self.is_open = False
+        try:
+            size, pos, raw = future.result()
+        except Exception:
+            self.on_error(self.file_path)
+            return
+        self.on_done(pygame.image.fromstring(raw, size, "RGBA"), pos)
+
+    def draw(self, screen, font, text_color, background_color):
+        pygame.draw.rect(screen, background_color, self.rect)
+        pygame.draw.rect(screen, text_color, self.rect, 1)
+        source_w, source_h = self.source_size
+        canvas_w, canvas_h = self.canvas_size
+        lines = [f"{os.path.basename(self.file_path)}: {source_w} x {source_h}  (canvas: {canvas_w} x {canvas_h})"]
+        if self.future is not None:
+            lines.append("Importing...")
+        else:
+            lines.append("Fit the whole image, fill the canvas, or crop at full size?")
+        y = self.rect.y + 10
+        for line in lines:
+            screen.blit(font.render(line, True, text_color), (self.rect.x + 10, y))
+            y += font.get_linesize() + 4
+        if self.future is None:
+            for (mode, label), rect in zip(PLACEMENT_MODES, self.mode_rects()):
+                draw_button(screen, rect, label, font, text_color, background_color)
+            draw_button(screen, self.cancel_rect(), "Cancel", font, text_color, background_color)
@@ -0,0 +1,235 @@
+import mmap
+import os
+import re
+import tempfile
+
+import pygame
+
+from startup import LazyModule
+
+Image = LazyModule("PIL.Image")  # Pillow is imported the first time it is used
+
+# Layers hold premultiplied alpha: the color channels of each pixel are already scaled by its alpha, and a transparent
+# pixel is (0, 0, 0, 0).  Image files hold straight alpha, so pixels are converted only when they are read or written.
+
+def premultiply_color(color):
+    """Returns a straight RGBA color the way a layer stores it."""
+    r, g, b, a = color
+    return ((r * a + 127) // 255, (g * a + 127) // 255, (b * a + 127) // 255, a)
+
+def unpremultiply_color(color):
+    """Returns the straight RGBA color of a layer pixel, e.g. for the eyedropper."""
+    r, g, b, a = color
+    if a == 0:
+        return (0, 0, 0, 0)
+    return (min(255, (r * 255 + a // 2) // a), min(255, (g * 255 + a // 2) // a), min(255, (b * 255 + a // 2) // a), a)
+
+def erase(surface, amount, pos):
+    """
+    Takes coverage away from a premultiplied surface.  Every channel of the pixels under amount is scaled down by the
+    alpha of amount, so an amount of 255 leaves the pixel fully transparent.
+
+    :param surface: The premultiplied surface to erase from.
+    :param amount: A surface with the amount to erase drawn into all four channels.
+    :param pos: The position of amount on surface.
+    """
+
+    rect = pygame.Rect(pos, amount.get_size())
+    clipped_rect = rect.clip(surface.get_rect())
+    if clipped_rect.width == 0 or clipped_rect.height == 0:
+        return
+    # Multiplying by 255 - amount scales the color channels and the alpha alike, which keeps the pixels premultiplied
+    keep = pygame.Surface(clipped_rect.size, pygame.SRCALPHA)
+    keep.fill((255, 255, 255, 255))
+    keep.blit(amount, (0, 0), clipped_rect.move(-rect.x, -rect.y), special_flags=pygame.BLEND_RGBA_SUB)
+    surface.blit(keep, clipped_rect, special_flags=pygame.BLEND_RGBA_MULT)
+
+# Pages are cropped to the pixels of their layer when saved.  Where a page goes is kept in its XPosition and YPosition
+# tags (in inches at PAGE_DPI, as TIFF readers expect), and the size of the whole canvas in its ImageDescription.
+PAGE_DPI = 72
+CANVAS_DESCRIPTION = re.compile(r"canvas (\d+)x(\d+)")
+
+def page_tiffinfo(offset, canvas_size):
+    """Returns the TIFF tags of a page that goes at offset on a canvas of canvas_size."""
+    return {
+        270: f"canvas {canvas_size[0]}x{canvas_size[1]}",  # ImageDescription
+        282: PAGE_DPI,                                    # XResolution
+        283: PAGE_DPI,                                    # YResolution
+        296: 2,                                           # ResolutionUnit: inches
+        286: offset[0] / PAGE_DPI,                        # XPosition
+        287: offset[1] / PAGE_DPI,                        # YPosition
+    }
+
+def tiff_pages(file_path):
+    """
+    Yields (page, offset, canvas_size) for every page of a (multipage) image file.  page is a premultiplied RGBa PIL
+    image, which is closed once the caller moves on.  offset is where its top-left corner goes on the canvas, and
+    canvas_size is the size of the whole canvas, or None when the file doesn't say (files from other programs).
+    """
+    with Image.open(file_path) as img:
+        page = 0
+        while True:
+            tags = getattr(img, "tag_v2", {})
+            resolution = (float(tags.get(282, PAGE_DPI)) or PAGE_DPI, float(tags.get(283, PAGE_DPI)) or PAGE_DPI)
+            offset = (round(float(tags.get(286, 0)) * resolution[0]), round(float(tags.get(287, 0)) * resolution[1]))
+            match = CANVAS_DESCRIPTION.fullmatch(str(tags.get(270, "")))
+            canvas_size = (int(match.group(1)), int(match.group(2))) if match else None
+            pil_page = img.convert("RGBa")  # Convert each page to premultiplied RGBA, keeping the alpha if present
+            try:
+                yield pil_page, offset, canvas_size
+            finally:
+                pil_page.close()
+            page += 1
+            try:
+                img.seek(page)  # Move to next page in the tiff file
+            except EOFError:
+                # no more pages
+                return
+
+def place_pages(pages):
+    """
+    Returns the pages of tiff_pages() as premultiplied surfaces the size of the canvas, with each page at its offset.
+    Without a canvas size in the file, the canvas is just big enough for every page.
+    """
+    pages = [(pil_to_surface(pil_page), offset, canvas_size) for pil_page, offset, canvas_size in pages]
+    canvas_size = pages[0][2]
+    if canvas_size is None:
+        canvas_size = (max(offset[0] + surface.get_width() for surface, offset, size in pages),
+                       max(offset[1] + surface.get_height() for surface, offset, size in pages))
+    surfaces = []
+    for surface, offset, size in pages:
+        if surface.get_size() != tuple(canvas_size) or offset != (0, 0):
+            placed_surface = pygame.Surface(canvas_size, pygame.SRCALPHA)
+            placed_surface.blit(surface, offset)  # Blitting onto fully transparent pixels copies them as is
+            surface = placed_surface
+        surfaces.append(surface)
+    return surfaces
+
+def pil_to_surface(pil_img):
+    """Creates a premultiplied pygame surface with per-pixel alpha from an RGBa PIL image."""
+    raw = pil_img.tobytes("raw", "RGBa")
+    return pygame.image.fromstring(raw, pil_img.size, "RGBA")
+
+def surface_to_pil(surface):
+    """Creates a straight-alpha RGBA PIL image from a premultiplied pygame surface."""
+    size = surface.get_size()
+    if surface.get_flags() & pygame.SRCALPHA:
+        # Get raw RGBA bytes from the surface
+        raw_str = pygame.image.tostring(surface, "RGBA", False)
+        return Image.frombytes("RGBa", size, raw_str).convert("RGBA")
+    else:
+        # No alpha: get RGB bytes
+        raw_str = pygame.image.tostring(surface, "RGB", False)
+        return Image.frombytes("RGB", size, raw_str).convert("RGBA")
+
+def flatten(surfaces, size):
+    """Blends premultiplied surfaces bottom to top onto a new transparent surface of the given size, the same way the canvas shows them."""
+    flat_surface = pygame.Surface(size, pygame.SRCALPHA)
+    for surface in surfaces:
+        flat_surface.blit(surface, (0,0), special_flags=pygame.BLEND_PREMULTIPLIED)
+    return flat_surface
+
+def encode_image(file_path, size, raw):
+    """Writes premultiplied RGBA bytes to an image file with straight alpha, in the format of its extension.  Pillow lets go of the GIL while encoding."""
+    img = Image.frombuffer("RGBa", size, raw, "raw", "RGBa", 0, 1).convert("RGBA")
+    if os.path.splitext(file_path)[1].lower() in (".jpg", ".jpeg"):
+        img = img.convert("RGB")  # JPEG has no alpha channel
+    img.save(file_path)
+    img.close()
+
+def unpremultiply_store(source, target, mode="RGBA", rows=256):
+    """
+    Copies the premultiplied pixels of a memory-mapped TileStore into a buffer (e.g. another store's mmap) with straight
+    alpha, a strip of rows at a time.  mode is "RGBA", or "RGB" to drop the alpha channel.
+    """
+
+    row_bytes = source.width * 4
+    target_row_bytes = source.width * len(mode)
+    for top in range(0, source.height, rows):
+        bottom = min(source.height, top + rows)
+        strip = Image.frombuffer("RGBa", (source.width, bottom - top), source.mmap[top*row_bytes:bottom*row_bytes], "raw", "RGBa", 0, 1)
+        target[top*target_row_bytes:bottom*target_row_bytes] = strip.convert(mode).tobytes()
+
+def encode_store(file_path, store):
+    """
+    Writes the pixels of a memory-mapped TileStore to an image file, like encode_image.  They are converted into a
+    temporary memory-mapped file a strip at a time, and the encoder reads that file, so the document never has to fit in
+    memory.  Can run on a worker thread while the store stays open.
+    """
+
+    mode = "RGB" if os.path.splitext(file_path)[1].lower() in (".jpg", ".jpeg") else "RGBA"  # JPEG has no alpha channel
+    nbytes = store.width * store.height * len(mode)
+    with tempfile.TemporaryFile(prefix="export_") as straight_file:
+        straight_file.truncate(nbytes)
+        with mmap.mmap(straight_file.fileno(), nbytes) as straight:
+            unpremultiply_store(store, straight, mode)
+            img = Image.frombuffer(mode, (store.width, store.height), straight, "raw", mode, 0, 1)
+            img.save(file_path)
+            img.close()
+            del img  # Lets go of the buffer, so the mapping can be closed
+
+def image_size(file_path):
+    """Returns the size of an image file.  Only the header is read."""
+    with Image.open(file_path) as img:
+        return img.size
+
+def placement(source_size, canvas_size, mode):
+    """
+    Works out how an image goes onto the canvas.
+
+    :param source_size: The size of the image.
+    :param canvas_size: The size of the canvas.
+    :param mode: "fit" scales the whole image to fit in the canvas and centers it, "fill" scales it to cover the canvas and
+                 cuts off the overflow evenly on both sides, and "crop" keeps the image at its size, at the top-left corner.
+    :return: (box, size, pos): The area of the image to use, the size to resample that area to, and its position on the canvas.
+    """
+
+    source_w, source_h = source_size
+    canvas_w, canvas_h = canvas_size
+    if mode == "fit":
+        scale = min(canvas_w / source_w, canvas_h / source_h)
+        size = (max(1, round(source_w * scale)), max(1, round(source_h * scale)))
+        return (0, 0, source_w, source_h), size, ((canvas_w - size[0]) // 2, (canvas_h - size[1]) // 2)
+    elif mode == "fill":
+        scale = max(canvas_w / source_w, canvas_h / source_h)
+        box_w = min(source_w, canvas_w / scale)
+        box_h = min(source_h, canvas_h / scale)
+        left = (source_w - box_w) / 2
+        top = (source_h - box_h) / 2
+        return (left, top, left + box_w, top + box_h), (canvas_w, canvas_h), (0, 0)
+    else:
+        size = (min(source_w, canvas_w), min(source_h, canvas_h))
+        return (0, 0) + size, size, (0, 0)
+
+def decode_placed(file_path, canvas_size, mode):
+    """
+    Decodes the part of an image file that ends up on the canvas, resampled to the size it is shown at.
+
+    For JPEGs that are scaled down, the decoder does the first 1/2, 1/4 or 1/8 of the scaling itself, so the full-size
+    image is never held in memory.  Meant to run on a worker thread.
+
+    :return: (size, pos, premultiplied RGBA bytes) of the placed image, see placement().
+    """
+
+    with Image.open(file_path) as img:
+        source_size = img.size
+        box, size, pos = placement(source_size, canvas_size, mode)
+        scale = size[0] / (box[2] - box[0])
+        if img.format == "JPEG" and scale < 1:
+            # draft() picks the smallest reduced size that is still at least the requested one
+            img.draft(img.mode, (int(source_size[0] * scale) + 1, int(source_size[1] * scale) + 1))
+            x_ratio = img.size[0] / source_size[0]
+            y_ratio = img.size[1] / source_size[1]
+            box = (box[0] * x_ratio, box[1] * y_ratio, box[2] * x_ratio, box[3] * y_ratio)
+
+        # Resampling premultiplied pixels keeps the colors of transparent pixels from bleeding into the edges
+        rgba = img.convert("RGBa")
+        if mode == "crop":
+            placed = rgba.crop(box)
+        else:
+            # reducing_gap shrinks by whole factors first, which is much faster than resampling from the full size
+            placed = rgba.resize(size, Image.LANCZOS, box=box, reducing_gap=3.0)
+        rgba.close()
+        raw = placed.tobytes("raw", "RGBa")
+        placed.close()
+        return size, pos, raw
@@ -0,0 +1,131 @@
+import json
+import os
+import sys
+import time
+
+import pygame
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows
+
+def surface_bytes(surface):
+    """Returns the number of bytes of pixel memory held by surface (0 for None)."""
+    if surface is None:
+        return 0
+    return surface.get_pitch() * surface.get_height()
+
+def process_memory_bytes():
+    """Returns the resident memory of the whole process, or None if the platform doesn't report it."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        # Only the peak is available here.  It is in bytes on macOS and in kilobytes elsewhere.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    return None
+
+class MemoryAccountant:
+    """Tracks the memory used by layers, history, scratch surfaces and caches, and keeps the total under a budget."""
+
+    def __init__(self, budget_bytes):
+        """
+        Initializes the accountant.
+
+        :param budget_bytes: The total the tracked memory should stay under.  Past it, evictors are run in the order they were added.
+        """
+
+        self.budget_bytes = budget_bytes
+        self.sources = []        # (category, function returning {name: bytes})
+        self.evictors = []       # (name, function freeing one unit of memory and returning True, or False if nothing is left)
+        self.eviction_counts = {}
+        self.counters = []       # (name, function returning {counter: value}), reported along with the memory
+        self.scratch_peak = 0    # Largest short-lived scratch surface seen
+
+    def add_source(self, category, measure):
+        self.sources.append((category, measure))
+
+    def add_evictor(self, name, evict):
+        self.evictors.append((name, evict))
+        self.eviction_counts[name] = 0
+
+    def add_counters(self, name, counters):
+        self.counters.append((name, counters))
+
+    def note_scratch(self, surface):
+        """Records a short-lived scratch surface, which only counts towards the peak."""
+        self.scratch_peak = max(self.scratch_peak, surface_bytes(surface))
+
+    def measure(self):
+        """Returns {category: {name: bytes}} for every source."""
+        report = {}
+        for category, measure in self.sources:
+            report.setdefault(category, {}).update(measure())
+        return report
+
+    def total_bytes(self, report=None):
+        if report is None:
+            report = self.measure()
+        return sum(sum(items.values()) for items in report.values())
+
+    def enforce(self):
+        """Runs the evictors, highest priority first, until the total is under budget or nothing more can be evicted."""
+        total = self.total_bytes()
+        for name, evict in self.evictors:
+            while total > self.budget_bytes and evict():
+                self.eviction_counts[name] += 1
+                total = self.total_bytes()
+            if total <= self.budget_bytes:
+                break
+        return total
+
+    def snapshot(self):
+        """Returns a JSON-ready dict of the current usage."""
+        report = self.measure()
+        return {
+            "time": time.time(),
+            "budget_bytes": self.budget_bytes,
+            "total_bytes": self.total_bytes(report),
+            "process_bytes": process_memory_bytes(),
+            "categories": {category: {"total_bytes": sum(items.values()), "items": items} for category, items in report.items()},
+            "eviction_order": [name for name, evict in self.evictors],
+            "eviction_counts": dict(self.eviction_counts),
+            "counters": {name: counters() for name, counters in self.counters},
+        }
+
+    def dump(self, file_path):
+        with open(file_path, "w") as report_file:
+            json.dump(self.snapshot(), report_file, indent=2)
+
+    def draw(self, screen, pos, font, text_color, background_color):
+        """Draws a debug panel listing the usage per category and item.  Returns the rect of the panel."""
+        snapshot = self.snapshot()
+        mb = 1024 * 1024
+        lines = [f"Memory: {snapshot['total_bytes']/mb:.1f} MB tracked / {self.budget_bytes/mb:.0f} MB budget"]
+        if snapshot["process_bytes"] is not None:
+            lines.append(f"Process: {snapshot['process_bytes']/mb:.1f} MB")
+        for category, usage in snapshot["categories"].items():
+            lines.append(f"{category}: {usage['total_bytes']/mb:.1f} MB")
+            for name, nbytes in usage["items"].items():
+                lines.append(f"    {name}: {nbytes/mb:.2f} MB")
+        evicted = [f"{name} x{count}" for name, count in snapshot["eviction_counts"].items() if count > 0]
+        if evicted:
+            lines.append("Evicted: " + ", ".join(evicted))
+        for name, counters in snapshot["counters"].items():
+            lines.append(f"{name}: " + ", ".join(f"{counter} {value}" for counter, value in counters.items()))
+
+        line_surfaces = [font.render(line, True, text_color) for line in lines]
+        padding = 5
+        width = max(line_surface.get_width() for line_surface in line_surfaces) + padding*2
+        height = sum(line_surface.get_height() for line_surface in line_surfaces) + padding*2
+        panel = pygame.Surface((width, height), pygame.SRCALPHA)
+        panel.fill(background_color)
+        y = padding
+        for line_surface in line_surfaces:
+            panel.blit(line_surface, (padding, y))
+            y += line_surface.get_height()
+        return screen.blit(panel, pos)
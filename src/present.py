@@ -0,0 +1,132 @@
+import pygame
+from pygame._sdl2.video import Window, Renderer, Texture
+
+class DisplayPresenter:
+    """
+    Shows the frames the usual pygame way: screen is the display surface, and the whole of it is flipped every frame.
+    """
+
+    name = "display"
+
+    def __init__(self, title, size, fullscreen=False):
+        """
+        Opens the window.
+
+        :param title: The window title.
+        :param size: The (width, height) of the window.  Ignored when fullscreen.
+        :param fullscreen: Whether to cover the whole screen.
+        """
+
+        pygame.display.set_caption(title)
+        if fullscreen:
+            self.screen = pygame.display.set_mode(flags=pygame.FULLSCREEN)
+        else:
+            self.screen = pygame.display.set_mode(size)
+        self.window = Window.from_display_module()
+        self.uploaded_pixels = 0
+
+    def present(self, dirty_rects):
+        """Shows what was drawn on screen.  dirty_rects is not needed, the whole display is flipped."""
+        pygame.display.flip()
+        self.uploaded_pixels += self.screen.get_width() * self.screen.get_height()
+
+    def nbytes(self):
+        return 0  # The display surface belongs to SDL
+
+class RendererPresenter:
+    """
+    Shows the frames through an SDL renderer.  The frame is still drawn in software on screen, a plain surface, but
+    only the parts of it that changed are copied into a streaming texture, which the renderer then puts in the window.
+
+    SDL picks a GPU renderer when there is one and its software renderer otherwise.
+    """
+
+    name = "renderer"
+
+    def __init__(self, title, size, fullscreen=False, vsync=False):
+        """
+        Opens the window and creates the renderer.
+
+        :param title: The window title.
+        :param size: The (width, height) of the window.  Ignored when fullscreen.
+        :param fullscreen: Whether to cover the whole screen.
+        :param vsync: Whether present() waits for the display's refresh.  The frame rate is already limited by the main loop.
+        """
+
+        self.window = Window(title, size, fullscreen_desktop=fullscreen)
+        self.renderer = Renderer(self.window, vsync=vsync)
+        self.screen = pygame.Surface(self.window.size)
+        self.texture = Texture(self.renderer, self.window.size, streaming=True)
+        self.screen_rect = self.screen.get_rect()
+        self.full_upload = True  # The texture starts out empty
+        self.uploaded_pixels = 0
+
+    def present(self, dirty_rects):
+        """Copies the dirty_rects of screen into the texture and shows it."""
+        if self.full_upload:
+            dirty_rects = [self.screen_rect]
+            self.full_upload = False
+        for rect in merge_rects(dirty_rects, self.screen_rect):
+            self.texture.update(self.screen.subsurface(rect), rect)
+            self.uploaded_pixels += rect.width * rect.height
+        # The renderer's back buffer is undefined after presenting, so the whole texture is drawn every frame.  This is a
+        # copy on the GPU, or a plain memory copy with the software renderer.
+        self.renderer.clear()
+        self.texture.draw()
+        self.renderer.present()
+
+    def nbytes(self):
+        return self.screen.get_width() * self.screen.get_height() * 4 * 2  # screen and the texture
+
+PRESENTERS = {presenter.name: presenter for presenter in [DisplayPresenter, RendererPresenter]}
+
+def merge_rects(rects, bounds, max_rects=16):
+    """
+    Returns rects clipped to bounds, with overlapping ones joined.  Past max_rects they are all joined into one, as each
+    upload has a cost of its own.
+    """
+
+    merged = []
+    for rect in rects:
+        rect = pygame.Rect(rect).clip(bounds)
+        if rect.width == 0 or rect.height == 0:
+            continue
+        # Join with every rect it touches until it touches none
+        index = rect.collidelist(merged)
+        while index != -1:
+            rect.union_ip(merged.pop(index))
+            index = rect.collidelist(merged)
+        merged.append(rect)
+    if len(merged) > max_rects:
+        merged = [merged[0].unionall(merged[1:])]
+    return merged
+
+class FrameDamage:
+    """
+    Collects the parts of the screen that may differ from the last frame shown.
+
+    Things drawn over the canvas every frame, like tooltips and panels, are added as overlays.  They are also refreshed
+    in the following frame, so that the area they covered is put back once they move or go away.
+    """
+
+    def __init__(self):
+        self.rects = []
+        self.overlays = []
+        self.last_overlays = []
+
+    def add(self, rect):
+        """Adds a changed area.  None is ignored, for drawing functions that drew nothing."""
+        if rect is not None:
+            self.rects.append(pygame.Rect(rect))
+
+    def add_overlay(self, rect):
+        if rect is not None:
+            self.overlays.append(pygame.Rect(rect))
+
+    def take(self):
+        """Returns the areas to refresh for this frame and starts collecting the next one."""
+        rects = self.rects + self.overlays + self.last_overlays
+        self.last_overlays = self.overlays
+        self.rects = []
+        self.overlays = []
+        return rects
@@ -0,0 +1,230 @@
+import json
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import pygame
+
+class SessionProfiler:
+    """
+    A sampling profiler that can be started and stopped in the running program, to find out what makes a long session
+    slow without having to reproduce it.
+
+    While capturing, a background thread looks at the main thread's stack every interval_ms and counts each stack along
+    with the main loop phase it was in and the number of layers.  The main loop only sets phase and layer_count and calls
+    frame() once per frame, so it doesn't slow down.  Stopping hands the samples to another thread, which writes a pstats
+    file, a collapsed-stack file for flame graphs (e.g. flamegraph.pl or speedscope) and a JSON summary with the events
+    handled per frame.
+    """
+
+    def __init__(self, interval_ms=5):
+        """
+        Initializes the profiler, not capturing.
+
+        :param interval_ms: The time between two samples.
+        """
+
+        self.interval_ms = interval_ms
+        self.main_thread_id = threading.main_thread().ident
+        self.phase = "startup"  # Set by the main loop as it goes
+        self.layer_count = 0    # Set by the main loop once per frame
+        self.is_capturing = False
+        self.samples = Counter()  # (phase, layer count, stack as code keys from the outermost call in) -> count
+        self.sample_count = 0     # Kept apart, so the indicator doesn't go through samples while the sampler adds to it
+        self.frame_events = Counter()  # Events handled in a frame -> number of frames
+        self.frame_times = []
+        self.start_time = None
+        self.last_frame_time = None
+        self.sampler = None
+        self.stop_event = None
+        self.writer = None
+        self.output_prefix = None
+        self.written = None  # The files of the last capture, once written
+        self.error = None
+
+    def is_busy(self):
+        """Returns True while capturing or while the last capture is being written."""
+        return self.is_capturing or (self.writer is not None and self.writer.is_alive())
+
+    def start(self, output_prefix):
+        """
+        Starts capturing.
+
+        :param output_prefix: The path the files are written to, without an extension.  ".pstats", ".collapsed" and
+                              ".json" are added to it.
+        """
+
+        folder = os.path.dirname(output_prefix)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.output_prefix = output_prefix
+        self.samples = Counter()
+        self.sample_count = 0
+        self.frame_events = Counter()
+        self.frame_times = []
+        self.written = None
+        self.error = None
+        self.start_time = time.perf_counter()
+        self.last_frame_time = None
+        self.stop_event = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, args=(self.stop_event, self.samples), daemon=True)
+        self.is_capturing = True
+        self.sampler.start()
+
+    def stop(self):
+        """Stops capturing.  The files are written on another thread, so this returns right away."""
+        if not self.is_capturing:
+            return
+        self.is_capturing = False
+        self.stop_event.set()
+        summary = self.summary(time.perf_counter() - self.start_time)
+        self.writer = threading.Thread(target=self.write, args=(self.sampler, self.samples, summary, self.output_prefix), daemon=True)
+        self.writer.start()
+
+    def wait(self):
+        """Waits until the last capture is written, e.g. before the program exits."""
+        if self.writer is not None:
+            self.writer.join()
+
+    def frame(self, event_count):
+        """Records the end of a frame that handled event_count events.  Call once per frame."""
+        if not self.is_capturing:
+            return
+        now = time.perf_counter()
+        if self.last_frame_time is not None:
+            self.frame_times.append(now - self.last_frame_time)
+        self.last_frame_time = now
+        self.frame_events[event_count] += 1
+
+    def sample(self, stop_event, samples):
+        """Runs on the sampling thread until stop_event is set."""
+        interval = self.interval_ms / 1000
+        while not stop_event.wait(interval):
+            frame = sys._current_frames().get(self.main_thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            stack.reverse()
+            samples[(self.phase, self.layer_count, tuple(stack))] += 1
+            self.sample_count += 1
+
+    def summary(self, duration):
+        """Returns the JSON-ready summary of the frames.  The writer adds the samples per phase and layer count."""
+        frame_count = sum(self.frame_events.values())
+        event_count = sum(events * frames for events, frames in self.frame_events.items())
+        frame_ms = sorted(seconds * 1000 for seconds in self.frame_times)
+        return {
+            "duration_s": round(duration, 3),
+            "interval_ms": self.interval_ms,
+            "frames": frame_count,
+            "events": event_count,
+            "events_per_frame": {
+                "mean": round(event_count / frame_count, 2) if frame_count else 0,
+                "max": max(self.frame_events, default=0),
+                "histogram": {str(events): frames for events, frames in sorted(self.frame_events.items())},
+            },
+            "frame_ms": {
+                "mean": round(sum(frame_ms) / len(frame_ms), 2) if frame_ms else 0,
+                "p95": round(frame_ms[int(len(frame_ms) * 0.95)], 2) if frame_ms else 0,
+                "max": round(frame_ms[-1], 2) if frame_ms else 0,
+            },
+        }
+
+    def write(self, sampler, samples, summary, output_prefix):
+        """Runs on the writer thread.  Waits for the sampler to finish, then writes the three files."""
+        sampler.join()
+        phases = Counter()
+        layer_counts = Counter()
+        for (phase, layer_count, stack), count in samples.items():
+            phases[phase] += count
+            layer_counts[layer_count] += count
+        summary["samples"] = sum(samples.values())
+        summary["samples_per_phase"] = dict(phases.most_common())
+        summary["samples_per_layer_count"] = {str(layer_count): count for layer_count, count in sorted(layer_counts.items())}
+        try:
+            write_pstats(samples, self.interval_ms / 1000, output_prefix + ".pstats")
+            write_collapsed(samples, output_prefix + ".collapsed")
+            with open(output_prefix + ".json", "w") as summary_file:
+                json.dump(summary, summary_file, indent=2)
+            self.written = output_prefix
+        except OSError as error:
+            self.error = error
+
+    def draw(self, screen, pos, font, text_color, background_color):
+        """Draws the profiling indicator while capturing or writing, and returns its rect."""
+        if self.is_capturing:
+            seconds = int(time.perf_counter() - self.start_time)
+            text = f"PROFILING {seconds // 60:02}:{seconds % 60:02}  {self.sample_count} samples  (F10 stops)"
+        elif self.is_busy():
+            text = "Writing profile..."
+        elif self.error is not None:
+            text = f"Profile failed: {self.error}"
+        else:
+            return
+        text_surface = font.render(text, True, text_color)
+        box_rect = text_surface.get_rect(topleft=pos).inflate(10, 10)
+        box_rect.topleft = pos
+        pygame.draw.rect(screen, background_color, box_rect)
+        pygame.draw.rect(screen, text_color, box_rect, 1)
+        screen.blit(text_surface, (box_rect.x + 5, box_rect.y + 5))
+        return box_rect
+
+def tag_key(phase, layer_count):
+    """The made-up function each sample's stack starts from in the pstats file, so the tags show up as callers."""
+    return ("~", 0, f"<{phase}, {layer_count} layers>")
+
+def write_pstats(samples, interval, file_path):
+    """
+    Writes the samples in the format pstats.Stats reads.  Times are the number of samples times interval, and call
+    counts are the number of samples a function was seen in.
+    """
+
+    stats = {}  # code key -> [primitive calls, calls, own time, cumulative time, {caller key: [same four]}]
+    def entry(key):
+        if key not in stats:
+            stats[key] = [0, 0, 0.0, 0.0, {}]
+        return stats[key]
+
+    for (phase, layer_count, stack), count in samples.items():
+        stack = (tag_key(phase, layer_count),) + stack
+        seconds = count * interval
+        seen = set()
+        for index, key in enumerate(stack):
+            function = entry(key)
+            is_leaf = index == len(stack) - 1
+            if is_leaf:
+                function[2] += seconds
+            if key in seen:
+                continue  # Counted once per sample, so recursion doesn't add up to more than the total time
+            seen.add(key)
+            function[0] += count
+            function[1] += count
+            function[3] += seconds
+            if index > 0:
+                caller = function[4].setdefault(stack[index - 1], [0, 0, 0.0, 0.0])
+                caller[0] += count
+                caller[1] += count
+                caller[2] += seconds if is_leaf else 0.0
+                caller[3] += seconds
+
+    with open(file_path, "wb") as stats_file:
+        marshal.dump({key: (cc, nc, tt, ct, {caller: tuple(values) for caller, values in callers.items()})
+                      for key, (cc, nc, tt, ct, callers) in stats.items()}, stats_file)
+
+def write_collapsed(samples, file_path):
+    """Writes the samples as collapsed stacks, one "phase;layers;outermost;...;innermost count" line per stack."""
+    lines = Counter()
+    for (phase, layer_count, stack), count in samples.items():
+        names = [f"phase {phase}", f"{layer_count} layers"]
+        names += [f"{name} ({os.path.basename(filename)}:{lineno})" for filename, lineno, name in stack]
+        lines[";".join(name.replace(";", ",") for name in names)] += count
+    with open(file_path, "w") as collapsed_file:
+        for line, count in sorted(lines.items()):
+            collapsed_file.write(f"{line} {count}\n")
@@ -1,14 +1,38 @@
+import time
+start_time = time.perf_counter()
 import pygame
-from pygame._sdl2.video import Window
 import os
-import tkinter as tk
-from tkinter import filedialog, messagebox
-from PIL import Image
+from startup import LazyModule, FontCache, ImageCache, StartupTimer, cache_dir
+# tkinter and Pillow take a while to import and are only needed for message boxes and TIFF files, so import them on first use
+messagebox = LazyModule("tkinter.messagebox")
+Image = LazyModule("PIL.Image")
+from tilestore import TileCache, TileStore, TILE_SIZE
+from layerio import tiff_pages, page_tiffinfo, pil_to_surface, surface_to_pil, flatten, image_size, encode_image, encode_store, unpremultiply_store, premultiply_color, unpremultiply_color, erase
+from thumbnails import ThumbnailRenderer
+from eyedropper import Eyedropper
+from history import SurfaceSnapshot, RegionSnapshot, LayerRemoval, LayerInsertion, FrameRemoval, VectorSnapshot, CompoundEdit
+from selection import Selection
+from gradient import GRADIENT_MODES, draw_gradient, preview_gradient
+from vector import VectorShape, VectorLayer
+from memory import MemoryAccountant, surface_bytes
+from surfacepool import SurfacePool
+from filebrowser import FileBrowser, ThumbnailCache
+from importer import ImportDialog
+from filterdialog import FilterDialog
+from versions import VersionStore, VersionBrowser
+from exporter import LayerExporter
+from timelapse import TimelapseRecorder
+from profiler import SessionProfiler
+from transform import TransformTool
+from animation import Frame, Timeline
+from chrome import ChromeCache
+from present import PRESENTERS, FrameDamage
+from collab import CollabSession, STROKE, ERASE, SHAPE, CLEAR, ADD_LAYER, DELETE_LAYER, MOVE_LAYER, MERGE_DOWN, UNDO, REDO, LAYER_BODY, MOVE_LAYER_BODY, encode_stroke, encode_shape
 
 class Layer:
     """A class for creating a layer in Pygame."""
     
-    def __init__(self, x, y, width, height, background_color=None):
+    def __init__(self, x, y, width, height, background_color=None, document_size=None, tile_cache=None):
         """
         Initializes the layer object.
 
@@ -16,7 +40,9 @@ class Layer:
         :param y: The y-coordinate of the top-left corner to be displayed on screen.
         :param width: The width of the layer.
         :param height: The height of the layer.
-        :param background_color: The background color of this layer.  This will be set as transparent.
+        :param background_color: The background color of this layer.  This will be set as transparent.  Layers hold premultiplied alpha, so every transparent pixel is stored as (0, 0, 0, 0).
+        :param document_size: The (width, height) of the whole document.  When it is larger than the layer, the pixels are kept in a memory-mapped TileStore and the surface only holds the part in view.
+        :param tile_cache: The TileCache shared by the layers of the document.  Required together with document_size.
         """
 
         self.x = x
@@ -24,24 +50,144 @@ class Layer:
         self.width = width
         self.height = height
         if len(background_color) == 4:
-            self.bg_color = background_color
+            self.bg_color = premultiply_color(background_color)
         else: 
-            self.bg_color = background_color+(0,)
+            self.bg_color = premultiply_color(background_color+(0,))
         self.is_visible = True
         self.is_current = True
         self.rect = pygame.Rect(x, y, width, height)
         self.surface = pygame.Surface((width, height), pygame.SRCALPHA)
-        self.surface.set_colorkey(self.bg_color)
         self.surface.fill(self.bg_color)
         self.eye_button = None
         self.layer_button = None
-
-    def clear(self):
+        self.thumbnail = None
+        self.sync_id = None  # Names the layer in the operations sent to the other artists when drawing together
+        self.vector = None  # The VectorLayer holding the shapes of a vector layer.  Its surface is then their raster cache.
+
+        # Change tracking.  Each consumer (e.g. "thumbnail") gets the area changed since it last called take_dirty().
+        self.version = 0
+        self.dirty_rects = {}
+
+        # Where the layer has pixels that aren't transparent.  Changes only grow it.  After pixels may have been taken
+        # away (erasing, undo), it is only an upper bound until content_rect() measures it again.
+        self.content_bounds = self.surface.get_rect() if self.bg_color[3] else pygame.Rect(0, 0, 0, 0)
+        self.content_measured = True
+
+        # Out-of-core storage.  self.surface is the window into the document at (view_x, view_y).
+        self.view_x = 0
+        self.view_y = 0
+        self.store = None
+        if document_size is not None and tile_cache is not None and (document_size[0] > width or document_size[1] > height):
+            self.store = TileStore(document_size[0], document_size[1], tile_cache)
+
+    def clear(self, rect=None):
+        """Fills the layer (or only rect) with its background color."""
+        if rect is not None:
+            rect = rect.clip(self.surface.get_rect())
+            self.surface.fill(self.bg_color, rect)
+            self.mark_dirty(rect)
+            self.content_may_shrink()
+            return
+        self.surface.fill(self.bg_color)
+        self.mark_dirty()
+        self.content_bounds = self.surface.get_rect() if self.bg_color[3] else pygame.Rect(0, 0, 0, 0)
+        self.content_measured = True
+
+    def mark_dirty(self, rect=None):
+        """Records that the pixels in rect (or the whole layer) changed.  Call content_may_shrink() too if pixels were taken away."""
+        if rect is None:
+            rect = self.surface.get_rect()
+        else:
+            rect = rect.clip(self.surface.get_rect())
+        self.version += 1
+        if rect.width == 0 or rect.height == 0:
+            return  # Nothing changed, and a union with an empty rect would stretch to its corner
+        if self.content_bounds.width > 0 and self.content_bounds.height > 0:
+            self.content_bounds = self.content_bounds.union(rect)
+        else:
+            self.content_bounds = rect
+        for consumer, dirty_rect in self.dirty_rects.items():
+            if dirty_rect is None:
+                self.dirty_rects[consumer] = rect
+            else:
+                self.dirty_rects[consumer] = dirty_rect.union(rect)
+
+    def content_may_shrink(self):
+        """Records that pixels may have been made transparent, so content_rect() measures the content again."""
+        self.content_measured = False
+
+    def content_rect(self):
+        """Returns the bounding rect of the pixels that aren't transparent, or an empty rect if there are none."""
+        if not self.content_measured:
+            # The content can only have shrunk, so only the old bounds are searched
+            bounds = self.content_bounds
+            if bounds.width > 0 and bounds.height > 0:
+                bounds = self.surface.subsurface(bounds).get_bounding_rect().move(bounds.topleft)
+            self.content_bounds = bounds if bounds.width > 0 and bounds.height > 0 else pygame.Rect(0, 0, 0, 0)
+            self.content_measured = True
+        return self.content_bounds
+
+    def is_empty(self):
+        content_rect = self.content_rect()
+        return content_rect.width == 0 or content_rect.height == 0
+
+    def take_dirty(self, consumer):
+        """Returns the area changed since consumer last asked (the whole layer the first time), or None if nothing changed."""
+        if consumer not in self.dirty_rects:
+            self.dirty_rects[consumer] = None
+            return self.surface.get_rect()
+        dirty_rect = self.dirty_rects[consumer]
+        self.dirty_rects[consumer] = None
+        return dirty_rect
+
+    def nbytes(self):
+        """Returns the RAM held by the layer's pixels (the memory-mapped file of an out-of-core layer isn't counted)."""
+        return surface_bytes(self.surface)
+
+    def view_rect(self):
+        return pygame.Rect(self.view_x, self.view_y, self.width, self.height)
+
+    def set_view(self, view_x, view_y):
+        """Writes the part in view back to the store and pages in the part of the document at (view_x, view_y)."""
+        if self.store is None:
+            return
+        self.store.write_region(self.view_rect(), self.surface)
+        self.view_x = view_x
+        self.view_y = view_y
+        self.load_view()
+
+    def load_view(self):
+        """Pages in the part of the document in view, plus a margin of tiles around it for scrolling."""
         self.surface.fill(self.bg_color)
+        self.store.read_region(self.view_rect(), self.surface)
+        self.mark_dirty()
+        self.content_may_shrink()
+        self.store.prefetch(self.view_rect().inflate(TILE_SIZE*2, TILE_SIZE*2))
+
+    def sync_store(self):
+        """Makes store.backing hold the whole document, including what is being drawn in view."""
+        if self.store is not None:
+            self.store.write_region(self.view_rect(), self.surface)
+            self.store.flush()
+
+    def release(self):
+        """Frees the memory-mapped file of an out-of-core layer."""
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def render_vector(self):
+        """Rasterizes the parts of a vector layer whose shapes changed."""
+        if self.vector is not None:
+            for rect in self.vector.render(self.surface):
+                self.mark_dirty(rect)
+                self.content_may_shrink()  # Shapes may have moved away or been removed
 
     def draw(self, screen):
-        """Draws the layer on the screen"""
-        screen.blit(self.surface, (self.x, self.y))
+        """Draws the layer on the screen.  Only the part with pixels is blended."""
+        content_rect = self.content_rect()
+        if content_rect.width > 0 and content_rect.height > 0:
+            screen.blit(self.surface, content_rect.move(self.x, self.y), content_rect, special_flags=pygame.BLEND_PREMULTIPLIED)
 
 class Button:
     """A class for creating clickable buttons in Pygame."""
@@ -72,11 +218,11 @@ class Button:
         self.height = height
         self.rect = pygame.Rect(x, y, width, height)
         if inactive_image is not None:
-            self.inactive_image = pygame.transform.scale(pygame.image.load(inactive_image), (width, height))
+            self.inactive_image = pygame.transform.scale(image_cache.load(inactive_image), (width, height))
         else:
             self.inactive_image = None
         if active_image is not None:
-            self.active_image = pygame.transform.scale(pygame.image.load(active_image), (width, height))
+            self.active_image = pygame.transform.scale(image_cache.load(active_image), (width, height))
         else:
             self.active_image = None
         self.inactive_color = inactive_color
@@ -94,12 +240,12 @@ class Button:
         self.use_active_on_hover = True # When True, display active image/color when mouse hovers over button.  Otherwise, which image/color to display depends on self.is_active
 
         # Setup Font
-        self.font = pygame.font.SysFont('Arial', 12)
+        self.font = font_cache.get('Arial', 12)
 
-    def draw(self, screen):
-        """Draws the button on the screen, changing color on hover."""
+    def state(self):
+        """Returns everything the look of the button depends on, so a drawing of it can be reused while this stays the same."""
         mouse_pos = pygame.mouse.get_pos()
-        
+
         # Determine current state based on hover
         if (self.use_active_on_hover and self.rect.collidepoint(mouse_pos)) or self.is_active:
             current_image = self.active_image
@@ -107,6 +253,13 @@ class Button:
         else:
             current_image = self.inactive_image
             current_color = self.inactive_color
+        return (current_image, current_color, self.text, self.text_color, self.border_color)
+
+    def draw(self, screen, state=None):
+        """Draws the button on the screen, changing color on hover.  state is the button's state(), if already known."""
+        if state is None:
+            state = self.state()
+        current_image, current_color, text, text_color, border_color = state
             
         # Draw the button
         if current_image is not None:
@@ -115,18 +268,18 @@ class Button:
             pygame.draw.rect(screen, current_color, self.rect)
 
         # Draw text
-        if self.text is not None:
-            text_surf = self.font.render(self.text, True, self.text_color)       
+        if text is not None:
+            text_surf = self.font.render(text, True, text_color)       
             text_rect = text_surf.get_rect(center=self.rect.center)
             screen.blit(text_surf, text_rect)
 
         # Draw border
-        if self.border_color is not None:
-            pygame.draw.rect(screen, self.border_color, self.rect, 1)
+        if border_color is not None:
+            pygame.draw.rect(screen, border_color, self.rect, 1)
 
 
     def draw_tooltip(self, screen):
-        """Draws the button on the screen, changing color on hover."""
+        """Draws the button's tooltip while the mouse is over it, and returns the tooltip's rect."""
         mouse_pos = pygame.mouse.get_pos()
         
         # Determine current state based on hover
@@ -142,6 +295,7 @@ class Button:
                 pygame.draw.rect(screen, TOOLTIP_BG, box_rect)
                 pygame.draw.rect(screen, BLACK, box_rect, 1)
                 screen.blit(text_surface, (box_rect.x + padding, box_rect.y + padding))
+                return box_rect
 
     def handle_event(self, event):
         """Checks for a mouse click on the button and executes the action."""
@@ -174,7 +328,7 @@ def set_active_tool(instance):
     global start_pos
 
     start_pos = None
-    if instance.is_active and instance.tool in ["pen", "eraser", "square", "rect", "circle", "oval", "triangle", "eyedropper"]:
+    if instance.is_active and instance.tool in ["pen", "eraser", "square", "rect", "circle", "oval", "triangle", "eyedropper", "select_rect", "select_oval", "wand", "gradient", "object", "transform"]:
         active_tool = instance.tool
     else:
         active_tool = "None"
@@ -188,24 +342,39 @@ def set_active_color_button(instance):
     else:
         active_color_button = "pen_color"
 
-def add_layer(instance):
-    """Function to add a layer."""
+def add_layer(instance, sync_id=None, vector=False):
+    """Function to add a layer.  sync_id is given for a layer added by another artist.  vector makes it a vector layer."""
     global current_layer
     global layer_label_cnt
     if len(layers_list) < 10:
+        if sync_id is None:
+            sync_id = new_sync_id()
+            if share_later(ADD_LAYER, LAYER_BODY.pack, sync_id):
+                if vector:
+                    shared_vector_layers.add(sync_id)  # The others don't know it as a vector layer, but here it is one
+                return
+
         layerN = layers_list[len(layers_list)-1]
         layerN_eye_button = layerN.eye_button
         button_x = layerN_eye_button.x
         button_y = layerN_eye_button.y
         button_w = layerN_eye_button.width
         button_h = layerN_eye_button.height
+        if layerN.store is not None:
+            document_size = (layerN.store.width, layerN.store.height)
+        else:
+            document_size = None
         new_layer = Layer(
             x=layerN.x,
             y=layerN.y,
             width=layerN.width,
             height=layerN.height,
-            background_color=layerN.bg_color
+            background_color=layerN.bg_color,
+            document_size=document_size,
+            tile_cache=tile_cache
         )
+        if new_layer.store is not None:
+            new_layer.set_view(view_x, view_y)
 
         eye_button = Button(
             x=button_x, y=button_y+button_h, width=button_w, height=button_h,
@@ -227,17 +396,29 @@ def add_layer(instance):
             eye_button.is_active = True
         new_layer.eye_button=eye_button
         new_layer.layer_button=layer_button
+        new_layer.sync_id = sync_id
+        if vector or sync_id in shared_vector_layers:
+            new_layer.vector = VectorLayer(new_layer.surface.get_size())
+            shared_vector_layers.discard(sync_id)
 
         layer_buttons_list.extend([eye_button, layer_button])
         layers_list.append(new_layer)
         current_layer_history.append(current_layer)
         current_layer = new_layer
 
+def add_vector_layer(instance):
+    """Function to add a layer that keeps its shapes and pen strokes as objects, which can be moved and deleted later."""
+    if len(layers_list) < 10 and layers_list[0].store is None:
+        add_layer(instance, vector=True)
+
 def delete_layer(instance):
     """Function to delete a layer."""
     global current_layer
 
     if len(layers_list) > 1:
+        if share_later(DELETE_LAYER, LAYER_BODY.pack, current_layer.sync_id):
+            return
+
         # Remove the current_layer associated buttons from the buttons list
         layer_buttons_list.remove(current_layer.eye_button)
         layer_buttons_list.remove(current_layer.layer_button)
@@ -250,6 +431,7 @@ def delete_layer(instance):
 
         # Remove current_layer from the layers list
         layers_list.remove(current_layer)
+        current_layer.release()
 
         # Assign previous current_layer to current_layer
         try:
@@ -261,6 +443,8 @@ def move_layer_up(instance):
     """Function to move layer up to make it more visible."""
     global current_layer
     if len(layers_list) > 1:
+        if share_later(MOVE_LAYER, MOVE_LAYER_BODY.pack, current_layer.sync_id, 1):
+            return
         current_idx = layers_list.index(current_layer)
         layers_list.insert(current_idx+1, layers_list.pop(current_idx))
 
@@ -268,6 +452,8 @@ def move_layer_down(instance):
     """Function to move layer up to make it more visible."""
     global current_layer
     if len(layers_list) > 1:
+        if share_later(MOVE_LAYER, MOVE_LAYER_BODY.pack, current_layer.sync_id, -1):
+            return
         current_idx = layers_list.index(current_layer)
         layers_list.insert(current_idx-1, layers_list.pop(current_idx))
 
@@ -279,43 +465,175 @@ def set_current_layer(instance):
             current_layer = layer
             break
 
-def open_file_dialog(filetypes=None):
-    global window
+def push_undo(entry):
+    """Function to add an edit to the undo history.  Starting a new edit discards the redo history."""
+    global undo_history
+    global redo_history
+    undo_history.append(entry)
+    if len(undo_history) > max_undo_number:
+        undo_history = undo_history[-max_undo_number:]
+    redo_history = []
+
+def finish_transform(entry, moved_mask):
+    """Function called once a transform is in the layer.  Adds its undo entry, and moves the selection with the pixels."""
+    push_undo(entry)
+    if moved_mask is not None:
+        selection.combine(moved_mask)
+
+def evict_tile_cache():
+    """Function to halve the tile cache, writing its dirty tiles back.  Returns False when there is nothing left to give back."""
+    used_bytes = tile_cache.used_bytes
+    tile_cache.evict(used_bytes // 2)
+    return tile_cache.used_bytes < used_bytes
+
+def evict_vector_sprites():
+    """Function to drop the drawn shapes kept for redrawing vector layers.  Returns False when there were none."""
+    released = False
+    for layer in layers_list:
+        if layer.vector is not None and layer.vector.release_sprites():
+            released = True
+    return released
+
+def evict_redo():
+    """Function to drop the redo entry furthest from the current state."""
+    if len(redo_history) > 0:
+        del redo_history[0]
+        return True
+    return False
 
-    # Create a hidden root window
-    root = tk.Tk()
-    root.withdraw()
+def evict_undo():
+    """Function to drop the oldest undo entry, always keeping the latest one."""
+    if len(undo_history) > 1:
+        del undo_history[0]
+        return True
+    return False
 
-    # Open the file dialog
-    if filetypes is None:
-        filetypes = pygame_supported_filetypes
+def get_selection_mode():
+    """Function to get how a new selection combines with the current one, from the modifier keys held down."""
+    mods = pygame.key.get_mods()
+    if mods & pygame.KMOD_SHIFT:
+        return "add"
+    elif mods & pygame.KMOD_ALT:
+        return "subtract"
+    return "replace"
 
-    file_path = filedialog.askopenfilename(
-        title="Select a file",
-        filetypes=filetypes,
-    )
-    root.destroy()
-    window.focus()
-    return file_path
+def get_layers():
+    return layers_list
 
-def save_file_dialog(title="Save file as", filetypes=None):
-    global window
+def restore_layers(layers):
+    """Function to make a list of layers the layer stack, e.g. when undoing a merge.  An undo can empty it for a moment, while it swaps layers."""
+    global layers_list
+    global layer_buttons_list
+    global current_layer
 
-    # Create a hidden root window
-    root = tk.Tk()
-    root.withdraw()
+    layers_list = list(layers)
+    layer_buttons_list = []
+    for layer in layers_list:
+        layer_buttons_list.extend([layer.eye_button, layer.layer_button])
+    if current_layer not in layers_list and layers_list:
+        current_layer = layers_list[len(layers_list) - 1]
 
-    # Save file dialog
+def merge_layers(target, sources):
+    """Blends the sources onto target, the same way they are shown, and removes them.  Returns the edit that reverses it."""
+    global current_layer
+    global undo_history
+    global redo_history
+
+    layer_removal = LayerRemoval([(layers_list.index(source), source) for source in sources], get_layers, restore_layers)
+    if target.store is not None:
+        # Out-of-core layers are merged file to file.  Snapshots only cover the view, so the merge can't be undone.
+        target.sync_store()
+        for source in sources:
+            source.sync_store()
+            target.store.backing.blit(source.store.backing, (0,0), special_flags=pygame.BLEND_PREMULTIPLIED)
+            source.release()
+        target.load_view()
+        undo_history = []
+        redo_history = []
+        edit = None
+    else:
+        # Only the area where the sources have pixels needs blending, and only that area of target is saved for undo
+        merge_rect = None
+        for source in sources:
+            if not source.is_empty():
+                source_rect = source.content_rect()
+                merge_rect = source_rect if merge_rect is None else merge_rect.union(source_rect)
+        if merge_rect is not None:
+            # The merged pixels aren't shapes, so a vector target becomes a raster layer
+            vector_snapshot = VectorSnapshot(target)
+            target.vector = None
+            target_snapshot = RegionSnapshot(target, merge_rect)
+            for source in sources:
+                if not source.is_empty():
+                    source_rect = source.content_rect()
+                    target.surface.blit(source.surface, source_rect, source_rect, special_flags=pygame.BLEND_PREMULTIPLIED)
+            target.mark_dirty(merge_rect)
+            edit = CompoundEdit([vector_snapshot, target_snapshot, layer_removal])
+        else:
+            edit = layer_removal
+
+    for source in sources:
+        for i in range(len(current_layer_history) - 1, -1, -1):
+            if current_layer_history[i] == source:
+                del current_layer_history[i]
+    current_layer = target
+    restore_layers([layer for layer in layers_list if layer not in sources])
+    return edit
+
+def merge_down(instance):
+    """Function to merge the current layer into the visible layer below it."""
+    current_idx = layers_list.index(current_layer)
+    if current_idx > 0 and current_layer.is_visible and layers_list[current_idx-1].is_visible:
+        if share_later(MERGE_DOWN, LAYER_BODY.pack, current_layer.sync_id):
+            return
+        edit = merge_layers(layers_list[current_idx-1], [current_layer])
+        if edit is not None:
+            push_undo(edit)
+
+def flatten_visible(instance):
+    """Function to merge all the visible layers into the lowest visible layer.  Hidden layers are kept as they are."""
+    visible_layers = [layer for layer in layers_list if layer.is_visible]
+    if len(visible_layers) > 1:
+        edit = merge_layers(visible_layers[0], visible_layers[1:])
+        if edit is not None:
+            push_undo(edit)
+
+def pan_view(dx, dy):
+    """Function to scroll the canvas over a document that is larger than the canvas."""
+    global view_x
+    global view_y
+    global start_pos
+    global undo_history
+    global redo_history
+
+    store = layers_list[0].store
+    if store is None:
+        return
+    new_x = max(0, min(view_x + dx, store.width - canvas_width))
+    new_y = max(0, min(view_y + dy, store.height - canvas_height))
+    if (new_x, new_y) != (view_x, view_y):
+        view_x = new_x
+        view_y = new_y
+        for layer in layers_list:
+            layer.set_view(view_x, view_y)
+        start_pos = None
+        tmp_layer.clear()
+        selection.deselect()
+        # The undo snapshots hold the pixels of the previous view, so they can't be restored after scrolling
+        undo_history = []
+        redo_history = []
+
+def open_file_dialog(on_select, filetypes=None, confirm_message=None):
+    """Opens the file browser to pick an existing file.  on_select is called with its path once one is picked (and confirmed, with confirm_message)."""
     if filetypes is None:
         filetypes = pygame_supported_filetypes
-    file_path = filedialog.asksaveasfilename(
-        title=title,
-        defaultextension=".tiff",  # Default extension
-        filetypes=filetypes,
-    )
-    root.destroy()
-    window.focus()
-    return file_path
+    file_browser.open("Select a file", filetypes, on_select, confirm_message=confirm_message)
+
+def save_file_dialog(on_select, title="Save file as", filetypes=None):
+    """Opens the file browser to pick a file name to save to.  on_select is called with the path once one is picked."""
+    if filetypes is None:
+        filetypes = pygame_supported_filetypes
+    file_browser.open(title, filetypes, on_select, save_mode=True, default_extension=".tiff")
 
 def load_from_multipage_tif(file_path):
     global layers_list
@@ -323,6 +641,10 @@ def load_from_multipage_tif(file_path):
     global layer_buttons_list
     global current_layer_history
     global current_layer
+    global view_x
+    global view_y
+    global undo_history
+    global redo_history
 
     layer0 = layers_list[0]
     layer0_eye_button = layer0.eye_button
@@ -336,69 +658,88 @@ def load_from_multipage_tif(file_path):
     button_w = layer0_eye_button.width
     button_h = layer0_eye_button.height
 
+    for layer in layers_list:
+        layer.release()
     layers_list = []
     layer_label_cnt = 1
     layer_buttons_list = []
     current_layer_history = []
+    view_x = 0
+    view_y = 0
+
+    # The undo entries belong to the old layers
+    undo_history = []
+    redo_history = []
+
+    # Load the tiff pages into the layers.  Each page holds only the part of its layer with pixels, which goes at offset.
+    for pil_page, offset, canvas_size in tiff_pages(file_path):
+        # Pages larger than the canvas are kept out-of-core instead of being cropped to the canvas
+        if out_of_core:
+            document_size = canvas_size or pil_page.size
+        else:
+            document_size = None
 
-    # Load the tiff pages into the pil_images array
-    with Image.open(file_path) as img:
-        try:
-            page = 0
-            while True:
-                pil_page = img.convert("RGBA")  # Convert each page to RGBA to preserve alpha if present
-                pil_img = pil_page.copy()
-                size = pil_img.size  # (width, height)
-                raw = pil_img.tobytes("raw", "RGBA")
-                surf = pygame.image.fromstring(raw, size, "RGBA").convert_alpha()  # Create a pygame surface with per-pixel alpha
-                pil_img.close()
-
-                new_layer = Layer(
-                    x=layer0_x,
-                    y=layer0_y,
-                    width=layer0_w,
-                    height=layer0_h,
-                    background_color=layer0_bg
-                )
-                new_layer.surface.blit(surf, (0,0))
-
-                eye_button = Button(
-                    x=button_x, y=button_y, width=button_w, height=button_h,
-                    inactive_image=os.path.join("assets", "layer_hidden.png"), active_image=os.path.join("assets", "layer_shown.png"),
-                    border_color=BLACK,
-                )
-                eye_button.use_active_on_hover = False
-                layer_button = Button(
-                    x=button_x+button_w, y=button_y, width=button_w, height=button_h,
-                    inactive_color=SCREEN_BG, active_color=SILVER,
-                    border_color=BLACK,
-                    text=f"{layer_label_cnt}",
-                    tooltip_text="Set as current layer",
-                    action=set_current_layer
-                )
-                layer_label_cnt += 1
-                button_y += button_h
-
-                if new_layer.is_visible:
-                    eye_button.is_active = True
-                new_layer.eye_button=eye_button
-                new_layer.layer_button=layer_button
-
-                layer_buttons_list.extend([eye_button, layer_button])
-                layers_list.append(new_layer)
-
-                page += 1
-                img.seek(page)  # Move to next page in the tiff file
-        except EOFError:
-            # no more pages
-            pass
+        new_layer = Layer(
+            x=layer0_x,
+            y=layer0_y,
+            width=layer0_w,
+            height=layer0_h,
+            background_color=layer0_bg,
+            document_size=document_size,
+            tile_cache=tile_cache
+        )
+        new_layer.sync_id = new_sync_id()
+        if new_layer.store is not None:
+            # Copy the page into the memory-mapped file a strip at a time, so only one decoded page is in RAM.  The page
+            # goes at its offset, since pages hold only the part of the layer with pixels.
+            store = new_layer.store
+            page_width, page_height = pil_page.size
+            for top in range(0, page_height, TILE_SIZE):
+                bottom = min(page_height, top + TILE_SIZE)
+                strip = pil_page.crop((0, top, page_width, bottom))
+                strip_surface = pygame.image.frombuffer(strip.tobytes("raw", "RGBa"), strip.size, "RGBA")
+                store.backing.blit(strip_surface, (offset[0], offset[1] + top))  # Blitting onto fully transparent pixels copies them as is
+                strip.close()
+            new_layer.load_view()
+        else:
+            surf = pil_to_surface(pil_page)
+            new_layer.surface.blit(surf, offset)
+            new_layer.mark_dirty(pygame.Rect(offset, surf.get_size()))
 
-        current_layer = layers_list[len(layers_list) - 1]
+        eye_button = Button(
+            x=button_x, y=button_y, width=button_w, height=button_h,
+            inactive_image=os.path.join("assets", "layer_hidden.png"), active_image=os.path.join("assets", "layer_shown.png"),
+            border_color=BLACK,
+        )
+        eye_button.use_active_on_hover = False
+        layer_button = Button(
+            x=button_x+button_w, y=button_y, width=button_w, height=button_h,
+            inactive_color=SCREEN_BG, active_color=SILVER,
+            border_color=BLACK,
+            text=f"{layer_label_cnt}",
+            tooltip_text="Set as current layer",
+            action=set_current_layer
+        )
+        layer_label_cnt += 1
+        button_y += button_h
+
+        if new_layer.is_visible:
+            eye_button.is_active = True
+        new_layer.eye_button=eye_button
+        new_layer.layer_button=layer_button
+        thumbnail_renderer.render(new_layer, new_layer.take_dirty("thumbnail"))
+
+        layer_buttons_list.extend([eye_button, layer_button])
+        layers_list.append(new_layer)
+
+    current_layer = layers_list[len(layers_list) - 1]
 
 
 def load_file(instance):
-    file_path = open_file_dialog()
+    # The browser asks for confirmation inside the window, so the canvas keeps rendering
+    open_file_dialog(load_file_path, confirm_message="You will lose the current progress.")
 
+def load_file_path(file_path):
     global layers_list
     global layer_buttons_list
     global current_layer
@@ -406,10 +747,6 @@ def load_file(instance):
     global current_layer_history
 
     if file_path != "":
-        response = messagebox.askokcancel(title="Confirmation", message="You will loose current progress. Do you want to proceed?")
-        if not response:
-            return False
-
         if os.access(file_path, os.R_OK):
             base, ext = os.path.splitext(file_path)
             if ext.lower() == ".tiff":
@@ -417,118 +754,721 @@ def load_file(instance):
                 return True
             else:
                 try:
-                    # Load the image into the 1st layer and then remove the other layers
-                    image = pygame.image.load(file_path).convert_alpha()
-                    layers_list[0].clear()
-                    layers_list[0].surface.blit(image, (0,0))
-                    layers_list[0].layer_button.text = "1"
-                    layer_label_cnt = 2  # When we create a new layer, this is the name of it.
-                    current_layer = layers_list[0]
-                    layers_list = [layers_list[0]]  # Keep only the 1st layer.  Remove the rest.
-                    layer_buttons_list = [layers_list[0].eye_button, layers_list[0].layer_button] # Keep only the buttons associated with the 1st layer
-                    current_layer_history = [] # Reset the current_layer history
-                    return True
+                    source_size = image_size(file_path)
                 except:
                     messagebox.showerror(title="Error", message=f"Couldn't load from {file_path}.")
+                    return False
+                # The image is decoded on a worker thread, at the size it will have on the canvas
+                import_dialog.open(file_path, source_size, load_image,
+                                   lambda file_path: messagebox.showerror(title="Error", message=f"Couldn't load from {file_path}."))
+                return True
         else:
             messagebox.showerror(title="Error", message=f"{file_path} is not readable.")
     return False
 
+def load_image(image, pos):
+    """Loads a decoded image into a new 1st layer, in place of all the layers, and shows the top-left of the document."""
+    global layers_list
+    global layer_buttons_list
+    global current_layer
+    global layer_label_cnt
+    global current_layer_history
+    global view_x
+    global view_y
+    global undo_history
+    global redo_history
+
+    # A new layer rather than clearing the 1st one, whose memory-mapped file still holds the old document outside the view
+    layer0 = layers_list[0]
+    if layer0.store is not None:
+        document_size = (layer0.store.width, layer0.store.height)
+    else:
+        document_size = None
+    new_layer = Layer(
+        x=layer0.x,
+        y=layer0.y,
+        width=layer0.width,
+        height=layer0.height,
+        background_color=layer0.bg_color,
+        document_size=document_size,
+        tile_cache=tile_cache
+    )
+    new_layer.sync_id = new_sync_id()
+    new_layer.eye_button = layer0.eye_button  # Keep only the buttons associated with the 1st layer
+    new_layer.layer_button = layer0.layer_button
+    new_layer.eye_button.is_active = True
+    new_layer.layer_button.text = "1"
+    for layer in layers_list:
+        layer.release()
+
+    view_x = 0
+    view_y = 0
+    new_layer.surface.blit(image, pos, special_flags=pygame.BLEND_PREMULTIPLIED)
+    new_layer.mark_dirty(pygame.Rect(pos, image.get_size()))
+    layer_label_cnt = 2  # When we create a new layer, this is the name of it.
+    current_layer = new_layer
+    layers_list = [new_layer]
+    layer_buttons_list = [new_layer.eye_button, new_layer.layer_button]
+    current_layer_history = [] # Reset the current_layer history
+
+    # The undo entries belong to the old layers
+    undo_history = []
+    redo_history = []
+
 def save_to_multipage_tif(file_path):
     pil_images = []
+    straight_stores = []
     for layer in layers_list:
-        # TIFF doesn’t automatically interpret colorkey as transparency, so we'll get black background.
-        # Use convert_alpha to force the surface to have an alpha channel, so colorkey pixels become transparent instead of black.
-        tmp_surface = layer.surface.convert_alpha()
-        size = tmp_surface.get_size()
-        has_alpha = tmp_surface.get_flags() & pygame.SRCALPHA
-        if has_alpha:
-            # Get raw RGBA bytes from the surface
-            raw_str = pygame.image.tostring(tmp_surface, "RGBA", False)
-            pil_img = Image.frombytes("RGBA", size, raw_str)
-        else:
-            # No alpha: get RGB bytes
-            raw_str = pygame.image.tostring(tmp_surface, "RGB", False)
-            pil_img = Image.frombytes("RGB", size, raw_str).convert("RGBA")
-        pil_images.append(pil_img)
+        if layer.store is not None:
+            # TIFF pages hold straight alpha.  The converted pixels go into another memory-mapped file, which is wrapped
+            # without copying it, so the encoder pages it in as it goes.
+            layer.sync_store()
+            straight_store = TileStore(layer.store.width, layer.store.height, tile_cache)
+            unpremultiply_store(layer.store, straight_store.mmap)
+            straight_stores.append(straight_store)
+            pil_image = Image.frombuffer("RGBA", (layer.store.width, layer.store.height), straight_store.mmap, "raw", "RGBA", 0, 1)
+            pil_image.encoderinfo = {"tiffinfo": page_tiffinfo((0, 0), (layer.store.width, layer.store.height))}
+            pil_images.append(pil_image)
+            continue
+        # Only the part of the layer with pixels is encoded.  Its offset goes in the page's tags.  An empty layer is kept
+        # as a single transparent pixel, since a page can't be empty.
+        content_rect = layer.content_rect()
+        if content_rect.width == 0 or content_rect.height == 0:
+            content_rect = pygame.Rect(0, 0, 1, 1)
+        pil_image = surface_to_pil(layer.surface.subsurface(content_rect))
+        pil_image.encoderinfo = {"tiffinfo": page_tiffinfo(content_rect.topleft, layer.surface.get_size())}
+        pil_images.append(pil_image)
 
     first, rest = pil_images[0], pil_images[1:]
-    save_kwargs = {"format": "TIFF", "save_all": True, "append_images": rest}
+    save_kwargs = {"format": "TIFF", "save_all": True, "append_images": rest, "tiffinfo": first.encoderinfo["tiffinfo"]}
     save_kwargs["compression"] = "tiff_deflate"
 
     first.save(file_path, **save_kwargs)
     # Close PIL images
     for im in pil_images:
         im.close()
+    for straight_store in straight_stores:
+        straight_store.close()
     return True
 
 def save_file(instance):
-    file_path = save_file_dialog(title="Save file as (Hint: Save to TIFF to preserve layers)")
+    save_file_dialog(save_file_path, title="Save file as (Hint: Save to TIFF to preserve layers)")
 
+def save_file_path(file_path):
     if file_path != "":
         base, ext = os.path.splitext(file_path)
         if ext.lower() == ".tiff":
             save_to_multipage_tif(file_path)
             return True
-        else:
-            tmp_surface = pygame.Surface((layers_list[0].width, layers_list[0].height), pygame.SRCALPHA)
+        elif layers_list[0].store is not None:
+            # Flatten into another memory-mapped file rather than a document-sized surface
+            flat_store = TileStore(layers_list[0].store.width, layers_list[0].store.height, tile_cache)
             for layer in layers_list:
                 if layer.is_visible:
-                    tmp_surface.blit(layer.surface, (0,0))
+                    layer.sync_store()
+                    flat_store.backing.blit(layer.store.backing, (0,0), special_flags=pygame.BLEND_PREMULTIPLIED)
+            try:
+                encode_store(file_path, flat_store)
+                return True
+            except:
+                messagebox.showerror(title="Error", message=f"Couldn't save to {file_path}")
+            finally:
+                flat_store.close()
+        else:
+            tmp_surface = flatten([layer.surface for layer in layers_list if layer.is_visible and not layer.is_empty()], (layers_list[0].width, layers_list[0].height))
             try:
-                pygame.image.save(tmp_surface, file_path)
+                encode_image(file_path, tmp_surface.get_size(), pygame.image.tostring(tmp_surface, "RGBA", False))
                 return True
             except:
                 messagebox.showerror(title="Error", message=f"Couldn't save to {file_path}")
     return False
 
 def import_file(instance):
-    global current_layer
-
     # pygame can't import tiff file that it creates.  Removing it from the supported filetype list.
     mod_filetypes = []
     for x in pygame_supported_filetypes:
         if x != ("TIFF files", "*.tiff"):
             mod_filetypes.append(x)
             
-    file_path = open_file_dialog(filetypes=mod_filetypes)
+    open_file_dialog(import_file_path, filetypes=mod_filetypes)
+
+def import_file_path(file_path):
+    global current_layer
 
     if file_path != "":
         if os.access(file_path, os.R_OK):
             try:
-                image = pygame.image.load(file_path).convert_alpha()
-                current_layer.surface.blit(image, (0,0))
-                return True
+                source_size = image_size(file_path)
             except:
                 messagebox.showerror(title="Error", message=f"Couldn't import from {file_path}")
+                return False
+            # The image is decoded on a worker thread, at the size it will have on the canvas
+            import_dialog.open(file_path, source_size, place_import,
+                               lambda file_path: messagebox.showerror(title="Error", message=f"Couldn't import from {file_path}"))
+            return True
         else:
             messagebox.showerror(title="Error", message=f"{file_path} is not readable.")
     return False
 
-def export_file(instance):
+def place_import(image, pos):
     global current_layer
 
+    memory_accountant.note_scratch(image)
+    current_layer.surface.blit(image, pos, special_flags=pygame.BLEND_PREMULTIPLIED)
+    current_layer.mark_dirty(pygame.Rect(pos, image.get_size()))
+
+def export_file(instance):
     # pygame can't import tiff file that it creates.  Removing it from the supported filetype list.
     mod_filetypes = []
     for x in pygame_supported_filetypes:
         if x != ("TIFF files", "*.tiff"):
             mod_filetypes.append(x)
             
-    file_path = save_file_dialog(filetypes=mod_filetypes)
+    save_file_dialog(export_file_path, filetypes=mod_filetypes)
+
+def export_file_path(file_path):
+    global current_layer
 
     if file_path != "":
         try:
-            pygame.image.save(current_layer.surface, file_path)
+            encode, args = layer_export_job(current_layer)
+            encode(file_path, *args)
             return True
         except:
             messagebox.showerror(title="Error", message=f"Couldn't export to {file_path}.")
     return False
 
+def export_all_layers(instance):
+    instance.is_active = False  # A one-shot button rather than a toggle
+
+    # pygame can't import tiff file that it creates.  Removing it from the supported filetype list.
+    mod_filetypes = []
+    for x in pygame_supported_filetypes:
+        if x != ("TIFF files", "*.tiff"):
+            mod_filetypes.append(x)
+
+    file_browser.open("Export every layer to its own image ({n} in the name is the layer number)", mod_filetypes, export_all_layers_path,
+                      save_mode=True, default_extension=".png", file_name="layer_{n}.png", option_label="Only visible layers")
+
+def export_all_layers_path(file_path):
+    """Writes the layers to the folder of file_path, naming the files after its name pattern.  The files are encoded in the background."""
+    directory, pattern = os.path.split(file_path)
+    if "{" not in pattern:
+        # Without a placeholder every layer would be written to the same file
+        base, ext = os.path.splitext(pattern)
+        pattern = base + "_{n}" + ext
+
+    items = []
+    for index, layer in enumerate(layers_list):
+        if file_browser.option_checked and not layer.is_visible:
+            continue
+        try:
+            file_name = pattern.format(n=layer.layer_button.text, index=index+1)
+        except (KeyError, IndexError, ValueError):
+            messagebox.showerror(title="Error", message=f"Can't use {pattern} as a file name pattern.  Use {{n}} for the layer number.")
+            return False
+        items.append((file_name, layer))
+    layer_exporter.start(items, directory)
+    return True
+
+def layer_export_job(layer):
+    """
+    Returns (encode, args) to write a whole layer to a file with encode(file path, *args), for the exporter.  A layer in
+    memory is copied.  An out-of-core layer is read from its memory-mapped file a strip at a time while it is encoded,
+    rather than being copied into memory.
+    """
+
+    if layer.store is not None:
+        layer.sync_store()
+        return encode_store, (layer.store,)
+    return encode_image, (layer.surface.get_size(), pygame.image.tostring(layer.surface, "RGBA", False))
+
+def pick_color(pos):
+    """Function to return the straight RGBA color the eyedropper would pick at pos on the canvas, or None."""
+    key = (view_x, view_y, timeline.current, tuple((id(layer), layer.is_visible) for layer in layers_list))
+    return eyedropper.sample(layers_list, current_layer, pos, key)
+
+def canvas_damage():
+    """
+    Function to return the part of the canvas (in screen coordinates) that may look different from the last frame, or
+    None.  Strokes mark only what they touched; showing other layers, frames or another part of the document changes
+    the whole canvas.
+    """
+    global canvas_damage_key
+
+    key = (view_x, view_y, timeline.current, timeline.playing, timeline.playback_index() if timeline.playing else None, timeline.onion_enabled,
+           tuple((id(layer), layer.is_visible) for layer in layers_list))
+    damage_rect = None
+    for layer in layers_list + [tmp_layer]:
+        dirty_rect = layer.take_dirty("present")
+        if dirty_rect is not None:
+            dirty_rect = dirty_rect.move(layer.x, layer.y)
+            damage_rect = dirty_rect if damage_rect is None else damage_rect.union(dirty_rect)
+    if key != canvas_damage_key:
+        canvas_damage_key = key
+        return canvas_rect
+    return damage_rect
+
+def restore_version(version_layers):
+    """Function to replace the layers of the current frame with the (name, is_visible, surface) layers of an earlier version.  It can be undone."""
+    global current_layer
+    global layer_label_cnt
+
+    x, y, w, h = layer_button_start_info
+    layer0 = layers_list[0]
+    new_layers = []
+    for name, is_visible, surface in version_layers:
+        new_layer = Layer(
+            x=layer0.x,
+            y=layer0.y,
+            width=layer0.width,
+            height=layer0.height,
+            background_color=layer0.bg_color
+        )
+        # Blitting onto fully transparent pixels copies them as is
+        new_layer.surface.blit(surface, (0,0))
+        new_layer.mark_dirty()
+        new_layer.content_may_shrink()
+        new_layer.is_visible = is_visible
+        new_layer.sync_id = new_sync_id()
+
+        eye_button = Button(
+            x=x, y=y, width=w, height=h,
+            inactive_image=os.path.join("assets", "layer_hidden.png"), active_image=os.path.join("assets", "layer_shown.png"),
+            border_color=BLACK,
+        )
+        eye_button.use_active_on_hover = False
+        layer_button = Button(
+            x=x+w, y=y, width=w, height=h,
+            inactive_color=SCREEN_BG, active_color=SILVER,
+            border_color=BLACK,
+            text=name,
+            tooltip_text="Set as current layer",
+            action=set_current_layer
+        )
+        if new_layer.is_visible:
+            eye_button.is_active = True
+        new_layer.eye_button=eye_button
+        new_layer.layer_button=layer_button
+        thumbnail_renderer.render(new_layer, new_layer.take_dirty("thumbnail"))
+        new_layers.append(new_layer)
+        if name.isdigit():
+            layer_label_cnt = max(layer_label_cnt, int(name) + 1)
+
+    if new_layers:
+        # The old layers are put back before the new ones are taken out, so undoing never leaves the stack empty
+        removed = list(enumerate(layers_list))
+        push_undo(CompoundEdit([LayerInsertion(new_layers, get_layers, restore_layers), LayerRemoval(removed, get_layers, restore_layers)]))
+        restore_layers(new_layers)
+        current_layer = new_layers[len(new_layers) - 1]
+
+def store_frame():
+    """Function to save the globals that make up the current animation frame into its Frame."""
+    frame = timeline.current_frame()
+    frame.layers = layers_list
+    frame.layer_buttons = layer_buttons_list
+    frame.current_layer = current_layer
+    frame.layer_label_cnt = layer_label_cnt
+    frame.current_layer_history = current_layer_history
+    frame.undo_history = undo_history
+    frame.redo_history = redo_history
+
+def set_frame(index):
+    """Function to make another animation frame the one shown and drawn on.  Each frame keeps its own layers and undo history."""
+    global layers_list
+    global layer_buttons_list
+    global current_layer
+    global layer_label_cnt
+    global current_layer_history
+    global undo_history
+    global redo_history
+    global start_pos
+
+    if index == timeline.current:
+        return
+    store_frame()
+    timeline.current = index
+    frame = timeline.current_frame()
+    layers_list = frame.layers
+    layer_buttons_list = frame.layer_buttons
+    current_layer = frame.current_layer
+    layer_label_cnt = frame.layer_label_cnt
+    current_layer_history = frame.current_layer_history
+    undo_history = frame.undo_history
+    redo_history = frame.redo_history
+
+    # The view may have been scrolled while this frame was hidden
+    for layer in layers_list:
+        if (layer.view_x, layer.view_y) != (view_x, view_y):
+            layer.set_view(view_x, view_y)
+            undo_history = []
+            redo_history = []
+    start_pos = None
+    tmp_layer.clear()
+
+def add_frame(duplicate=False):
+    """Function to add an animation frame after the current one, with one empty layer or with a copy of the current frame's layers."""
+    if duplicate:
+        sources = layers_list
+    else:
+        sources = [layers_list[0]]
+
+    x, y, w, h = layer_button_start_info
+    new_layers = []
+    new_buttons = []
+    new_current_layer = None
+    for source in sources:
+        if source.store is not None:
+            document_size = (source.store.width, source.store.height)
+        else:
+            document_size = None
+        new_layer = Layer(
+            x=source.x,
+            y=source.y,
+            width=source.width,
+            height=source.height,
+            background_color=source.bg_color,
+            document_size=document_size,
+            tile_cache=tile_cache
+        )
+        new_layer.sync_id = new_sync_id()
+        if duplicate:
+            if new_layer.store is not None:
+                source.sync_store()
+                new_layer.store.mmap[:] = source.store.mmap
+                new_layer.set_view(view_x, view_y)
+            else:
+                # Blitting onto fully transparent pixels copies them as is
+                new_layer.surface.blit(source.surface, (0,0))
+                new_layer.mark_dirty()
+                new_layer.content_bounds = source.content_rect().copy()
+                if source.vector is not None:
+                    new_layer.vector = source.vector.copy()
+            new_layer.is_visible = source.is_visible
+            label = source.layer_button.text
+        else:
+            if new_layer.store is not None:
+                new_layer.set_view(view_x, view_y)
+            label = "1"
+
+        eye_button = Button(
+            x=x, y=y, width=w, height=h,
+            inactive_image=os.path.join("assets", "layer_hidden.png"), active_image=os.path.join("assets", "layer_shown.png"),
+            border_color=BLACK,
+        )
+        eye_button.use_active_on_hover = False
+        layer_button = Button(
+            x=x+w, y=y, width=w, height=h,
+            inactive_color=SCREEN_BG, active_color=SILVER,
+            border_color=BLACK,
+            text=label,
+            tooltip_text="Set as current layer",
+            action=set_current_layer
+        )
+        if new_layer.is_visible:
+            eye_button.is_active = True
+        new_layer.eye_button=eye_button
+        new_layer.layer_button=layer_button
+        thumbnail_renderer.render(new_layer, new_layer.take_dirty("thumbnail"))
+
+        new_layers.append(new_layer)
+        new_buttons.extend([eye_button, layer_button])
+        if source == current_layer or new_current_layer is None:
+            new_current_layer = new_layer
+
+    if duplicate:
+        label_cnt = layer_label_cnt
+    else:
+        label_cnt = 2
+    timeline.frames.insert(timeline.current + 1, Frame(new_layers, new_buttons, new_current_layer, label_cnt))
+    set_frame(timeline.current + 1)
+
+def delete_frame():
+    """
+    Function to delete the current animation frame, showing the previous frame (or the next one for the first frame).
+    The undo entry goes into the history of the frame shown, and keeps the deleted frame's layers until it is dropped.
+    """
+    if len(timeline.frames) > 1:
+        index = timeline.current
+        removed = timeline.frames[index]
+        if index > 0:
+            set_frame(index - 1)
+        else:
+            set_frame(index + 1)
+        del timeline.frames[index]
+        if timeline.current > index:
+            timeline.current -= 1
+        push_undo(FrameRemoval(timeline, index, removed))
+
+def toggle_playback():
+    if timeline.playing:
+        timeline.stop()
+    else:
+        store_frame()
+        timeline.play()
+
+def export_frames(instance):
+    # pygame can't import tiff file that it creates.  Removing it from the supported filetype list.
+    mod_filetypes = []
+    for x in pygame_supported_filetypes:
+        if x != ("TIFF files", "*.tiff"):
+            mod_filetypes.append(x)
+
+    file_browser.open("Export every animation frame to its own image ({n} in the name is the frame number)", mod_filetypes, export_frames_path,
+                      save_mode=True, default_extension=".png", file_name="frame_{n:03}.png")
+
+def export_frames_path(file_path):
+    """Writes the flattened animation frames to the folder of file_path, naming the files after its name pattern.  The files are encoded in the background."""
+    store_frame()
+    directory, pattern = os.path.split(file_path)
+    if "{" not in pattern:
+        # Without a placeholder every frame would be written to the same file
+        base, ext = os.path.splitext(pattern)
+        pattern = base + "_{n:03}" + ext
+
+    items = []
+    for index, frame in enumerate(timeline.frames):
+        try:
+            file_name = pattern.format(n=index+1)
+        except (KeyError, IndexError, ValueError):
+            messagebox.showerror(title="Error", message=f"Can't use {pattern} as a file name pattern.  Use {{n}} for the frame number.")
+            return False
+        items.append((file_name, frame))
+    layer_exporter.start(items, directory, snapshot=frame_export_job, what="frames")
+    return True
+
+def frame_export_job(frame):
+    """Returns (encode, args) to write a flattened animation frame to a file, for the exporter."""
+    composite = frame.composite((canvas_width, canvas_height))
+    return encode_image, (composite.get_size(), pygame.image.tostring(composite, "RGBA", False))
+
+def new_sync_id():
+    """Function to name a new layer for drawing together.  The client id in the top bits keeps the names of different artists apart."""
+    global sync_id_counter
+    sync_id_counter += 1
+    if collab is None:
+        return sync_id_counter
+    return (collab.client_id << 20) | sync_id_counter
+
+def is_sharing():
+    """Function to tell whether edits made here go to the relay.  Edits being applied from the relay aren't sent again."""
+    return collab is not None and collab.status == "connected" and not applying_remote
+
+def share_later(op, encode, *args):
+    """
+    Function to send an edit that is only done once the relay sends it back, in the same order as everyone else does it.
+    Returns False when not drawing together, and the edit is to be done right away.
+
+    :param op: The operation code.
+    :param encode: The function that turns args into the operation's body, e.g. LAYER_BODY.pack.  It is only called when
+                   connected, so edits cost nothing extra when drawing alone.
+    """
+
+    if not is_sharing():
+        return False
+    collab_pending.append((op, args, None))
+    collab.send(op, encode(*args))
+    return True
+
+def share_edit(entry, op, encode, *args):
+    """
+    Function to add an edit that was just drawn to the undo history, or when drawing together, to send it.  It then stays
+    as a preview until the relay sends it back, when it is done again in the relay's order and goes into the undo history.
+
+    :param entry: The undo entry of the edit, which also takes the preview away.
+    :param op: The operation code.  args are its arguments, as decode() returns them, and encode turns them into its body.
+    """
+
+    if not is_sharing():
+        push_undo(entry)
+        return
+    collab_pending.append((op, args, entry))
+    collab.send(op, encode(*args))
+
+def to_document(pos):
+    """Function to turn a position on the canvas into a position in the document, which is what is sent to the other artists."""
+    return (pos[0] + view_x, pos[1] + view_y)
+
+def find_synced_layer(sync_id):
+    for layer in layers_list:
+        if layer.sync_id == sync_id:
+            return layer
+    return None
+
+def run_on_layer(layer, action, *args):
+    """Function to run a layer action on layer for a shared edit, keeping the current layer here the same.  Returns what action returns."""
+    global current_layer
+    global applying_remote
+
+    previous_layer = current_layer
+    previous_applying_remote = applying_remote
+    current_layer = layer
+    applying_remote = True
+    try:
+        result = action(*args)
+    finally:
+        applying_remote = previous_applying_remote
+    if previous_layer in layers_list:
+        current_layer = previous_layer
+    return result
+
+def draw_remote_stroke(layer, color, width, points, erasing=False):
+    """Function to draw a pen or eraser stroke of another artist, segment by segment like a local stroke is drawn."""
+    points = [(x - layer.view_x, y - layer.view_y) for x, y in points]
+    for start, end in zip(points, points[1:]):
+        # Each segment is drawn on a surface just big enough for it, rather than one the size of the layer
+        segment_rect = pygame.Rect(start, (0, 0)).union(pygame.Rect(end, (0, 0))).inflate(width*2 + 2, width*2 + 2)
+        tmp_surface = pygame.Surface(segment_rect.size, pygame.SRCALPHA)
+        memory_accountant.note_scratch(tmp_surface)
+        offset_start = (start[0] - segment_rect.x, start[1] - segment_rect.y)
+        offset_end = (end[0] - segment_rect.x, end[1] - segment_rect.y)
+        if erasing:
+            alpha = color[3]
+            pygame.draw.line(tmp_surface, (alpha, alpha, alpha, alpha), offset_start, offset_end, width)
+            erase(layer.surface, tmp_surface, segment_rect.topleft)
+        else:
+            pygame.draw.line(tmp_surface, premultiply_color(color), offset_start, offset_end, width)
+            layer.surface.blit(tmp_surface, segment_rect, special_flags=pygame.BLEND_PREMULTIPLIED)
+        layer.mark_dirty(segment_rect)
+    if erasing:
+        layer.content_may_shrink()
+
+def do_operation(op, args, own):
+    """
+    Function to do a shared edit.  Edits on layers that aren't in the layer stack here are skipped.
+
+    :param own: True for an edit made here, e.g. so a layer added here becomes the current one.
+    :return: The undo entry of the edit, or None if it was skipped or can't be undone.
+    """
+
+    if op == ADD_LAYER:
+        if find_synced_layer(args[0]) is None:
+            if own:
+                add_layer(None, args[0])
+            else:
+                run_on_layer(current_layer, add_layer, None, args[0])
+        return None
+    if op not in (STROKE, ERASE, SHAPE, CLEAR, DELETE_LAYER, MOVE_LAYER, MERGE_DOWN):
+        return None
+    layer = find_synced_layer(args[0])
+    if layer is None:
+        return None
+
+    if op in (STROKE, ERASE):
+        layer_id, color, width, points = args
+        if layer.vector is None:
+            stroke_rect = pygame.Rect(points[0], (0, 0)).unionall([pygame.Rect(point, (0, 0)) for point in points])
+            entry = RegionSnapshot(layer, stroke_rect.move(-layer.view_x, -layer.view_y).inflate(width*2 + 2, width*2 + 2))
+            draw_remote_stroke(layer, color, width, points, erasing=op == ERASE)
+            return entry
+        elif op == STROKE:
+            # The other side may not have this as a vector layer, but here the stroke is kept as a polyline
+            entry = VectorSnapshot(layer)
+            layer.vector.add(VectorShape("polyline", tuple(points), color, color, width, 0))
+            layer.render_vector()
+            return entry
+    elif op == SHAPE:
+        layer_id, tool, pen, fill, start, end, remote_shape_width, line_width = args
+        start = (start[0] - layer.view_x, start[1] - layer.view_y)
+        end = (end[0] - layer.view_x, end[1] - layer.view_y)
+        if layer.vector is None:
+            entries = []
+            shape_rect = draw_shape(tool, layer.surface, pen, fill, start, end, remote_shape_width, line_width, use_selection=False,
+                                    before_drawing=lambda rect: entries.append(RegionSnapshot(layer, rect)))
+            layer.mark_dirty(shape_rect)
+            return entries[0]
+        else:
+            entry = VectorSnapshot(layer)
+            layer.vector.add(make_vector_shape(tool, pen, fill, start, end, remote_shape_width, line_width))
+            layer.render_vector()
+            return entry
+    elif op == CLEAR:
+        if layer.vector is not None:
+            entry = VectorSnapshot(layer)
+            layer.vector.set_shapes([])
+            layer.render_vector()
+        else:
+            entry = SurfaceSnapshot(layer, pygame.Surface.copy(layer.surface))
+            layer.clear()
+        return entry
+    elif op == DELETE_LAYER:
+        run_on_layer(layer, delete_layer, None)
+    elif op == MOVE_LAYER:
+        run_on_layer(layer, move_layer_up if args[1] > 0 else move_layer_down, None)
+    elif op == MERGE_DOWN:
+        # The artist who merged checked that both layers were visible on their side, so this doesn't depend on visibility here
+        layer_idx = layers_list.index(layer)
+        if layer_idx > 0:
+            return run_on_layer(layer, merge_layers, layers_list[layer_idx-1], [layer])
+    return None
+
+def apply_operation(operation, own):
+    """
+    Function to apply one shared edit in relay order.  Each artist's shared edits have their own undo and redo history,
+    which UNDO and REDO go through, so an undo changes the same pixels for everyone.
+    """
+
+    undo_stack = collab_undo.setdefault(operation.client_id, [])
+    redo_stack = collab_redo.setdefault(operation.client_id, [])
+    if operation.op in (UNDO, REDO):
+        if operation.op == UNDO:
+            from_stack, to_stack, local_from, local_to = undo_stack, redo_stack, undo_history, redo_history
+        else:
+            from_stack, to_stack, local_from, local_to = redo_stack, undo_stack, redo_history, undo_history
+        if from_stack:
+            entry = from_stack.pop()
+            inverse = entry.apply()
+            to_stack.append(inverse)
+            if own:
+                if entry in local_from:
+                    local_from.remove(entry)
+                local_to.append(inverse)
+        return
+
+    entry = do_operation(operation.op, operation.args, own)
+    if entry is not None:
+        undo_stack.append(entry)
+        del undo_stack[:-max_undo_number]
+        redo_stack.clear()
+        if own:
+            push_undo(entry)
+
+def apply_shared(operations):
+    """
+    Function to apply the shared edits, this artist's own included, in the order the relay numbered them.  The own edits
+    that haven't come back from the relay yet are shown as a preview, so they are taken off first and done again on top.
+    """
+
+    global applying_remote
+
+    applying_remote = True
+    try:
+        for op, args, entry in reversed(collab_pending):
+            if entry is not None:
+                entry.apply()
+        for operation in operations:
+            own = operation.client_id == collab.client_id
+            if own and collab_pending:
+                collab_pending.pop(0)  # The relay keeps the order each artist sent their edits in
+            apply_operation(operation, own)
+        for index, (op, args, entry) in enumerate(collab_pending):
+            if entry is not None:
+                collab_pending[index] = (op, args, do_operation(op, args, True))
+    finally:
+        applying_remote = False
+
 def set_active_color(instance):
     """Function to set current color."""
     global current_pen_color
     global current_fill_color
     global active_color_button
+    if instance.tool == "eraser_color":
+        # Erasing takes coverage away rather than painting a color, so the eraser swatch picks the eraser tool
+        for button in tool_buttons_list:
+            if button.tool == "eraser":
+                button.is_active = True
+                set_active_tool(button)
+        return
     if active_color_button == "pen_color":
         current_pen_color = instance.active_color
     elif active_color_button == "fill_color":
@@ -651,7 +1591,7 @@ def create_left_buttons(edge_padding, button_padding, button_w, button_h):
         x=button_x, y=button_y, width=button_w, height=button_h,
         inactive_image=os.path.join("assets", "eyedropper_inactive.png"), active_image=os.path.join("assets", "eyedropper_active.png"),
         tool="eyedropper",
-        tooltip_text="Color Picker",
+        tooltip_text="Color Picker (S: sample size, L: all layers or the current layer)",
         action=set_active_tool
     )
 
@@ -700,7 +1640,77 @@ def create_left_buttons(edge_padding, button_padding, button_w, button_h):
         action=set_active_tool
     )
 
-    button_y = button_y + (button_h + button_padding)*4
+    # Selection tools are half-height text buttons in the gap below the shapes
+    select_y = button_y + button_h + button_padding
+    select_rect_button = Button(
+        x=button_x, y=select_y, width=button_w, height=button_h//2,
+        inactive_color=SILVER, active_color=SCREEN_BG,
+        border_color=BLACK,
+        text="[  ]",
+        tool="select_rect",
+        tooltip_text="Rectangle Select (Shift: add, Alt: subtract)",
+        action=set_active_tool
+    )
+
+    select_y = select_y + button_h//2 + button_padding//2
+    select_oval_button = Button(
+        x=button_x, y=select_y, width=button_w, height=button_h//2,
+        inactive_color=SILVER, active_color=SCREEN_BG,
+        border_color=BLACK,
+        text="(  )",
+        tool="select_oval",
+        tooltip_text="Ellipse Select (Shift: add, Alt: subtract)",
+        action=set_active_tool
+    )
+
+    select_y = select_y + button_h//2 + button_padding//2
+    wand_button = Button(
+        x=button_x, y=select_y, width=button_w, height=button_h//2,
+        inactive_color=SILVER, active_color=SCREEN_BG,
+        border_color=BLACK,
+        text="Wand",
+        tool="wand",
+        tooltip_text="Magic Wand (Shift: add, Alt: subtract)",
+        action=set_active_tool
+    )
+
+    # The gradient button shows the gradient mode
+    global gradient_button
+    select_y = select_y + button_h//2 + button_padding//2
+    gradient_button = Button(
+        x=button_x, y=select_y, width=button_w, height=button_h//2,
+        inactive_color=SILVER, active_color=SCREEN_BG,
+        border_color=BLACK,
+        text="Linear",
+        tool="gradient",
+        tooltip_text="Gradient from pen to fill color (g: linear, radial, angular, Shift+g: dither)",
+        action=set_active_tool
+    )
+
+    select_y = select_y + button_h//2 + button_padding//2
+    object_button = Button(
+        x=button_x, y=select_y, width=button_w, height=button_h//2,
+        inactive_color=SILVER, active_color=SCREEN_BG,
+        border_color=BLACK,
+        text="Object",
+        tool="object",
+        tooltip_text="Pick, move (drag) and delete (Delete) shapes on a vector layer (F8 adds one)",
+        action=set_active_tool
+    )
+
+    global transform_button
+    select_y = select_y + button_h//2 + button_padding//2
+    transform_button = Button(
+        x=button_x, y=select_y, width=button_w, height=button_h//2,
+        inactive_color=SILVER, active_color=SCREEN_BG,
+        border_color=BLACK,
+        text="Transform",
+        tool="transform",
+        tooltip_text="Move (drag), scale (Shift+drag) or rotate (Ctrl+drag) the selection or layer (t: smooth or nearest)",
+        action=set_active_tool
+    )
+
+    button_y = button_y + (button_h + button_padding)*4 + button_h//2 + button_padding//2
     quit_button = Button(
         x=button_x, y=button_y, width=button_w, height=button_h,
         inactive_image=os.path.join("assets", "quit_inactive.png"), active_image=os.path.join("assets", "quit_active.png"),
@@ -709,7 +1719,8 @@ def create_left_buttons(edge_padding, button_padding, button_w, button_h):
         action=quit_program
     )
 
-    tool_buttons_list.extend([pen_button, eraser_button, eyedropper_button, square_button, rect_button, circle_button, oval_button, triangle_button, quit_button])    
+    tool_buttons_list.extend([pen_button, eraser_button, eyedropper_button, square_button, rect_button, circle_button, oval_button, triangle_button,
+                              select_rect_button, select_oval_button, wand_button, gradient_button, object_button, transform_button, quit_button])    
 
 def create_right_buttons(edge_padding, button_padding, button_w, button_h, screen_width):
     # --- Create right side buttons ---
@@ -752,7 +1763,18 @@ def create_right_buttons(edge_padding, button_padding, button_w, button_h, scree
         action=export_file
     )
 
-    misc_buttons_list.extend([save_button, load_button, import_button, export_button])
+    button_y = button_y + button_h + button_padding
+    export_all_button = Button(
+        x=button_x, y=button_y, width=button_w, height=button_h//2,
+        inactive_color=SILVER, active_color=SCREEN_BG,
+        border_color=BLACK,
+        text="All",
+        tool="export_all",
+        tooltip_text="Export every layer to its own image",
+        action=export_all_layers
+    )
+
+    misc_buttons_list.extend([save_button, load_button, import_button, export_button, export_all_button])
 
 def create_layer_buttons(edge_padding, button_padding, button_w, button_h, screen_width, layers_list):
     # --- Create right side buttons ---
@@ -862,7 +1884,7 @@ def create_color_buttons(x_edge_padding, y_edge_padding, button_padding, button_
             x=button_x, y=button_y, width=button_w, height=button_h,
             inactive_color=color, active_color=color,
             border_color=BLACK,
-            tool="color",
+            tool="eraser_color" if tooltip == "Eraser" else "color",
             tooltip_text=tooltip,
             action=set_active_color
         )
@@ -946,31 +1968,74 @@ def create_lw_a_buttons(x_edge_padding, y_edge_padding, button_padding, button_w
                               alpha_label_button, alpha_minus_button, alpha_value_button, alpha_plus_button])
 
 
-def draw_shape(active_tool, surface, pen_color, fill_color, start_pos, current_pos, shape_width):
-    global line_thickness
-    tmp_surface = pygame.Surface((surface.get_width(), surface.get_height()), pygame.SRCALPHA)
+def draw_shape(active_tool, surface, pen_color, fill_color, start_pos, current_pos, shape_width, line_width=None, use_selection=True, before_drawing=None):
+    """
+    Draws the shape onto surface and returns the rect it covers.  line_width defaults to the current line_thickness.
+    before_drawing, if given, is called with that rect just before surface is changed, e.g. to save the area for undo.
+    """
+    if line_width is None:
+        line_width = line_thickness
+    pen_color = premultiply_color(pen_color)
+    fill_color = premultiply_color(fill_color)
+    tmp_surface = surface_pool.acquire(surface.get_size())
+    shape_rect = pygame.Rect(start_pos, (0, 0))
     if active_tool == "square":
-        pygame.draw.rect(tmp_surface, fill_color, get_square(start_pos, current_pos), shape_width)
+        shape_rect.union_ip(pygame.draw.rect(tmp_surface, fill_color, get_square(start_pos, current_pos), shape_width))
         if pen_color != fill_color:
-            pygame.draw.rect(tmp_surface, pen_color, get_square(start_pos, current_pos), line_thickness)
+            shape_rect.union_ip(pygame.draw.rect(tmp_surface, pen_color, get_square(start_pos, current_pos), line_width))
     elif active_tool == "rect":
-        pygame.draw.rect(tmp_surface, fill_color, get_rect(start_pos, current_pos), shape_width)
+        shape_rect.union_ip(pygame.draw.rect(tmp_surface, fill_color, get_rect(start_pos, current_pos), shape_width))
         if pen_color != fill_color:
-            pygame.draw.rect(tmp_surface, pen_color, get_rect(start_pos, current_pos), line_thickness)
+            shape_rect.union_ip(pygame.draw.rect(tmp_surface, pen_color, get_rect(start_pos, current_pos), line_width))
     elif active_tool == "circle":
         x, y , radius = get_circle(start_pos, current_pos)
-        pygame.draw.circle(tmp_surface, fill_color, (x, y), radius, shape_width)
+        shape_rect.union_ip(pygame.draw.circle(tmp_surface, fill_color, (x, y), radius, shape_width))
         if pen_color != fill_color:
-            pygame.draw.circle(tmp_surface, pen_color, (x, y), radius, line_thickness)
+            shape_rect.union_ip(pygame.draw.circle(tmp_surface, pen_color, (x, y), radius, line_width))
     elif active_tool == "oval":
-        pygame.draw.ellipse(tmp_surface, fill_color, get_rect(start_pos, current_pos), shape_width)
+        shape_rect.union_ip(pygame.draw.ellipse(tmp_surface, fill_color, get_rect(start_pos, current_pos), shape_width))
         if pen_color != fill_color:
-            pygame.draw.ellipse(tmp_surface, pen_color, get_rect(start_pos, current_pos), line_thickness)
+            shape_rect.union_ip(pygame.draw.ellipse(tmp_surface, pen_color, get_rect(start_pos, current_pos), line_width))
     elif active_tool == "triangle":
-        pygame.draw.polygon(tmp_surface, fill_color, get_triangle(start_pos, current_pos), shape_width)
+        shape_rect.union_ip(pygame.draw.polygon(tmp_surface, fill_color, get_triangle(start_pos, current_pos), shape_width))
         if pen_color != fill_color:
-            pygame.draw.polygon(tmp_surface, pen_color, get_triangle(start_pos, current_pos), line_thickness)
-    surface.blit(tmp_surface, (0, 0))
+            shape_rect.union_ip(pygame.draw.polygon(tmp_surface, pen_color, get_triangle(start_pos, current_pos), line_width))
+    if use_selection:
+        selection.clip(tmp_surface, shape_rect)
+    if before_drawing is not None:
+        before_drawing(shape_rect)
+    surface.blit(tmp_surface, shape_rect, shape_rect, special_flags=pygame.BLEND_PREMULTIPLIED)
+    surface_pool.release(tmp_surface, shape_rect)
+    return shape_rect
+
+def make_vector_shape(active_tool, pen_color, fill_color, start_pos, current_pos, shape_width, line_width=None):
+    """Returns the VectorShape of what draw_shape would draw with the same arguments."""
+    if line_width is None:
+        line_width = line_thickness
+    if active_tool == "square":
+        geometry = tuple(get_square(start_pos, current_pos))
+    elif active_tool in ["rect", "oval"]:
+        geometry = tuple(get_rect(start_pos, current_pos))
+    elif active_tool == "circle":
+        geometry = get_circle(start_pos, current_pos)
+    else:
+        geometry = get_triangle(start_pos, current_pos)
+    return VectorShape(active_tool, geometry, pen_color, fill_color, line_width, shape_width)
+
+def add_shape(active_tool, start_pos, current_pos):
+    """Function to draw the shape of a shape tool on the current layer, or to add it as an object on a vector layer."""
+    if current_layer.vector is not None:
+        entry = VectorSnapshot(current_layer)
+        current_layer.vector.add(make_vector_shape(active_tool, pen_color+(alpha,), fill_color+(alpha,), start_pos, current_pos, shape_width))
+        current_layer.render_vector()
+    else:
+        # Only the area under the shape goes into the undo history
+        entries = []
+        shape_rect = draw_shape(active_tool, current_layer.surface, pen_color+(alpha,), fill_color+(alpha,), start_pos, current_pos, shape_width,
+                                before_drawing=lambda rect: entries.append(RegionSnapshot(current_layer, rect)))
+        current_layer.mark_dirty(shape_rect)
+        entry = entries[0]
+    share_edit(entry, SHAPE, encode_shape, current_layer.sync_id, active_tool, pen_color+(alpha,), fill_color+(alpha,), to_document(start_pos), to_document(current_pos), shape_width, line_thickness)
 
 def is_pos_in_canvas(pos, canvas_rect):
     if canvas_rect.collidepoint(pos):
@@ -1009,22 +2074,29 @@ SCREEN_BG = GRAY
 TOOLTIP_BG = (255, 255, 200)
 TRANSPARENT_BG = (255, 255, 255)
 
+print_startup_report = False  # Print how long each phase of startup took
+startup_timer = StartupTimer(start_time)
+startup_timer.mark("imports")
+
 pygame.init()
-pygame.display.set_caption("Drawing Pygame Software")
+# How the frames get to the window: "display" flips the whole pygame display surface, "renderer" copies only the
+# changed parts of each frame into an SDL texture (using the GPU when there is one).  `python benchmark.py present` compares them.
+presentation_backend = "display"
 fullscreen = False
-if fullscreen:
-    screen = pygame.display.set_mode(flags=pygame.FULLSCREEN)
-    infoObject = pygame.display.Info()
-    screen_width, screen_height = infoObject.current_w, infoObject.current_h
-    resolution = (screen_width, screen_height)
-else:
-    screen_width = 1600
-    screen_height = 900
-    resolution = (screen_width, screen_height)
-    screen = pygame.display.set_mode(resolution)
-
-# Get the Pygame window object
-window = Window.from_display_module()
+presenter = PRESENTERS[presentation_backend]("Drawing Pygame Software", (1600, 900), fullscreen)
+screen = presenter.screen
+screen_width, screen_height = screen.get_size()
+resolution = (screen_width, screen_height)
+startup_timer.mark("display")
+
+# Decode the button images on several threads, and find the fonts from the last run's cache
+image_cache = ImageCache()
+image_cache.preload("assets")
+startup_timer.mark("assets")
+font_cache = FontCache(os.path.join(cache_dir(), "fonts.json"))
+font_cache.get('Arial', 12)
+font_cache.get('Arial', 18, bold=True)
+startup_timer.mark("fonts")
 
 pygame_supported_filetypes = [("TIFF files", "*.tiff"), ("BMP files", "*.bmp"), ("GIF files", "*.gif"), ("JPEG files", "*.jpg"), ("PNG Files", "*.png"), ("All Files", "*.*")]
 
@@ -1076,13 +2148,25 @@ canvas_width = screen_width - x_canvas_border_width*2
 canvas_height = screen_height - y_canvas_border_width
 canvas_rect = pygame.Rect(x_canvas_border_width, 0, canvas_width, canvas_height)
 
+# Out-of-core documents.  When enabled, a document larger than the canvas keeps its layers in memory-mapped files,
+# only the tiles around the view are kept in RAM (up to tile_cache_mb), and the arrow keys scroll the view.
+out_of_core = False
+tile_cache_mb = 256
+document_width = canvas_width   # Set larger than the canvas (e.g. 12000 x 12000) together with out_of_core for print-size work
+document_height = canvas_height
+tile_cache = TileCache(tile_cache_mb * 1024 * 1024)
+view_x = 0  # Top-left corner of the document shown on the canvas
+view_y = 0
+
 # Create 1st drawing layer
 layer0 = Layer(
     x=x_canvas_border_width,
     y=0,
     width=canvas_width,
     height=canvas_height,
-    background_color=TRANSPARENT_BG
+    background_color=TRANSPARENT_BG,
+    document_size=(document_width, document_height) if out_of_core else None,
+    tile_cache=tile_cache
 )
 
 # Create a surface to draw temp shapes
@@ -1094,6 +2178,7 @@ tmp_layer = Layer(
     background_color=TRANSPARENT_BG
 )
 
+layer0.sync_id = 0  # The same on every artist's side when drawing together
 layers_list = [layer0]
 current_layer = layer0
 
@@ -1101,6 +2186,33 @@ layer_buttons_list = []
 layer_func_buttons_list = []
 create_layer_buttons(edge_padding, button_padding, button_w//2*1.3, button_h//2*1.3, screen_width, layers_list)
 
+# The layer thumbnails are shown on the layer buttons, inside a 2 pixel margin
+x, y, w, h = layer_button_start_info
+thumbnail_renderer = ThumbnailRenderer(int(w) - 4, int(h) - 4, CANVAS_BG)
+
+# The eyedropper reads a flattened copy of the visible layers, which is only redone where they changed
+eyedropper = Eyedropper((canvas_width, canvas_height))
+
+# Animation frames.  Each frame has its own layer stack; the globals above always hold the current frame's.
+animation_fps = 12
+timeline = Timeline(Frame(layers_list, layer_buttons_list, current_layer, layer_label_cnt), fps=animation_fps)
+frame_strip_rect = pygame.Rect(x_canvas_border_width + 10, 10, canvas_width - 20, 24)
+
+# The window around the canvas is drawn from a cache, rebuilt only when the buttons are added, removed or moved
+chrome = ChromeCache(SCREEN_BG, canvas_rect, CANVAS_BG)
+frame_damage = FrameDamage()  # The parts of the screen the presenter needs to copy to the window this frame
+canvas_damage_key = None
+font = font_cache.get('Arial', 18, bold=True)
+# Left side
+chrome.add_label(font.render("Tools"  , True, BLACK), (edge_padding, 50-25))
+chrome.add_label(font.render("Shapes" , True, BLACK), (edge_padding, 50-25+(button_h+button_padding)*4))
+chrome.add_label(font.render("Exit" , True, BLACK), (edge_padding, 50-25+(button_h+button_padding)*12.4))
+# Right side
+chrome.add_label(font.render("Layers" , True, BLACK), (screen_width - edge_padding - button_w, 50-25))
+chrome.add_label(font.render("File"   , True, BLACK), (screen_width - edge_padding - button_w, 50-30+(button_h+button_padding)*8))
+
+startup_timer.mark("ui")
+
 active_tool = "None"
 active_color_button = "pen_color"
 running = True
@@ -1110,30 +2222,149 @@ last_pos = None # To store the last mouse position for continuous lines
 clock = pygame.time.Clock() # To control the frame rate
 start_pos = None # Use for square, rect, circle, oval, and triangle
 shape_width = 0  # Set to 0 to have the shape filled. Set to non-zero to specify the line width of the shape edges
-eraser_color = TRANSPARENT_BG
+shape_preview_rect = None  # The part of tmp_layer the shape preview drew last, cleared before drawing the next one
 current_layer_history = []
+selection = Selection(canvas_width, canvas_height)
+file_browser = FileBrowser(canvas_rect.inflate(-80, -80), ThumbnailCache(os.path.join(cache_dir(), "thumbnails")))  # Used for load, save, import and export
+import_dialog = ImportDialog(canvas_rect.center, (canvas_width, canvas_height))  # Asks for fit, fill or crop when an image is loaded or imported
+filter_dialog = FilterDialog((x_canvas_border_width + 10, 44))  # Blur, sharpen, hue/saturation, levels and invert, opened with F7
+layer_exporter = LayerExporter(layer_export_job)  # Writes the layers to image files in the background for "export all"
+timelapse_interval_ms = 500  # Time between the frames of a timelapse recording.  F5 starts and stops recording.
+timelapse_recorder = TimelapseRecorder(timelapse_interval_ms)
+
+# F10 starts and stops profiling the running program.  Each capture is written to profile_dir as profile_<time>.pstats,
+# .collapsed (for flame graphs) and .json (samples per main loop phase, events and time per frame).
+profile_dir = "profiles"
+profiler = SessionProfiler()
+
+# Version history.  Set version_history_path to a database file (e.g. "drawing_history.sqlite") to keep every version of
+# the drawing in it, also after quitting.  F9 opens the list of versions to go back to one.  Not for out-of-core documents.
+version_history_path = None
+version_store = None
+if version_history_path is not None and not out_of_core:
+    version_store = VersionStore(version_history_path)
+version_browser = VersionBrowser(canvas_rect.inflate(-160, -200), CANVAS_BG)
+
+# Drawing together.  Set collab_relay to the "host:port" of a relay (started with "python collab.py relay") to share strokes,
+# shapes, clears and layer operations with the other artists connected to it.  Everyone should start from a blank document.
+collab_relay = None
+collab = None
+applying_remote = False  # True while a shared edit from the relay is applied, so it isn't sent again
+collab_pending = []   # The (op, args, undo entry of its preview or None) of the edits sent but not back from the relay yet
+collab_incoming = []  # Edits from the relay that wait for the stroke being drawn to be finished
+collab_undo = {}      # Client id -> the undo entries of that artist's shared edits, in relay order
+collab_redo = {}
+shared_vector_layers = set()  # The sync ids of the vector layers added here that the relay hasn't sent back yet
+sync_id_counter = 0
+stroke_points = []  # The document positions of the pen or eraser stroke being drawn
+if collab_relay is not None:
+    collab_host, collab_port = collab_relay.rsplit(":", 1)
+    collab = CollabSession(collab_host, int(collab_port))
+    collab.start()
+    collab.wait_connected()  # New layers are named after the client id the relay gives out
+wand_tolerance = 32  # How far (per channel) a color may be from the clicked color to be picked up by the magic wand
+gradient_mode = "linear"  # One of GRADIENT_MODES, cycled with g
+gradient_dither = False   # Toggled with Shift+g
+selected_shape = None  # The shape of a vector layer picked with the object tool
 undo_history = []
 redo_history = []
 max_undo_number = 50  # Maximum number of undo/redo allowed
 
+# Scratch surfaces for drawing are taken from a pool instead of being allocated for every mouse event.  Up to
+# surface_pool_mb of them are kept while idle, for at most half a minute.
+surface_pool_mb = 64
+surface_pool = SurfacePool(surface_pool_mb * 1024 * 1024)
+stroke_backup = None  # A copy of the layer from before the pen or eraser stroke being drawn, for its undo entry
+stroke_layer = None   # The layer the stroke is drawn on
+stroke_rect = None    # The area the stroke covers so far
+stroke_shapes = None  # The shapes of the vector layer from before the pen stroke being drawn on it, for its undo entry
+
+# The transform tool shows a low-resolution preview while dragging, and resamples the full-size pixels on a worker thread
+transform_tool = TransformTool(surface_pool)
+
+# Memory accounting.  Past memory_budget_mb, memory is given back in this order: idle pooled surfaces, the eyedropper's
+# composite, tile cache, vector shape sprites, redo history, then the oldest undo.
+memory_budget_mb = 1024
+show_memory_panel = False  # Toggled with F3.  F4 writes memory_report.json.
+memory_accountant = MemoryAccountant(memory_budget_mb * 1024 * 1024)
+memory_accountant.add_source("Layers", lambda: {f"layer {layer.layer_button.text}": layer.nbytes() for layer in layers_list})
+memory_accountant.add_source("History", lambda: {
+    "undo": sum(entry.nbytes() for entry in undo_history),
+    "redo": sum(entry.nbytes() for entry in redo_history),
+    "other frames": sum(entry.nbytes() for frame in timeline.frames if frame is not timeline.current_frame() for entry in frame.undo_history + frame.redo_history),
+})
+memory_accountant.add_source("Animation", lambda: {
+    "other frames' layers": sum(layer.nbytes() for frame in timeline.frames if frame is not timeline.current_frame() for layer in frame.layers),
+    "flattened frames and onion skins": timeline.nbytes(),
+})
+memory_accountant.add_source("Scratch", lambda: {
+    "tmp_layer": tmp_layer.nbytes(),
+    "surface pool (idle)": surface_pool.nbytes(),
+    "stroke undo copy": surface_bytes(stroke_backup) if stroke_backup is not None else 0,
+    "per-event surfaces (peak)": memory_accountant.scratch_peak,
+})
+memory_accountant.add_source("Caches", lambda: {
+    "tile cache": tile_cache.used_bytes,
+    "thumbnails": sum(surface_bytes(layer.thumbnail) + surface_bytes(layer.layer_button.inactive_image) + surface_bytes(layer.layer_button.active_image) for layer in layers_list),
+    "file browser previews": file_browser.thumbnails.nbytes(),
+    "window chrome": chrome.nbytes(),
+    "eyedropper composite": eyedropper.nbytes(),
+    "presentation": presenter.nbytes(),
+    "vector shapes": sum(layer.vector.nbytes() for layer in layers_list if layer.vector is not None),
+    "timelapse frames": timelapse_recorder.nbytes(),
+    "version history (waiting to be written)": version_store.nbytes() if version_store is not None else 0,
+    "selection": (canvas_width * canvas_height // 8 if selection.is_active() else 0) + surface_bytes(selection.outline),
+})
+memory_accountant.add_counters("Surface pool", surface_pool.stats)
+memory_accountant.add_evictor("surface pool", surface_pool.clear)
+memory_accountant.add_evictor("eyedropper composite", eyedropper.release)
+memory_accountant.add_evictor("tile cache", evict_tile_cache)
+memory_accountant.add_evictor("vector shapes", evict_vector_sprites)
+memory_accountant.add_evictor("redo history", evict_redo)
+memory_accountant.add_evictor("undo history", evict_undo)
+
 while running:
-    screen.fill(SCREEN_BG)                            # Fill the entire screen with SCREEN_BG color (e.g. gray)
-    pygame.draw.rect(screen, CANVAS_BG, canvas_rect)  # Fill just the canvas area with CANVAS_BG color (e.g. white)
-    if active_tool == "eraser":
-        fill_color = eraser_color
-        pen_color = eraser_color
-    else:
-        fill_color = current_fill_color
-        pen_color = current_pen_color
+    fill_color = current_fill_color
+    pen_color = current_pen_color
 
     if active_color_button not in ["pen_color", "fill_color"]:
         active_color_button = "pen_color"
 
     # Event Loop
-    for event in pygame.event.get():
+    profiler.phase = "events"
+    profiler.layer_count = len(layers_list)
+    frame_events = pygame.event.get()
+    for event in frame_events:
         if event.type == pygame.QUIT:
             running = False
 
+        # While the file browser or a dialog is open, it gets all the input
+        if file_browser.is_open:
+            file_browser.handle_event(event)
+            continue
+        if import_dialog.is_open:
+            import_dialog.handle_event(event)
+            continue
+        if filter_dialog.is_open:
+            filter_dialog.handle_event(event)
+            continue
+        if version_browser.is_open:
+            version_browser.handle_event(event)
+            continue
+        if transform_tool.is_busy():
+            transform_tool.handle_event(event)  # Esc cancels, anything else waits until the result is in the layer
+            continue
+
+        # Clicking a cell of the frame strip shows that frame.  Clicking the canvas stops playback.
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            if len(timeline.frames) > 1 and timeline.frame_at(frame_strip_rect, event.pos) is not None:
+                timeline.stop()
+                set_frame(timeline.frame_at(frame_strip_rect, event.pos))
+                continue
+            if timeline.playing and is_pos_in_canvas(event.pos, canvas_rect):
+                timeline.stop()
+                continue
+
         # Mouse Button Down Event
         if event.type == pygame.MOUSEBUTTONDOWN:
             if event.button == 1:  # Left mouse button
@@ -1147,33 +2378,50 @@ while running:
                             start_pos = (event.pos[0] - x_canvas_border_width, event.pos[1])
                         else:
                             tmp_layer.clear()
+                            shape_preview_rect = None
                             current_pos = (event.pos[0] - x_canvas_border_width, event.pos[1])
-                            undo_surface = pygame.Surface.copy(current_layer.surface)   # Create a copy of the current surface and put it into the undo history
-                            undo_history.append([current_layer, undo_surface])
-                            if len(undo_history) > max_undo_number:
-                                undo_history = undo_history[-max_undo_number:]
-                            draw_shape(active_tool, current_layer.surface, pen_color+(alpha,), fill_color+(alpha,), start_pos, current_pos, shape_width)
-                            redo_history = []
+                            add_shape(active_tool, start_pos, current_pos)
                             start_pos = None
                     elif active_tool == "eyedropper":
                         current_pos = (event.pos[0] - x_canvas_border_width, event.pos[1])
-                        for layer in reversed(layers_list):
-                            if layer.is_visible:
-                                color = layer.surface.get_at(current_pos)
-                                if color != (0,0,0,0):
-                                    break
-                        if color != (0,0,0,0):
+                        color = pick_color(current_pos)
+                        if color is not None and color[3] > 0:
+                            r, g, b, a = color
                             if active_color_button == "pen_color":
-                                current_pen_color = (color.r, color.g, color.b)
+                                current_pen_color = (r, g, b)
                             else:
-                                current_fill_color = (color.r, color.g, color.b)
-                            alpha = color.a
-                    elif active_tool in ["pen", "eraser"]:
-                        undo_surface = pygame.Surface.copy(current_layer.surface)   # Create a copy of the current surface and put it into the undo history
-                        undo_history.append([current_layer, undo_surface])
-                        if len(undo_history) > max_undo_number:
-                            undo_history = undo_history[-max_undo_number:]
-                        redo_history = []
+                                current_fill_color = (r, g, b)
+                            alpha = a
+                    elif active_tool == "pen" and current_layer.vector is not None:
+                        # The stroke is drawn as usual while it is made, and becomes a polyline when the mouse is released
+                        stroke_shapes = VectorSnapshot(current_layer)
+                        stroke_points = [to_document(last_pos)]
+                    elif active_tool in ["pen", "eraser"] and current_layer.vector is None:
+                        # The stroke's area is only known once it is done, so its undo entry is cut from this copy then
+                        stroke_backup = surface_pool.acquire(current_layer.surface.get_size())
+                        stroke_backup.blit(current_layer.surface, (0, 0))  # A plain blit onto transparent pixels copies them as they are
+                        stroke_layer = current_layer
+                        stroke_rect = None
+                        stroke_points = [to_document(last_pos)]
+                    elif active_tool in ["select_rect", "select_oval"] or (active_tool == "gradient" and current_layer.vector is None):
+                        start_pos = (event.pos[0] - x_canvas_border_width, event.pos[1])
+                    elif active_tool == "object" and current_layer.vector is not None:
+                        # Pick the topmost shape under the mouse.  Dragging moves it.
+                        start_pos = (event.pos[0] - x_canvas_border_width, event.pos[1])
+                        selected_shape = current_layer.vector.shape_at(start_pos)
+                    elif active_tool == "transform" and current_layer.vector is None:
+                        # Shift scales and Ctrl rotates around the center of the pixels, otherwise they are moved
+                        if pygame.key.get_mods() & pygame.KMOD_SHIFT:
+                            transform_mode = "scale"
+                        elif pygame.key.get_mods() & pygame.KMOD_CTRL:
+                            transform_mode = "rotate"
+                        else:
+                            transform_mode = "move"
+                        transform_rect = selection.bounding_rect() if selection.is_active() else current_layer.content_rect()
+                        transform_tool.begin(current_layer, tmp_layer, transform_rect, selection.mask, transform_mode, (event.pos[0] - x_canvas_border_width, event.pos[1]))
+                    elif active_tool == "wand":
+                        current_pos = (event.pos[0] - x_canvas_border_width, event.pos[1])
+                        selection.magic_wand(current_layer.surface, current_pos, wand_tolerance, get_selection_mode())
 
         # Mouse Button Up Event
         if event.type == pygame.MOUSEBUTTONUP:
@@ -1181,59 +2429,244 @@ while running:
                 mouse_button_down = False
                 last_pos = None # Reset last_pos when button is released
 
+                # The finished pen or eraser stroke goes to the other artists as a whole
+                stroke_op = ERASE if active_tool == "eraser" else STROKE
+                if stroke_shapes is not None:
+                    if len(stroke_points) > 1:
+                        stroke_shapes.layer.vector.add(VectorShape("polyline", tuple(stroke_points), pen_color+(alpha,), pen_color+(alpha,), line_thickness, 0))
+                        stroke_shapes.layer.render_vector()
+                        share_edit(stroke_shapes, stroke_op, encode_stroke, stroke_shapes.layer.sync_id, pen_color+(alpha,), line_thickness, stroke_points)
+                    stroke_shapes = None
+                if stroke_backup is not None:
+                    if stroke_rect is not None:
+                        if active_tool == "eraser":
+                            stroke_layer.content_may_shrink()
+                        share_edit(RegionSnapshot(stroke_layer, stroke_rect, stroke_backup), stroke_op, encode_stroke, stroke_layer.sync_id, pen_color+(alpha,), line_thickness, stroke_points)
+                    surface_pool.release(stroke_backup)
+                    stroke_backup = None
+                    stroke_layer = None
+                stroke_points = []
+
+                # The full-size pixels are resampled on a worker thread, and go into the layer when they are ready
+                if transform_tool.is_dragging():
+                    transform_tool.release(finish_transform)
+
                 # This section of code draws the shape for the click, drag, release operation
                 current_pos = (event.pos[0] - x_canvas_border_width, event.pos[1])
                 if active_tool in ["square", "rect", "circle", "oval", "triangle"] and start_pos is not None and current_pos != start_pos:
                     tmp_layer.clear()
-                    undo_surface = pygame.Surface.copy(current_layer.surface)   # Create a copy of the current surface and put it into the undo history
-                    undo_history.append([current_layer, undo_surface])
-                    if len(undo_history) > max_undo_number:
-                        undo_history = undo_history[-max_undo_number:]
-                    draw_shape(active_tool, current_layer.surface, pen_color+(alpha,), fill_color+(alpha,), start_pos, current_pos, shape_width)
-                    redo_history = []
+                    shape_preview_rect = None
+                    add_shape(active_tool, start_pos, current_pos)
+                    start_pos = None
+
+                # Dragging a shape with the object tool moves it
+                elif active_tool == "object" and start_pos is not None:
+                    if selected_shape is not None and current_pos != start_pos and selected_shape in current_layer.vector:
+                        push_undo(VectorSnapshot(current_layer))
+                        moved_shape = selected_shape.moved(current_pos[0] - start_pos[0], current_pos[1] - start_pos[1])
+                        current_layer.vector.replace(selected_shape, moved_shape)
+                        current_layer.render_vector()
+                        selected_shape = moved_shape
+                    start_pos = None
+
+                # Selections are made with click, drag, release.  A click without dragging drops the selection.
+                elif active_tool in ["select_rect", "select_oval"] and start_pos is not None:
+                    selection_mode = get_selection_mode()
+                    if current_pos != start_pos:
+                        if active_tool == "select_rect":
+                            selection.select_rect(get_rect(start_pos, current_pos), selection_mode)
+                        else:
+                            selection.select_ellipse(get_rect(start_pos, current_pos), selection_mode)
+                    elif selection_mode == "replace":
+                        selection.deselect()
+                    start_pos = None
+
+                # The gradient fills the selection (or the whole layer), going from the pen color where the drag
+                # started to the fill color where it ended
+                elif active_tool == "gradient" and start_pos is not None:
+                    tmp_layer.clear()
+                    if current_pos != start_pos:
+                        fill_rect = selection.bounding_rect()
+                        push_undo(RegionSnapshot(current_layer, fill_rect))
+                        tmp_surface = surface_pool.acquire(current_layer.surface.get_size())
+                        draw_gradient(tmp_surface, fill_rect, start_pos, current_pos, current_pen_color+(alpha,), current_fill_color+(alpha,), gradient_mode, gradient_dither)
+                        selection.clip(tmp_surface, fill_rect)
+                        current_layer.surface.blit(tmp_surface, fill_rect, fill_rect, special_flags=pygame.BLEND_PREMULTIPLIED)
+                        surface_pool.release(tmp_surface, fill_rect)
+                        current_layer.mark_dirty(fill_rect)
                     start_pos = None
 
         # Mouse Motion Event
         if event.type == pygame.MOUSEMOTION:
-            if active_tool in ["pen", "eraser"]:
+            if active_tool == "pen" or (active_tool == "eraser" and current_layer.vector is None):
                 if mouse_button_down:
                     if is_pos_in_canvas(event.pos, canvas_rect):
                         current_pos = (event.pos[0] - x_canvas_border_width, event.pos[1])
                         if last_pos:
                             # Draw a line from the last position to the current position
                             # This makes the drawing smooth rather than just dots
-                            tmp_surface = pygame.Surface((current_layer.surface.get_width(), current_layer.surface.get_height()), pygame.SRCALPHA)
-                            pygame.draw.line(tmp_surface, pen_color+(alpha,), last_pos, current_pos, line_thickness)
-                            current_layer.surface.blit(tmp_surface, (0, 0))
+                            tmp_surface = surface_pool.acquire(current_layer.surface.get_size())
+                            if active_tool == "eraser":
+                                # The eraser takes away alpha in proportion to the alpha setting, rather than painting
+                                line_rect = pygame.draw.line(tmp_surface, (alpha, alpha, alpha, alpha), last_pos, current_pos, line_thickness)
+                                selection.clip(tmp_surface, line_rect)
+                                erase(current_layer.surface, tmp_surface.subsurface(line_rect), line_rect.topleft)
+                            else:
+                                line_rect = pygame.draw.line(tmp_surface, premultiply_color(pen_color+(alpha,)), last_pos, current_pos, line_thickness)
+                                selection.clip(tmp_surface, line_rect)
+                                current_layer.surface.blit(tmp_surface, line_rect, line_rect, special_flags=pygame.BLEND_PREMULTIPLIED)
+                            surface_pool.release(tmp_surface, line_rect)
+                            current_layer.mark_dirty(line_rect)
+                            if stroke_backup is not None:
+                                stroke_rect = line_rect if stroke_rect is None else stroke_rect.union(line_rect)
+                            stroke_points.append(to_document(current_pos))
                         last_pos = current_pos # Update last_pos for the next segment
             
             # Follow the mouse movement and draw the shape and tmp_layer
             elif active_tool in ["square", "rect", "circle", "oval", "triangle"] and start_pos is not None:
+                # Only the last preview and the layer's content are cleared and redrawn, not the whole canvas
+                content_rect = current_layer.content_rect()
+                tmp_layer.clear(content_rect)
+                if shape_preview_rect is not None:
+                    tmp_layer.clear(shape_preview_rect)
+                tmp_layer.surface.blit(current_layer.surface, content_rect, content_rect)
+                current_pos = (event.pos[0] - x_canvas_border_width, event.pos[1])
+                shape_rect = draw_shape(active_tool, tmp_layer.surface, pen_color+(alpha,), fill_color+(alpha,), start_pos, current_pos, shape_width)
+                tmp_layer.mark_dirty(shape_rect)
+                shape_preview_rect = shape_rect
+
+            # Preview the gradient while dragging.  It is computed at a lower resolution, so it keeps up with the mouse.
+            elif active_tool == "gradient" and start_pos is not None and mouse_button_down:
                 tmp_layer.clear()
-                tmp_layer.surface.blit(current_layer.surface, (0,0))
+                fill_rect = selection.bounding_rect()
                 current_pos = (event.pos[0] - x_canvas_border_width, event.pos[1])
-                if fill_color != eraser_color:
-                    tmp_fill_color = fill_color
-                    tmp_shape_width = shape_width
-                else:
-                    tmp_fill_color = BLACK
-                    tmp_shape_width = 1
-                if pen_color != eraser_color:
-                    tmp_pen_color = pen_color
-                else:
-                    tmp_pen_color = BLACK
-                draw_shape(active_tool, tmp_layer.surface, tmp_pen_color+(alpha,), tmp_fill_color+(alpha,), start_pos, current_pos, tmp_shape_width)
+                tmp_layer.surface.blit(preview_gradient(fill_rect, start_pos, current_pos, current_pen_color+(alpha,), current_fill_color+(alpha,), gradient_mode, gradient_dither), fill_rect)
+                selection.clip(tmp_layer.surface, fill_rect)
+                tmp_layer.mark_dirty(fill_rect)
+
+            # Follow the mouse with the transform preview
+            elif transform_tool.is_dragging():
+                transform_tool.drag((event.pos[0] - x_canvas_border_width, event.pos[1]))
 
         # Keyboard Events
         if event.type == pygame.KEYDOWN:
             # Clear Screen
             if event.key == pygame.K_c:
-                undo_surface = pygame.Surface.copy(current_layer.surface)   # Create a copy of the current surface and put it into the undo history
-                undo_history.append([current_layer, undo_surface])
-                if len(undo_history) > max_undo_number:
-                    undo_history = undo_history[-max_undo_number:]
-                current_layer.clear()
-                redo_history = []
+                if current_layer.vector is not None:
+                    entry = VectorSnapshot(current_layer)
+                    current_layer.vector.set_shapes([])
+                    current_layer.render_vector()
+                    share_edit(entry, CLEAR, LAYER_BODY.pack, current_layer.sync_id)
+                elif selection.is_active():
+                    # Only the selected pixels are cleared, so only their bounding rect is saved for undo
+                    clear_rect = selection.bounding_rect()
+                    push_undo(RegionSnapshot(current_layer, clear_rect))
+                    selection.fill(current_layer.surface, current_layer.bg_color)
+                    current_layer.mark_dirty(clear_rect)
+                    current_layer.content_may_shrink()
+                else:
+                    entry = SurfaceSnapshot(current_layer, pygame.Surface.copy(current_layer.surface))   # Create a copy of the current surface for the undo history
+                    current_layer.clear()
+                    share_edit(entry, CLEAR, LAYER_BODY.pack, current_layer.sync_id)
+
+            # Fill the selection with the fill color.  Without a selection Backspace does nothing (Ctrl+a selects everything).
+            elif event.key == pygame.K_BACKSPACE and current_layer.vector is None and selection.is_active():
+                fill_rect = selection.bounding_rect()
+                push_undo(RegionSnapshot(current_layer, fill_rect))
+                tmp_surface = surface_pool.acquire(current_layer.surface.get_size())
+                tmp_surface.fill(premultiply_color(current_fill_color+(alpha,)), fill_rect)
+                selection.clip(tmp_surface, fill_rect)
+                current_layer.surface.blit(tmp_surface, fill_rect, fill_rect, special_flags=pygame.BLEND_PREMULTIPLIED)
+                surface_pool.release(tmp_surface, fill_rect)
+                current_layer.mark_dirty(fill_rect)
+
+            # Select all using Ctrl+a, deselect using Ctrl+d, and invert the selection using Ctrl+Shift+i
+            elif event.key == pygame.K_a and (event.mod & pygame.KMOD_CTRL):
+                selection.select_all()
+            elif event.key == pygame.K_d and (event.mod & pygame.KMOD_CTRL):
+                selection.deselect()
+            elif event.key == pygame.K_i and (event.mod & pygame.KMOD_CTRL) and (event.mod & pygame.KMOD_SHIFT):
+                selection.invert()
+
+            # Merge the current layer down using Ctrl+e, or flatten the visible layers using Ctrl+Shift+e
+            elif event.key == pygame.K_e and (event.mod & pygame.KMOD_CTRL):
+                if event.mod & pygame.KMOD_SHIFT:
+                    flatten_visible(None)
+                else:
+                    merge_down(None)
+
+            # Show the memory debug panel using F3, or write the memory report using F4
+            elif event.key == pygame.K_F3:
+                show_memory_panel = not show_memory_panel
+            elif event.key == pygame.K_F4:
+                memory_accountant.dump("memory_report.json")
+
+            # Animation frames: n adds an empty frame after the current one, Shift+n a copy of it, Ctrl+Delete removes it (undoable),
+            # "," and "." go to the previous and next frame, o toggles the onion skins, Space plays, and F6 exports the frames
+            elif event.key == pygame.K_n and not (event.mod & pygame.KMOD_CTRL):
+                add_frame(duplicate=bool(event.mod & pygame.KMOD_SHIFT))
+            elif event.key == pygame.K_DELETE and (event.mod & pygame.KMOD_CTRL):
+                delete_frame()
+            elif event.key == pygame.K_DELETE and active_tool == "object":
+                # With the object tool, Delete removes the picked shape
+                if selected_shape is not None and current_layer.vector is not None and selected_shape in current_layer.vector:
+                    push_undo(VectorSnapshot(current_layer))
+                    current_layer.vector.remove(selected_shape)
+                    current_layer.render_vector()
+                selected_shape = None
+            elif event.key == pygame.K_COMMA:
+                timeline.stop()
+                set_frame(max(0, timeline.current - 1))
+            elif event.key == pygame.K_PERIOD:
+                timeline.stop()
+                set_frame(min(len(timeline.frames) - 1, timeline.current + 1))
+            elif event.key == pygame.K_o:
+                timeline.onion_enabled = not timeline.onion_enabled
+            elif event.key == pygame.K_SPACE:
+                toggle_playback()
+            elif event.key == pygame.K_F6:
+                export_frames(None)
+
+            # Filter the selection (or the whole layer) using F7
+            elif event.key == pygame.K_F7 and current_layer.vector is None:
+                filter_rect = selection.bounding_rect()
+                filter_dialog.open(current_layer, tmp_layer, filter_rect, selection.mask_array(filter_rect), push_undo)
+
+            # Add a vector layer using F8
+            elif event.key == pygame.K_F8:
+                add_vector_layer(None)
+
+            # Open the version history using F9
+            elif event.key == pygame.K_F9:
+                if version_store is not None:
+                    version_browser.open(version_store, restore_version)
+
+            # Start or stop recording a timelapse using F5
+            elif event.key == pygame.K_F5:
+                if timelapse_recorder.is_recording:
+                    timelapse_recorder.stop()
+                elif not timelapse_recorder.is_busy():
+                    file_browser.open("Record timelapse to (.gif or .webp for an animation, .png for numbered frames)",
+                                      [("GIF files", "*.gif"), ("WebP files", "*.webp"), ("PNG Files", "*.png")], timelapse_recorder.start,
+                                      save_mode=True, default_extension=".gif", file_name="timelapse.gif")
+
+            # Start or stop profiling using F10
+            elif event.key == pygame.K_F10:
+                if profiler.is_capturing:
+                    profiler.stop()
+                elif not profiler.is_busy():
+                    profiler.start(os.path.join(profile_dir, time.strftime("profile_%Y%m%d_%H%M%S")))
+
+            # Cycle the eyedropper's sample size (1x1, 3x3, 5x5, 11x11) using S, and switch between sampling all
+            # layers and the current layer using L
+            elif event.key == pygame.K_s:
+                eyedropper.next_sample_size()
+            elif event.key == pygame.K_l:
+                eyedropper.next_mode()
+
+            # Switch the transform tool between smooth and nearest-pixel resampling using t
+            elif event.key == pygame.K_t:
+                transform_tool.smooth = not transform_tool.smooth
 
             # Toggle shape fill
             elif event.key == pygame.K_f:
@@ -1242,57 +2675,70 @@ while running:
                 else:
                     shape_width = 0
 
+            # Cycle the gradient mode using g, or toggle dithering the gradient using Shift+g
+            elif event.key == pygame.K_g:
+                if event.mod & pygame.KMOD_SHIFT:
+                    gradient_dither = not gradient_dither
+                else:
+                    gradient_mode = GRADIENT_MODES[(GRADIENT_MODES.index(gradient_mode) + 1) % len(GRADIENT_MODES)]
+
+            # Scroll a document that is larger than the canvas
+            elif event.key == pygame.K_LEFT:
+                pan_view(-canvas_width//4, 0)
+            elif event.key == pygame.K_RIGHT:
+                pan_view(canvas_width//4, 0)
+            elif event.key == pygame.K_UP:
+                pan_view(0, -canvas_height//4)
+            elif event.key == pygame.K_DOWN:
+                pan_view(0, canvas_height//4)
+
             # Cancel drawing operation
             elif event.key == pygame.K_ESCAPE:
                 start_pos = None
+                selected_shape = None
+                transform_tool.cancel()
                 tmp_layer.clear()
 
             # Undo an edit using Ctrl+z
             elif event.key == pygame.K_z and (event.mod & pygame.KMOD_CTRL):
-                if len(undo_history) > 0:
-                    undo_layer, undo_surface = undo_history.pop()
-
-                    # Before doing the undo, we need to populate the redo history by creating a copy of the surface that will be undone and put it into the redo history
-                    redo_surface = pygame.Surface.copy(undo_layer.surface)
-                    redo_history.append([undo_layer, redo_surface])
-
-                    undo_layer.surface = undo_surface # Do the undo function
+                if len(undo_history) > 0 and is_sharing() and undo_history[-1] in collab_undo.get(collab.client_id, []):
+                    # A shared edit is undone by everyone, once the relay sends the undo back
+                    share_later(UNDO, bytes)
+                elif len(undo_history) > 0:
+                    # Doing the undo returns the entry that reverses it, which goes into the redo history
+                    redo_history.append(undo_history.pop().apply())
 
             # Redo an edit using Ctrl+y
             elif event.key == pygame.K_y and (event.mod & pygame.KMOD_CTRL):
-                if len(redo_history) > 0:
-                    redo_layer, redo_surface = redo_history.pop()
-
-                    # Before doing the redo, we need to populate the undo history by creating a copy of the surface that will be redone and put it into the undo history
-                    undo_surface = pygame.Surface.copy(redo_layer.surface)
-                    undo_history.append([redo_layer, undo_surface])
-
-                    redo_layer.surface = redo_surface # Do the redo function
+                if len(redo_history) > 0 and is_sharing() and redo_history[-1] in collab_redo.get(collab.client_id, []):
+                    share_later(REDO, bytes)
+                elif len(redo_history) > 0:
+                    # Doing the redo returns the entry that reverses it, which goes back into the undo history
+                    undo_history.append(redo_history.pop().apply())
 
         # Handling event for the buttons
         for button in tool_buttons_list + misc_buttons_list + layer_buttons_list + layer_func_buttons_list + color_buttons_list + lw_a_buttons_list + current_color_buttons_list:
             button.handle_event(event)
 
-    # Draw layers
-    for layer in layers_list:
-        # keep layer.is_current and layer.layer_button.is_active in sync with current_layer
-        if layer == current_layer:
-            layer.is_current = True
-            layer.layer_button.is_active = True
-            layer.layer_button.text_color = RED
-        else:
-            layer.is_current = False
-            layer.layer_button.is_active = False
-            layer.layer_button.text_color = BLACK
-
-        # keep layer.is_visible in sync with layer.eye_button.is_active, just in case the button status was changed by the event loop 
-        if layer.eye_button.is_active:
-            layer.is_visible = True
-            layer.draw(screen)
-        else:
-            layer.is_visible = False
-
-    tmp_layer.draw(screen)
+    # Pick up the folder listings, previews and imported images finished on worker threads
+    if file_browser.is_open:
+        file_browser.update()
+    if import_dialog.is_open:
+        import_dialog.update()
+    if filter_dialog.is_open:
+        filter_dialog.update()
+    if version_browser.is_open:
+        version_browser.update()
+    transform_tool.update()
+    layer_exporter.update()
+
+    # Apply the shared edits in the order the relay numbered them.  They wait while a stroke, a transform or a filter is
+    # being made on the layer's pixels, which would otherwise be drawn over.
+    if collab is not None:
+        collab_incoming.extend(collab.poll())
+        if collab_incoming and not stroke_points and not transform_tool.is_previewing() and not filter_dialog.is_open:
+            apply_shared(collab_incoming)
+            collab_incoming = []
 
     x, y, w, h = layer_button_start_info
     for layer in reversed(layers_list):
@@ -1305,66 +2751,175 @@ while running:
         layer.layer_button.rect = pygame.Rect(x+w, y, w, h)
         y = y + h
 
-    # Draw the buttons onto the on screen
+    # Bring the buttons up to date
     for button in tool_buttons_list:
         # keep tool button.is_active in sync with active_tool
         if button.tool != active_tool:
             button.is_active = False
-        button.draw(screen)  
-
-    for button in misc_buttons_list + layer_buttons_list + color_buttons_list:
-        button.draw(screen)
-
-    lw_value_button.text=f"{line_thickness}"
     for button in lw_a_buttons_list + layer_func_buttons_list:
         button.is_active = False
-        button.draw(screen)
-
+    lw_value_button.text=f"{line_thickness}"
     alpha_percent = int(round(alpha * 100 / 255))
     alpha_value_button.text=f"{alpha_percent}%"
-    for button in lw_a_buttons_list:
-        button.is_active = False
-        button.draw(screen)
-
-    # Draw the current color
+    gradient_button.text = gradient_mode.title() + ("*" if gradient_dither else "")
     current_pen_color_button.active_color = current_pen_color_button.inactive_color = current_pen_color
-    current_pen_color_button.draw(screen)
-    current_pen_color_button.is_active = False
-
     current_fill_color_button.active_color = current_fill_color_button.inactive_color = current_fill_color
-    current_fill_color_button.draw(screen)
+
+    # Draw the background, the canvas and the buttons from the cached chrome.  Only the buttons that look different from
+    # the last frame are redrawn into it.
+    for rect in chrome.draw(screen, tool_buttons_list + misc_buttons_list + layer_buttons_list + color_buttons_list + lw_a_buttons_list + layer_func_buttons_list + current_color_buttons_list):
+        frame_damage.add(rect)
+    current_pen_color_button.is_active = False
     current_fill_color_button.is_active = False
 
+    # Draw the current color
+    profiler.phase = "draw"
     if active_color_button == "pen_color":
-        pygame.draw.rect(screen, ORANGE, current_pen_color_button.rect.inflate(5,5), 2)
+        frame_damage.add_overlay(pygame.draw.rect(screen, ORANGE, current_pen_color_button.rect.inflate(5,5), 2))
     else:
-        pygame.draw.rect(screen, ORANGE, current_fill_color_button.rect.inflate(5,5), 2)
-
-    # Draw the button section texts on the screen
-    font = pygame.font.SysFont('Arial', 18, bold=True)
-    # Left side
-    screen.blit(font.render("Tools"  , True, BLACK), (edge_padding, 50-25))
-    screen.blit(font.render("Shapes" , True, BLACK), (edge_padding, 50-25+(button_h+button_padding)*4))
-    screen.blit(font.render("Exit" , True, BLACK), (edge_padding, 50-25+(button_h+button_padding)*11.9))
-    # Right side
-    screen.blit(font.render("Layers" , True, BLACK), (screen_width - edge_padding - button_w, 50-25))
-    screen.blit(font.render("File"   , True, BLACK), (screen_width - edge_padding - button_w, 50-30+(button_h+button_padding)*8))
+        frame_damage.add_overlay(pygame.draw.rect(screen, ORANGE, current_fill_color_button.rect.inflate(5,5), 2))
+
+    # While playing, the cached flattened frames are shown instead of the layers.  Otherwise the onion skins of the
+    # neighbouring frames go under the current frame.
+    if timeline.playing:
+        store_frame()
+        screen.blit(timeline.frames[timeline.playback_index()].composite((canvas_width, canvas_height)), (x_canvas_border_width, 0), special_flags=pygame.BLEND_PREMULTIPLIED)
+    else:
+        for onion_skin in timeline.onion_skins((canvas_width, canvas_height)):
+            screen.blit(onion_skin, (x_canvas_border_width, 0), special_flags=pygame.BLEND_PREMULTIPLIED)
+
+    # Draw layers
+    for layer in layers_list:
+        # keep layer.is_current and layer.layer_button.is_active in sync with current_layer
+        if layer == current_layer:
+            layer.is_current = True
+            layer.layer_button.is_active = True
+            layer.layer_button.text_color = RED
+        else:
+            layer.is_current = False
+            layer.layer_button.is_active = False
+            layer.layer_button.text_color = BLACK
+        layer.layer_button.tooltip = "Set as current layer (vector)" if layer.vector is not None else "Set as current layer"
+
+        # keep layer.is_visible in sync with layer.eye_button.is_active, just in case the button status was changed by the event loop 
+        if layer.eye_button.is_active:
+            layer.is_visible = True
+            if not timeline.playing:
+                if (filter_dialog.is_open or transform_tool.is_previewing()) and layer == current_layer:
+                    tmp_layer.draw(screen)  # The filter or transform preview is shown in place of the layer
+                else:
+                    layer.draw(screen)
+        else:
+            layer.is_visible = False
+
+    if not timeline.playing and not filter_dialog.is_open and not transform_tool.is_previewing():
+        tmp_layer.draw(screen)
+    frame_damage.add(canvas_damage())
+
+    # Record a timelapse frame if the visible layers changed.  Only the copy is made here, the encoding is done on another thread.
+    timelapse_recorder.capture(screen.subsurface(canvas_rect), (view_x, view_y) + tuple((id(layer), layer.version) for layer in layers_list if layer.is_visible))
+
+    # Draw the selection edge, and the selection being dragged
+    frame_damage.add_overlay(selection.draw(screen, (x_canvas_border_width, 0), BLACK))
+    if active_tool in ["select_rect", "select_oval"] and start_pos is not None:
+        mouse_pos = pygame.mouse.get_pos()
+        drag_rect = get_rect(start_pos, (mouse_pos[0] - x_canvas_border_width, mouse_pos[1])).move(x_canvas_border_width, 0)
+        screen.set_clip(canvas_rect)  # The buttons are already drawn, so keep the drag outline off them
+        if active_tool == "select_rect":
+            pygame.draw.rect(screen, BLACK, drag_rect, 1)
+        else:
+            pygame.draw.ellipse(screen, BLACK, drag_rect, 1)
+        screen.set_clip(None)
+        frame_damage.add_overlay(drag_rect.inflate(2, 2))
+
+    # Outline the shape picked with the object tool, where it would go while it is dragged
+    if active_tool == "object" and selected_shape is not None and current_layer.vector is not None and selected_shape in current_layer.vector:
+        outline_rect = selected_shape.rect.move(x_canvas_border_width, 0)
+        if start_pos is not None and mouse_button_down:
+            mouse_pos = pygame.mouse.get_pos()
+            outline_rect.move_ip(mouse_pos[0] - x_canvas_border_width - start_pos[0], mouse_pos[1] - start_pos[1])
+        screen.set_clip(canvas_rect)
+        pygame.draw.rect(screen, ORANGE, outline_rect, 2)
+        screen.set_clip(None)
+        frame_damage.add_overlay(outline_rect.clip(canvas_rect))
 
     # Display mouse coordinate at the bottom left of the screen
     mouse_pos = pygame.mouse.get_pos()
-    mouse_coordinate_text = f"{mouse_pos[0]- x_canvas_border_width} , {mouse_pos[1]}"
-    font = pygame.font.SysFont('Arial', 12)
+    mouse_coordinate_text = f"{mouse_pos[0]- x_canvas_border_width + view_x} , {mouse_pos[1] + view_y}"
+    font = font_cache.get('Arial', 12)
     mouse_coor_surface = font.render(mouse_coordinate_text , True, BLACK)
-    screen.blit(mouse_coor_surface, (15, screen_height-15))
+    frame_damage.add_overlay(screen.blit(mouse_coor_surface, (15, screen_height-15)))
+
+    # Show the color the eyedropper would pick.  It reads the flattened copy, so hovering doesn't blend the layers again.
+    if active_tool == "eyedropper" and is_pos_in_canvas(mouse_pos, canvas_rect) and not (file_browser.is_open or import_dialog.is_open or filter_dialog.is_open or version_browser.is_open):
+        hover_color = pick_color((mouse_pos[0] - x_canvas_border_width, mouse_pos[1]))
+        frame_damage.add_overlay(eyedropper.draw_readout(screen, mouse_pos, hover_color, font, BLACK, TOOLTIP_BG))
+
+    if show_memory_panel:
+        frame_damage.add_overlay(memory_accountant.draw(screen, (x_canvas_border_width + 10, 10), font, BLACK, TOOLTIP_BG+(230,)))
 
     # Draw button tooltip on the screen
     for button in tool_buttons_list + misc_buttons_list + layer_buttons_list + layer_func_buttons_list + color_buttons_list + lw_a_buttons_list + current_color_buttons_list:
-        button.draw_tooltip(screen)        
+        frame_damage.add_overlay(button.draw_tooltip(screen))
+
+    # Draw the file browser and the import and filter dialogs on top of everything.  The canvas keeps being drawn underneath them.
+    if file_browser.is_open:
+        file_browser.draw(screen, font, font_cache.get('Arial', 18, bold=True), BLACK, TOOLTIP_BG, SILVER)
+        frame_damage.add_overlay(file_browser.rect)
+    if import_dialog.is_open:
+        import_dialog.draw(screen, font, BLACK, TOOLTIP_BG)
+        frame_damage.add_overlay(import_dialog.rect)
+    if filter_dialog.is_open:
+        frame_damage.add_overlay(filter_dialog.draw(screen, font, BLACK, TOOLTIP_BG, SILVER))
+    if version_browser.is_open:
+        frame_damage.add_overlay(version_browser.draw(screen, font, BLACK, TOOLTIP_BG, SILVER))
+    if len(timeline.frames) > 1 or timeline.playing:
+        timeline.draw(screen, frame_strip_rect, font, BLACK, TOOLTIP_BG, SILVER)
+        frame_damage.add_overlay(frame_strip_rect)
+    frame_damage.add_overlay(timelapse_recorder.draw(screen, (x_canvas_border_width + 10, canvas_height - 60), font, BLACK, TOOLTIP_BG))
+    frame_damage.add_overlay(transform_tool.draw(screen, (x_canvas_border_width + 10, canvas_height - 150), font, BLACK, TOOLTIP_BG))
+    frame_damage.add_overlay(profiler.draw(screen, (x_canvas_border_width + 10, canvas_height - 120), font, BLACK, TOOLTIP_BG))
+    if collab is not None:
+        frame_damage.add_overlay(collab.draw(screen, (x_canvas_border_width + 10, canvas_height - 90), font, BLACK, TOOLTIP_BG))
+    frame_damage.add_overlay(layer_exporter.draw(screen, pygame.Rect(x_canvas_border_width + 10, canvas_height - 30, canvas_width - 20, 20), font, BLACK, TOOLTIP_BG, SILVER))
 
     # --- Update the Display ---
-    pygame.display.flip()
+    profiler.phase = "present"
+    presenter.present(frame_damage.take())
+    if startup_timer is not None:
+        startup_timer.mark("first frame")
+        if print_startup_report:
+            print(startup_timer.report())
+        startup_timer = None
+
+    # Refresh the layer thumbnails after the frame is shown, but not in the middle of a stroke
+    profiler.phase = "after frame"
+    if not mouse_button_down:
+        thumbnail_renderer.update(layers_list)
+
+    # Record a version once an edit is finished.  Only the changed tiles are copied here, they are written on another thread.
+    if version_store is not None and not mouse_button_down:
+        version_store.commit(layers_list, timeline.current + 1)
+
+    # Give memory back before going over budget
+    surface_pool.trim()
+    memory_accountant.enforce()
 
     # --- Frame Rate Control ---
+    profiler.frame(len(frame_events))
+    profiler.phase = "waiting"
     clock.tick(fps) # Limit frames per second to fps
 
+# Finish writing the timelapse and the version history
+timelapse_recorder.stop()
+timelapse_recorder.wait()
+profiler.stop()
+profiler.wait()
+if version_store is not None:
+    version_store.close()
+
+store_frame()
+for frame in timeline.frames:
+    for layer in frame.layers:
+        layer.release()
 pygame.quit()
@@ -0,0 +1,127 @@
+import pygame
+
+class Selection:
+    """The selected area of the canvas, kept as a bit-packed pygame.mask.Mask.  With no selection, everything can be drawn on."""
+
+    def __init__(self, width, height):
+        """
+        Initializes an empty selection.
+
+        :param width: The width of the canvas.
+        :param height: The height of the canvas.
+        """
+
+        self.width = width
+        self.height = height
+        self.mask = None        # None means nothing is selected, so drawing isn't clipped
+        self.outline = None     # Cached surface showing the edge of the selection
+
+    def is_active(self):
+        return self.mask is not None
+
+    def combine(self, shape_mask, mode="replace"):
+        """
+        Combines a new shape with the selection.
+
+        :param shape_mask: A canvas-sized mask of the new shape.
+        :param mode: "replace", "add" or "subtract".
+        """
+
+        if mode == "add" and self.mask is not None:
+            self.mask.draw(shape_mask, (0, 0))
+        elif mode == "subtract":
+            if self.mask is None:
+                return
+            self.mask.erase(shape_mask, (0, 0))
+        else:
+            self.mask = shape_mask
+        self.changed()
+
+    def select_rect(self, rect, mode="replace"):
+        rect = pygame.Rect(rect).clip(pygame.Rect(0, 0, self.width, self.height))
+        shape_mask = pygame.Mask((self.width, self.height))
+        if rect.width > 0 and rect.height > 0:
+            shape_mask.draw(pygame.Mask(rect.size, fill=True), rect.topleft)
+        self.combine(shape_mask, mode)
+
+    def select_ellipse(self, rect, mode="replace"):
+        rect = pygame.Rect(rect)
+        shape_mask = pygame.Mask((self.width, self.height))
+        if rect.width > 0 and rect.height > 0:
+            shape_surface = pygame.Surface(rect.size, pygame.SRCALPHA)
+            pygame.draw.ellipse(shape_surface, (255, 255, 255, 255), shape_surface.get_rect())
+            shape_mask.draw(pygame.mask.from_surface(shape_surface), rect.topleft)
+        self.combine(shape_mask, mode)
+
+    def magic_wand(self, surface, pos, tolerance, mode="replace"):
+        """Selects the connected area around pos whose colors are within tolerance of the color at pos."""
+        color = surface.get_at(pos)
+        similar_mask = pygame.mask.from_threshold(surface, color, (tolerance+1, tolerance+1, tolerance+1, tolerance+1))
+        self.combine(similar_mask.connected_component(pos), mode)
+
+    def select_all(self):
+        self.mask = pygame.Mask((self.width, self.height), fill=True)
+        self.changed()
+
+    def invert(self):
+        if self.mask is None:
+            return
+        self.mask.invert()
+        self.changed()
+
+    def deselect(self):
+        self.mask = None
+        self.changed()
+
+    def changed(self):
+        # An empty selection would block all drawing, so treat it as no selection
+        if self.mask is not None and self.mask.count() == 0:
+            self.mask = None
+        self.outline = None
+
+    def bounding_rect(self):
+        """Returns the rect around the selected pixels, or the whole canvas with no selection."""
+        if self.mask is None:
+            return pygame.Rect(0, 0, self.width, self.height)
+        rects = self.mask.get_bounding_rects()
+        return rects[0].unionall(rects[1:])
+
+    def mask_array(self, rect):
+        """Returns which pixels in rect are selected as a bool array indexed [y, x], or None with no selection."""
+        if self.mask is None:
+            return None
+        rect = pygame.Rect(rect)
+        surface = pygame.Surface(rect.size, pygame.SRCALPHA)
+        self.mask.to_surface(surface, setcolor=(255, 255, 255, 255), unsetcolor=(0, 0, 0, 0), dest=(-rect.x, -rect.y))
+        return pygame.surfarray.array_alpha(surface).T > 0
+
+    def clip(self, surface, rect=None):
+        """Makes the pixels of surface outside the selection transparent, looking only inside rect if given."""
+        if self.mask is None:
+            return
+        if rect is None:
+            rect = surface.get_rect()
+        rect = pygame.Rect(rect).clip(surface.get_rect())
+        if rect.width > 0 and rect.height > 0:
+            self.mask.to_surface(surface.subsurface(rect), setcolor=None, unsetcolor=(0, 0, 0, 0), dest=(-rect.x, -rect.y))
+
+    def fill(self, surface, color):
+        """Sets the selected pixels of surface to color, without blending."""
+        if self.mask is None:
+            surface.fill(color)
+        else:
+            self.mask.to_surface(surface, setcolor=color, unsetcolor=None)
+
+    def draw(self, screen, pos, color):
+        """Draws the edge of the selection on screen, with the canvas at pos.  Returns the area drawn, or None."""
+        if self.mask is None:
+            return
+        if self.outline is None:
+            # The edge is what is left after removing the pixels whose 4 neighbours are all selected
+            inner_mask = self.mask.overlap_mask(self.mask, (1, 0))
+            for offset in [(-1, 0), (0, 1), (0, -1)]:
+                inner_mask = inner_mask.overlap_mask(self.mask, offset)
+            edge_mask = self.mask.copy()
+            edge_mask.erase(inner_mask, (0, 0))
+            self.outline = edge_mask.to_surface(setcolor=color, unsetcolor=(0, 0, 0, 0))
+        return screen.blit(self.outline, pos)
@@ -0,0 +1,139 @@
+import importlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+
+class LazyModule:
+    """Stands in for a module and only imports it the first time one of its attributes is used."""
+
+    def __init__(self, name):
+        """
+        Initializes the stand-in.
+
+        :param name: The full name of the module, e.g. "tkinter.filedialog".
+        """
+
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        # Only called for attributes that aren't set on the stand-in itself
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+def cache_dir():
+    """Returns the folder where caches are kept between runs, creating it if needed."""
+    base = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "drawing_pygame")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+class FontCache:
+    """Creates each font once, and remembers the font files SysFont would pick so later runs don't have to search for them."""
+
+    def __init__(self, cache_file):
+        """
+        Initializes the font cache.
+
+        :param cache_file: The JSON file the resolved font paths are kept in.
+        """
+
+        self.cache_file = cache_file
+        self.fonts = {}
+        try:
+            with open(cache_file) as paths_file:
+                self.paths = json.load(paths_file)
+        except (OSError, ValueError):
+            self.paths = {}
+
+    def get(self, name, size, bold=False):
+        """Returns the same font as pygame.font.SysFont(name, size, bold)."""
+        font = self.fonts.get((name, size, bold))
+        if font is None:
+            path, fake_bold = self.resolve(name, bold)
+            font = pygame.font.Font(path, size)
+            if fake_bold:
+                font.set_bold(True)
+            self.fonts[(name, size, bold)] = font
+        return font
+
+    def resolve(self, name, bold):
+        """Returns (font file or None for the default font, whether bold has to be faked), from the cache when possible."""
+        key = f"{name}|{'bold' if bold else 'regular'}"
+        entry = self.paths.get(key)
+        if entry is not None and (entry["path"] is None or os.path.exists(entry["path"])):
+            return entry["path"], entry["fake_bold"]
+
+        # This is the slow part: the first lookup lists every font installed (on Linux by running fc-list)
+        path = pygame.font.match_font(name, bold=bold)
+        # Like SysFont, fall back to the regular face (or the default font) and fake the bold
+        fake_bold = bold and (path is None or path == pygame.font.match_font(name))
+        self.paths[key] = {"path": path, "fake_bold": fake_bold}
+        self.save()
+        return path, fake_bold
+
+    def save(self):
+        try:
+            tmp_file = self.cache_file + ".tmp"
+            with open(tmp_file, "w") as paths_file:
+                json.dump(self.paths, paths_file)
+            os.replace(tmp_file, self.cache_file)
+        except OSError:
+            pass  # Without the cache, the next run just searches again
+
+class ImageCache:
+    """Decodes image files once.  A whole folder can be decoded up front on several threads."""
+
+    def __init__(self):
+        self.images = {}
+
+    def key(self, path):
+        # Case-insensitive, so "save.png" finds "save.PNG" on case-sensitive file systems too
+        return os.path.normcase(os.path.normpath(path)).lower()
+
+    def preload(self, directory, workers=None):
+        """Decodes every image in directory in parallel."""
+        names = [name for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS)]
+        paths = [os.path.join(directory, name) for name in names]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for path, image in zip(paths, executor.map(pygame.image.load, paths)):
+                self.images[self.key(path)] = image
+
+    def load(self, path):
+        """Returns the decoded image at path, decoding it now if it wasn't preloaded."""
+        image = self.images.get(self.key(path))
+        if image is None:
+            image = pygame.image.load(path)
+            self.images[self.key(path)] = image
+        return image
+
+class StartupTimer:
+    """Measures how long each phase of startup takes."""
+
+    def __init__(self, start_time):
+        """
+        Initializes the timer.
+
+        :param start_time: The time.perf_counter() value when the program started.
+        """
+
+        self.start_time = start_time
+        self.last_time = start_time
+        self.phases = []
+
+    def mark(self, phase):
+        """Ends the current phase, naming it phase."""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last_time))
+        self.last_time = now
+
+    def report(self):
+        lines = [f"{phase:<14} {seconds*1000:8.1f} ms" for phase, seconds in self.phases]
+        lines.append(f"{'time to frame':<14} {(self.last_time - self.start_time)*1000:8.1f} ms")
+        return "\n".join(lines)
@@ -0,0 +1,105 @@
+import time
+
+import pygame
+
+from memory import surface_bytes
+
+class SurfacePool:
+    """
+    Hands out cleared scratch surfaces and takes them back after use, so drawing doesn't allocate (and free) a
+    canvas-sized surface for every mouse event.
+
+    Surfaces are kept per (size, flags).  Idle surfaces are kept up to max_bytes, and trim() frees the ones that were not
+    used for idle_seconds, so a burst of work doesn't hold on to memory for the rest of the session.
+    """
+
+    def __init__(self, max_bytes, idle_seconds=30.0):
+        """
+        Initializes an empty pool.
+
+        :param max_bytes: The most memory the idle surfaces may hold.  Surfaces given back past it are freed.
+        :param idle_seconds: How long an idle surface is kept.
+        """
+
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.free = {}  # (size, flags) -> [(surface, time it was given back)], most recently given back last
+        self.idle_bytes = 0
+        self.in_use = 0
+        self.peak_bytes = 0  # The most memory the pool's surfaces held, idle or in use
+        self.in_use_bytes = 0
+
+        # Counters
+        self.allocated = 0  # Surfaces created because none was idle
+        self.reused = 0     # Surfaces handed out again, i.e. allocations avoided
+        self.dropped = 0    # Surfaces freed when given back, because the pool was full
+        self.trimmed = 0    # Surfaces freed by trim() or clear()
+
+    def acquire(self, size, flags=pygame.SRCALPHA):
+        """Returns a surface of size, with all its pixels (0, 0, 0, 0).  Give it back with release().  flags is SRCALPHA or 0."""
+        free = self.free.get((tuple(size), flags & pygame.SRCALPHA))
+        if free:
+            surface, released = free.pop()
+            self.idle_bytes -= surface_bytes(surface)
+            self.reused += 1
+        else:
+            surface = pygame.Surface(size, flags)
+            self.allocated += 1
+        self.in_use += 1
+        self.in_use_bytes += surface_bytes(surface)
+        self.peak_bytes = max(self.peak_bytes, self.idle_bytes + self.in_use_bytes)
+        return surface
+
+    def release(self, surface, dirty_rect=None):
+        """
+        Takes back a surface from acquire().
+
+        :param surface: The surface.  It must not be used any more.
+        :param dirty_rect: The area drawn on since it was acquired, which is all that needs clearing.  None for all of it.
+        """
+
+        nbytes = surface_bytes(surface)
+        self.in_use -= 1
+        self.in_use_bytes -= nbytes
+        if self.idle_bytes + nbytes > self.max_bytes:
+            self.dropped += 1
+            return
+        surface.set_clip(None)
+        if dirty_rect is None:
+            surface.fill((0, 0, 0, 0))
+        else:
+            surface.fill((0, 0, 0, 0), dirty_rect)
+        self.free.setdefault((surface.get_size(), surface.get_flags() & pygame.SRCALPHA), []).append((surface, time.monotonic()))
+        self.idle_bytes += nbytes
+
+    def trim(self):
+        """Frees the surfaces that were idle for idle_seconds.  Cheap enough to call every frame."""
+        oldest = time.monotonic() - self.idle_seconds
+        for key, free in self.free.items():
+            # The least recently given back are first
+            while free and free[0][1] < oldest:
+                surface, released = free.pop(0)
+                self.idle_bytes -= surface_bytes(surface)
+                self.trimmed += 1
+
+    def clear(self):
+        """Frees every idle surface.  Returns False when there were none, so it can be used as a memory evictor."""
+        count = sum(len(free) for free in self.free.values())
+        self.free = {}
+        self.idle_bytes = 0
+        self.trimmed += count
+        return count > 0
+
+    def nbytes(self):
+        return self.idle_bytes
+
+    def stats(self):
+        """Returns the counters, e.g. for the memory report."""
+        return {
+            "allocated": self.allocated,
+            "reused (allocations avoided)": self.reused,
+            "dropped (pool full)": self.dropped,
+            "trimmed (idle)": self.trimmed,
+            "in use": self.in_use,
+            "peak MB": round(self.peak_bytes / (1024 * 1024), 1),
+        }
@@ -0,0 +1,90 @@
+import math
+
+import pygame
+
+class ThumbnailRenderer:
+    """Keeps a small preview of each layer, rescaling only the parts of the layer that changed."""
+
+    def __init__(self, box_width, box_height, background_color, interval_ms=200, time_budget_ms=4):
+        """
+        Initializes the thumbnail renderer.
+
+        :param box_width: The width of the box the thumbnails have to fit in.
+        :param box_height: The height of the box the thumbnails have to fit in.
+        :param background_color: The color shown through the transparent parts of a thumbnail, e.g. the canvas color.
+        :param interval_ms: The minimum time between two rounds of thumbnail updates.
+        :param time_budget_ms: The time a round of updates may take.  Layers left over are updated in the next round.
+        """
+
+        self.box_width = box_width
+        self.box_height = box_height
+        self.background_color = background_color
+        self.interval_ms = interval_ms
+        self.time_budget_ms = time_budget_ms
+        self.last_update = 0
+
+    def thumbnail_size(self, layer):
+        """Returns the largest size with the layer's aspect ratio that fits in the box."""
+        scale = min(self.box_width / layer.width, self.box_height / layer.height)
+        return max(1, int(layer.width * scale)), max(1, int(layer.height * scale))
+
+    def render(self, layer, dirty_rect=None):
+        """Rescales the part of the layer in dirty_rect (or the whole layer) into layer.thumbnail."""
+        size = self.thumbnail_size(layer)
+        if layer.thumbnail is None or layer.thumbnail.get_size() != size:
+            layer.thumbnail = pygame.Surface(size, pygame.SRCALPHA)
+            dirty_rect = None
+        if dirty_rect is None:
+            dirty_rect = layer.surface.get_rect()
+
+        # Snap the dirty area to whole thumbnail pixels, then take the matching area of the layer
+        scale_x = size[0] / layer.width
+        scale_y = size[1] / layer.height
+        left = math.floor(dirty_rect.left * scale_x)
+        top = math.floor(dirty_rect.top * scale_y)
+        right = min(size[0], math.ceil(dirty_rect.right * scale_x))
+        bottom = min(size[1], math.ceil(dirty_rect.bottom * scale_y))
+        if right <= left or bottom <= top:
+            return
+        source_rect = pygame.Rect(
+            math.floor(left / scale_x), math.floor(top / scale_y),
+            math.ceil(right / scale_x) - math.floor(left / scale_x), math.ceil(bottom / scale_y) - math.floor(top / scale_y)
+        ).clip(layer.surface.get_rect())
+        thumb_rect = pygame.Rect(left, top, right - left, bottom - top)
+
+        layer.thumbnail.fill((0, 0, 0, 0), thumb_rect)
+        # Where the layer has no pixels, the thumbnail stays transparent without rescaling anything
+        if source_rect.colliderect(layer.content_rect()):
+            scaled = pygame.transform.smoothscale(layer.surface.subsurface(source_rect), thumb_rect.size)
+            # Blitting onto fully transparent pixels copies them as is
+            layer.thumbnail.blit(scaled, thumb_rect)
+        self.decorate(layer)
+
+    def update(self, layers):
+        """Brings the thumbnails of changed layers up to date, at most every interval_ms and within time_budget_ms."""
+        now = pygame.time.get_ticks()
+        if now - self.last_update < self.interval_ms:
+            return
+        self.last_update = now
+        for layer in layers:
+            if pygame.time.get_ticks() - now > self.time_budget_ms:
+                break
+            dirty_rect = layer.take_dirty("thumbnail")
+            if dirty_rect is not None:
+                self.render(layer, dirty_rect)
+
+    def decorate(self, layer):
+        """Shows the layer's thumbnail on its layer button, over both the button's active and inactive colors."""
+        button = layer.layer_button
+        if button is None or layer.thumbnail is None:
+            return
+        button_rect = pygame.Rect(0, 0, int(button.width), int(button.height))
+        thumb_rect = layer.thumbnail.get_rect(center=button_rect.center)
+        images = []
+        for color in [button.inactive_color, button.active_color]:
+            image = pygame.Surface(button_rect.size)
+            image.fill(color)
+            pygame.draw.rect(image, self.background_color, thumb_rect)
+            image.blit(layer.thumbnail, thumb_rect, special_flags=pygame.BLEND_PREMULTIPLIED)
+            images.append(image)
+        button.inactive_image, button.active_image = images
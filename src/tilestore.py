@@ -0,0 +1,155 @@
+import mmap
+import tempfile
+from collections import OrderedDict
+
+import pygame
+
+TILE_SIZE = 256  # Width and height of a tile in pixels
+BYTES_PER_PIXEL = 4  # Pixels are stored as RGBA
+
+class TileCache:
+    """A shared, size-bounded cache of the tiles that are currently paged into RAM."""
+
+    def __init__(self, cache_bytes):
+        """
+        Initializes the tile cache.
+
+        :param cache_bytes: The maximum number of bytes the cached tiles may use.  Least recently used tiles are written back and evicted beyond this.
+        """
+
+        self.cache_bytes = cache_bytes
+        self.used_bytes = 0
+        self.tiles = OrderedDict()  # (store, tx, ty) -> tile surface, oldest first
+        self.dirty = set()          # Keys of the tiles that differ from the memory-mapped file
+
+    def get(self, store, tx, ty):
+        """Returns the tile surface at (tx, ty) of store, paging it in from the file if needed."""
+        key = (store, tx, ty)
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+
+        tile = store.read_tile(tx, ty)
+        self.tiles[key] = tile
+        self.used_bytes += tile.get_width() * tile.get_height() * BYTES_PER_PIXEL
+        self.evict()
+        return tile
+
+    def mark_dirty(self, store, tx, ty):
+        self.dirty.add((store, tx, ty))
+
+    def evict(self, target_bytes=None):
+        """Writes back and drops the least recently used tiles until the cache fits in target_bytes (cache_bytes by default)."""
+        if target_bytes is None:
+            target_bytes = self.cache_bytes
+        # Always keep at least one tile, otherwise a cache smaller than a tile would thrash on every get()
+        while self.used_bytes > target_bytes and len(self.tiles) > 1:
+            key, tile = self.tiles.popitem(last=False)
+            self.release(key, tile)
+
+    def release(self, key, tile):
+        store, tx, ty = key
+        if key in self.dirty:
+            store.write_tile(tx, ty, tile)
+            self.dirty.discard(key)
+        self.used_bytes -= tile.get_width() * tile.get_height() * BYTES_PER_PIXEL
+
+    def flush(self, store=None):
+        """Writes all dirty tiles (of one store, or of every store) back to their files."""
+        for key in list(self.dirty):
+            if store is None or key[0] is store:
+                key[0].write_tile(key[1], key[2], self.tiles[key])
+                self.dirty.discard(key)
+
+    def drop(self, store):
+        """Forgets every cached tile of store without writing it back."""
+        for key in [key for key in self.tiles if key[0] is store]:
+            self.dirty.discard(key)
+            self.release(key, self.tiles.pop(key))
+
+class TileStore:
+    """Keeps the pixels of one layer in a memory-mapped file, so a document can be larger than physical memory."""
+
+    def __init__(self, width, height, cache):
+        """
+        Initializes the tile store.
+
+        :param width: The width of the document in pixels.
+        :param height: The height of the document in pixels.
+        :param cache: The TileCache shared by all the stores of the document.
+        """
+
+        self.width = width
+        self.height = height
+        self.cache = cache
+        self.rect = pygame.Rect(0, 0, width, height)
+
+        # The file is deleted as soon as it is closed.  Truncating creates it sparse, and all zeros is fully transparent.
+        self.file = tempfile.TemporaryFile(prefix="layer_")
+        self.file.truncate(width * height * BYTES_PER_PIXEL)
+        self.mmap = mmap.mmap(self.file.fileno(), width * height * BYTES_PER_PIXEL)
+
+        # A surface that reads and writes the mapped file directly.  The OS pages it in only where it is touched.
+        self.backing = pygame.image.frombuffer(self.mmap, (width, height), "RGBA")
+
+    def tile_rect(self, tx, ty):
+        return pygame.Rect(tx * TILE_SIZE, ty * TILE_SIZE, TILE_SIZE, TILE_SIZE).clip(self.rect)
+
+    def tiles_in(self, rect):
+        """Yields (tx, ty) of every tile overlapping rect."""
+        rect = rect.clip(self.rect)
+        if rect.width == 0 or rect.height == 0:
+            return
+        for ty in range(rect.top // TILE_SIZE, (rect.bottom - 1) // TILE_SIZE + 1):
+            for tx in range(rect.left // TILE_SIZE, (rect.right - 1) // TILE_SIZE + 1):
+                yield tx, ty
+
+    def read_tile(self, tx, ty):
+        return self.backing.subsurface(self.tile_rect(tx, ty)).copy()
+
+    def write_tile(self, tx, ty, tile):
+        rect = self.tile_rect(tx, ty)
+        # Blitting onto fully transparent pixels copies them as is
+        self.backing.fill((0, 0, 0, 0), rect)
+        self.backing.blit(tile, rect)
+
+    def read_region(self, rect, surface, pos=(0, 0)):
+        """Copies the document pixels in rect onto surface at pos, going through the tile cache."""
+        for tx, ty in self.tiles_in(rect):
+            tile_rect = self.tile_rect(tx, ty)
+            overlap = tile_rect.clip(rect)
+            tile = self.cache.get(self, tx, ty)
+            dest = (pos[0] + overlap.x - rect.x, pos[1] + overlap.y - rect.y)
+            surface.fill((0, 0, 0, 0), pygame.Rect(dest, overlap.size))
+            surface.blit(tile, dest, overlap.move(-tile_rect.x, -tile_rect.y))
+
+    def write_region(self, rect, surface, pos=(0, 0)):
+        """Copies the pixels of surface at pos into the document at rect, going through the tile cache."""
+        for tx, ty in self.tiles_in(rect):
+            tile_rect = self.tile_rect(tx, ty)
+            overlap = tile_rect.clip(rect)
+            tile = self.cache.get(self, tx, ty)
+            local = overlap.move(-tile_rect.x, -tile_rect.y)
+            tile.fill((0, 0, 0, 0), local)
+            tile.blit(surface, local, pygame.Rect(pos[0] + overlap.x - rect.x, pos[1] + overlap.y - rect.y, overlap.width, overlap.height))
+            self.cache.mark_dirty(self, tx, ty)
+
+    def prefetch(self, rect):
+        """Pages in the tiles overlapping rect as long as they fit in the cache without evicting anything."""
+        for tx, ty in self.tiles_in(rect):
+            if (self, tx, ty) in self.cache.tiles:
+                continue
+            if self.cache.used_bytes + TILE_SIZE * TILE_SIZE * BYTES_PER_PIXEL > self.cache.cache_bytes:
+                break
+            self.cache.get(self, tx, ty)
+
+    def flush(self):
+        """Writes the dirty tiles back so that self.backing and self.mmap hold the whole document."""
+        self.cache.flush(self)
+
+    def close(self):
+        self.cache.drop(self)
+        self.backing = None
+        self.mmap.close()
+        self.file.close()
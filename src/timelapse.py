@@ -0,0 +1,171 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+
+import pygame
+
+from startup import LazyModule
+
+Image = LazyModule("PIL.Image")  # Pillow is imported the first time a frame is written
+
+ANIMATED_EXTENSIONS = (".gif", ".webp")
+
+class TimelapseRecorder:
+    """
+    Records the canvas at an interval while drawing.
+
+    Frames go through a bounded ring buffer to an encoder thread.  When the encoder falls behind, the oldest frames are
+    dropped instead of making the main loop wait.
+    """
+
+    def __init__(self, interval_ms=500, buffer_frames=8, frame_duration_ms=100):
+        """
+        Initializes the recorder.
+
+        :param interval_ms: The minimum time between two frames.
+        :param buffer_frames: The number of frames that may wait for the encoder.
+        :param frame_duration_ms: How long each frame is shown in an animated image.
+        """
+
+        self.interval_ms = interval_ms
+        self.frame_duration_ms = frame_duration_ms
+        self.buffer = deque(maxlen=buffer_frames)  # (size, RGB bytes) waiting for the encoder, oldest first
+        self.condition = threading.Condition()
+        self.thread = None
+        self.is_recording = False
+        self.stopping = False
+        self.output_path = None
+        self.last_capture = 0
+        self.last_signature = None
+        self.captured = 0
+        self.dropped = 0
+        self.written = 0
+        self.start_time = 0
+        self.error = None
+
+    def is_busy(self):
+        """Returns True while recording, or while the encoder is still writing the last recording."""
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, output_path):
+        """
+        Starts recording.
+
+        :param output_path: A .gif or .webp file for an animated image.  Any other name is used for a numbered PNG sequence
+                            in the same folder, e.g. "session.png" gives session_00001.png, session_00002.png, ...
+        """
+
+        if self.is_busy():
+            return
+        self.output_path = output_path
+        self.buffer.clear()
+        self.is_recording = True
+        self.stopping = False
+        self.last_capture = 0
+        self.last_signature = None
+        self.captured = 0
+        self.dropped = 0
+        self.written = 0
+        self.error = None
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self.encode_frames, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops recording.  The encoder finishes writing the frames in the buffer on its own."""
+        if not self.is_recording:
+            return
+        self.is_recording = False
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+    def wait(self):
+        """Waits for the encoder to finish, e.g. before quitting."""
+        if self.thread is not None:
+            self.thread.join()
+
+    def capture(self, surface, signature):
+        """
+        Adds a frame if recording, the interval has passed, and the canvas changed.  Call once per frame.
+
+        :param surface: The composited canvas.
+        :param signature: Anything that compares equal while the canvas is unchanged, e.g. the versions of the visible layers.
+        """
+
+        if not self.is_recording:
+            return
+        now = pygame.time.get_ticks()
+        if now - self.last_capture < self.interval_ms or signature == self.last_signature:
+            return
+        self.last_capture = now
+        self.last_signature = signature
+
+        frame = (surface.get_size(), pygame.image.tostring(surface, "RGB", False))
+        with self.condition:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1  # The deque drops the oldest frame
+            self.buffer.append(frame)
+            self.captured += 1
+            self.condition.notify()
+
+    def encode_frames(self):
+        # Runs on the encoder thread
+        base, ext = os.path.splitext(self.output_path)
+        animated = ext.lower() in ANIMATED_EXTENSIONS
+        if animated:
+            # The frames are kept as PNGs until the end, when they are put together into one file
+            frames_dir = tempfile.mkdtemp(prefix="timelapse_")
+            frame_base = os.path.join(frames_dir, "frame")
+        else:
+            frame_base = base
+
+        try:
+            while True:
+                with self.condition:
+                    while not self.buffer and not self.stopping:
+                        self.condition.wait()
+                    if not self.buffer:
+                        break
+                    size, raw = self.buffer.popleft()
+                img = Image.frombuffer("RGB", size, raw, "raw", "RGB", 0, 1)
+                img.save(f"{frame_base}_{self.written + 1:05}.png", compress_level=1)
+                self.written += 1
+
+            if animated and self.written > 0:
+                frames = (Image.open(f"{frame_base}_{i + 1:05}.png") for i in range(1, self.written))
+                with Image.open(f"{frame_base}_00001.png") as first:
+                    first.save(self.output_path, save_all=True, append_images=frames, duration=self.frame_duration_ms, loop=0)
+        except Exception as e:
+            self.error = e
+        finally:
+            if animated:
+                shutil.rmtree(frames_dir, ignore_errors=True)
+
+    def nbytes(self):
+        return sum(len(raw) for size, raw in list(self.buffer))
+
+    def draw(self, screen, pos, font, text_color, background_color):
+        """Draws the recording indicator while recording or writing, and returns its rect."""
+        if self.is_recording:
+            seconds = int(time.perf_counter() - self.start_time)
+            text = f"REC {seconds // 60:02}:{seconds % 60:02}  {self.captured} frames"
+            if self.dropped:
+                text += f", {self.dropped} dropped"
+        elif self.is_busy():
+            text = f"Writing timelapse... {self.written} / {self.captured - self.dropped} frames"
+        elif self.error is not None:
+            text = f"Timelapse failed: {self.error}"
+        else:
+            return
+        text_surface = font.render(text, True, text_color)
+        box_rect = text_surface.get_rect(topleft=pos).inflate(10 + 14, 10)
+        box_rect.topleft = pos
+        pygame.draw.rect(screen, background_color, box_rect)
+        pygame.draw.rect(screen, text_color, box_rect, 1)
+        pygame.draw.circle(screen, (255, 0, 0) if self.is_recording else text_color, (box_rect.x + 10, box_rect.centery), 4)
+        screen.blit(text_surface, (box_rect.x + 19, box_rect.y + 5))
+        return box_rect
@@ -0,0 +1,253 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+from filters import tile_rects
+from history import RegionSnapshot, CompoundEdit
+
+TRANSFORM_MODES = ("move", "scale", "rotate")
+
+def resample(source, angle, scale, smooth):
+    """
+    Returns source rotated by angle degrees (counterclockwise) and scaled by scale, around its center.
+
+    :param source: A premultiplied surface with a transparent border, so the corners filled in by rotating are (0, 0, 0, 0).
+    :param smooth: True to interpolate (rotozoom), False to take the nearest pixels.
+    """
+
+    if angle == 0 and scale == 1:
+        return source
+    if smooth:
+        return pygame.transform.rotozoom(source, angle, scale)
+    size = (max(1, round(source.get_width() * scale)), max(1, round(source.get_height() * scale)))
+    # Shrinking can drop the border, and rotate() fills the corners from the top-left pixel, so a new border is added
+    padded = pygame.Surface((size[0] + 2, size[1] + 2), pygame.SRCALPHA)
+    padded.blit(pygame.transform.scale(source, size), (1, 1))  # Blitting onto fully transparent pixels copies them as is
+    return pygame.transform.rotate(padded, angle)
+
+class TransformTool:
+    """
+    Moves, scales or rotates the pixels of a layer, or of the selection, with a drag.
+
+    While dragging, a small proxy of the pixels is transformed and scaled up into the preview layer, which is shown in
+    place of the layer.  On release the full-resolution pixels are resampled on a worker thread, and once that is done
+    the result replaces the layer's pixels with one undo entry made of the tiles it touched.
+    """
+
+    def __init__(self, surface_pool, proxy_size=256):
+        """
+        Initializes the tool.
+
+        :param surface_pool: The SurfacePool the layer-sized copy shown under the preview is taken from.
+        :param proxy_size: The longest side of the proxy.
+        """
+
+        self.surface_pool = surface_pool
+        self.proxy_size = proxy_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.smooth = True
+        self.layer = None
+        self.preview_layer = None
+        self.mode = None
+        self.source = None       # The pixels being transformed, with a transparent border of 1 pixel
+        self.source_rect = None  # Where they are on the layer, border included
+        self.proxy = None
+        self.proxy_scale = 1.0
+        self.base = None         # The layer without the pixels being transformed
+        self.start_pos = None
+        self.offset = (0, 0)
+        self.angle = 0.0
+        self.scale = 1.0
+        self.preview_rect = None
+        self.future = None
+        self.on_done = None
+        self.follow_selection = False  # True when a selection was transformed, so it moves with the pixels
+
+    def is_dragging(self):
+        return self.layer is not None and self.future is None
+
+    def is_busy(self):
+        """Returns True while the full-resolution result is being computed."""
+        return self.future is not None
+
+    def is_previewing(self):
+        """Returns True while the preview layer should be shown in place of the layer."""
+        return self.layer is not None
+
+    def begin(self, layer, preview_layer, rect, mask, mode, pos):
+        """
+        Starts a drag.
+
+        :param layer: The layer to transform.
+        :param preview_layer: A layer the size of layer, to show the preview in.
+        :param rect: The area to transform, e.g. the layer's content rect or the bounds of the selection.
+        :param mask: The selection's pygame.mask.Mask, or None to take every pixel in rect.
+        :param mode: One of TRANSFORM_MODES.
+        :param pos: The mouse position on the layer.
+        :return: False if there is nothing to transform.
+        """
+
+        rect = pygame.Rect(rect).clip(layer.surface.get_rect())
+        if rect.width == 0 or rect.height == 0:
+            return False
+        self.layer = layer
+        self.preview_layer = preview_layer
+        self.mode = mode
+        self.start_pos = pos
+        self.offset = (0, 0)
+        self.angle = 0.0
+        self.scale = 1.0
+        self.follow_selection = mask is not None
+
+        # Blitting onto fully transparent pixels copies them as is
+        self.source_rect = rect.inflate(2, 2)
+        self.source = pygame.Surface(self.source_rect.size, pygame.SRCALPHA)
+        self.source.blit(layer.surface, (1, 1), rect)
+        if mask is not None:
+            mask.to_surface(self.source, setcolor=None, unsetcolor=(0, 0, 0, 0), dest=(-self.source_rect.x, -self.source_rect.y))
+        self.proxy_scale = min(1.0, self.proxy_size / max(rect.size))
+        if self.proxy_scale < 1:
+            proxy_size = (max(1, round(self.source_rect.width * self.proxy_scale)), max(1, round(self.source_rect.height * self.proxy_scale)))
+            self.proxy = pygame.transform.smoothscale(self.source, proxy_size)
+        else:
+            self.proxy = self.source
+
+        self.base = self.surface_pool.acquire(layer.surface.get_size())
+        self.base.blit(layer.surface, (0, 0))
+        if mask is None:
+            self.base.fill(layer.bg_color, rect)
+        else:
+            mask.to_surface(self.base, setcolor=layer.bg_color, unsetcolor=None)
+
+        preview_layer.clear()
+        content_rect = layer.content_rect()
+        preview_layer.surface.blit(self.base, content_rect, content_rect)
+        preview_layer.mark_dirty(content_rect)
+        self.preview_rect = None
+        self.draw_preview()
+        return True
+
+    def center(self):
+        return (self.source_rect.centerx + self.offset[0], self.source_rect.centery + self.offset[1])
+
+    def drag(self, pos):
+        """Updates the transform for the mouse at pos on the layer, and redraws the preview."""
+        if not self.is_dragging():
+            return
+        if self.mode == "move":
+            self.offset = (pos[0] - self.start_pos[0], pos[1] - self.start_pos[1])
+        elif self.mode == "scale":
+            center = self.source_rect.center
+            start_distance = math.hypot(self.start_pos[0] - center[0], self.start_pos[1] - center[1])
+            distance = math.hypot(pos[0] - center[0], pos[1] - center[1])
+            self.scale = max(0.05, distance / max(1.0, start_distance))
+        else:
+            # The screen's y axis points down, so a clockwise drag is a negative (clockwise) rotation
+            center = self.source_rect.center
+            start_angle = math.atan2(self.start_pos[1] - center[1], self.start_pos[0] - center[0])
+            angle = math.atan2(pos[1] - center[1], pos[0] - center[0])
+            self.angle = -math.degrees(angle - start_angle)
+        self.draw_preview()
+
+    def draw_preview(self):
+        """Draws the transformed proxy, scaled up to full size, over the layer without the pixels being transformed."""
+        if self.angle == 0 and self.scale == 1:
+            preview = self.source  # Moving needs no resampling, so the full-resolution pixels are shown
+        else:
+            preview = pygame.transform.rotozoom(self.proxy, self.angle, self.scale)
+            if self.proxy_scale < 1:
+                preview = pygame.transform.scale(preview, (max(1, round(preview.get_width() / self.proxy_scale)), max(1, round(preview.get_height() / self.proxy_scale))))
+        preview_rect = preview.get_rect(center=self.center())
+
+        surface = self.preview_layer.surface
+        dirty_rect = preview_rect
+        if self.preview_rect is not None:
+            previous_rect = self.preview_rect.clip(surface.get_rect())
+            surface.fill((0, 0, 0, 0), previous_rect)
+            surface.blit(self.base, previous_rect, previous_rect)
+            dirty_rect = dirty_rect.union(self.preview_rect)
+        surface.blit(preview, preview_rect, special_flags=pygame.BLEND_PREMULTIPLIED)
+        self.preview_rect = preview_rect
+        self.preview_layer.mark_dirty(dirty_rect)
+
+    def release(self, on_done):
+        """
+        Ends the drag and starts resampling the full-resolution pixels on the worker thread.
+
+        :param on_done: Called once the result is in the layer, with the undo entry and, if a selection was
+                        transformed, a layer-sized mask of where its pixels are now (else None).
+        """
+
+        if not self.is_dragging():
+            return
+        if self.offset == (0, 0) and self.angle == 0 and self.scale == 1:
+            self.cancel()
+            return
+        self.on_done = on_done
+        self.future = self.executor.submit(resample, self.source, self.angle, self.scale, self.smooth)
+
+    def update(self):
+        """Puts the result into the layer once it is ready.  Call once per frame."""
+        if self.future is None or not self.future.done():
+            return
+        future = self.future
+        self.future = None
+        if future.cancelled() or future.exception() is not None:
+            self.cancel()
+            return
+        result = future.result()
+        layer = self.layer
+        bounds = layer.surface.get_rect()
+        result_rect = result.get_rect(center=self.center())
+        source_rect = self.source_rect.clip(bounds)
+
+        # Only the tiles under the old or the new place of the pixels are saved for undo
+        tiles = [tile for tile in tile_rects(bounds) if tile.colliderect(source_rect) or tile.colliderect(result_rect)]
+        edit = CompoundEdit([RegionSnapshot(layer, tile) for tile in tiles])
+        layer.surface.fill((0, 0, 0, 0), source_rect)
+        layer.surface.blit(self.base, source_rect, source_rect)
+        layer.surface.blit(result, result_rect, special_flags=pygame.BLEND_PREMULTIPLIED)
+        layer.mark_dirty(source_rect)
+        layer.mark_dirty(result_rect)
+        layer.content_may_shrink()
+        moved_mask = None
+        if self.follow_selection:
+            moved_mask = pygame.Mask(bounds.size)
+            moved_mask.draw(pygame.mask.from_surface(result), result_rect.topleft)
+        on_done = self.on_done
+        self.cancel()
+        on_done(edit, moved_mask)
+
+    def cancel(self):
+        """Drops the drag, or the result being computed, and leaves the layer as it was."""
+        if self.future is not None:
+            self.future.cancel()  # If it is already running, its result is ignored
+            self.future = None
+        if self.base is not None:
+            self.surface_pool.release(self.base)
+            self.base = None
+        if self.preview_layer is not None:
+            self.preview_layer.clear()
+        self.layer = None
+        self.preview_layer = None
+        self.source = None
+        self.proxy = None
+        self.on_done = None
+
+    def handle_event(self, event):
+        """Handles an event while the result is being computed.  Only Esc, which cancels, does anything."""
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            self.cancel()
+
+    def draw(self, screen, pos, font, text_color, background_color):
+        """Draws a note while the result is being computed, and returns its rect."""
+        if not self.is_busy():
+            return
+        text_surface = font.render("Transforming...  (Esc cancels)", True, text_color)
+        box_rect = text_surface.get_rect(topleft=pos).inflate(10, 10)
+        box_rect.topleft = pos
+        pygame.draw.rect(screen, background_color, box_rect)
+        pygame.draw.rect(screen, text_color, box_rect, 1)
+        screen.blit(text_surface, (box_rect.x + 5, box_rect.y + 5))
+        return box_rect
@@ -0,0 +1,375 @@
+import pygame
+
+from layerio import premultiply_color
+
+VECTOR_TILE_SIZE = 128  # A vector layer is re-rasterized in squares of this size around the shapes that changed
+
+class VectorShape:
+    """
+    A shape of a vector layer.  Shapes are not changed once made, so the undo history and copies of a layer can share
+    them; moving a shape makes a new one.
+
+    The geometry depends on the kind:
+        "square", "rect" and "oval": (x, y, width, height)
+        "circle": (center_x, center_y, radius)
+        "triangle" and "polyline": a tuple of (x, y) points
+    """
+
+    def __init__(self, kind, geometry, pen_color, fill_color, line_width, shape_width, serial=None):
+        """
+        Initializes the shape.
+
+        :param kind: One of "square", "rect", "circle", "oval", "triangle" and "polyline".
+        :param geometry: Where the shape is, in layer coordinates (see above).
+        :param pen_color: The (r, g, b, a) outline color, not premultiplied.  A polyline is drawn in this color.
+        :param fill_color: The (r, g, b, a) fill color, not premultiplied.
+        :param line_width: The width of the outline, as line_thickness was when the shape was made.
+        :param shape_width: 0 for a filled shape, or the width of the fill color's outline (see shape_width in project.py).
+        :param serial: The shape's place in the drawing order of its layer.  Set by VectorLayer.add().
+        """
+
+        self.kind = kind
+        self.geometry = geometry
+        self.pen_color = tuple(pen_color)
+        self.fill_color = tuple(fill_color)
+        self.line_width = line_width
+        self.shape_width = shape_width
+        self.serial = serial
+        self.rect = self.bounds()
+        self._sprite = None  # The shape drawn on a surface the size of rect, made when first needed
+
+    def bounds(self):
+        """Returns a rect that holds every pixel the shape draws."""
+        if self.kind in ("square", "rect", "oval"):
+            rect = pygame.Rect(self.geometry)
+        elif self.kind == "circle":
+            x, y, radius = self.geometry
+            rect = pygame.Rect(x - radius, y - radius, radius*2 + 1, radius*2 + 1)
+        else:
+            xs = [x for x, y in self.geometry]
+            ys = [y for x, y in self.geometry]
+            rect = pygame.Rect(min(xs), min(ys), max(xs) - min(xs) + 1, max(ys) - min(ys) + 1)
+            # Thick lines stick out of the points by half their width on each side
+            width = max(self.line_width, self.shape_width)
+            rect.inflate_ip(width, width)
+        return rect.inflate(4, 4)
+
+    def moved(self, dx, dy):
+        """Returns a copy of the shape moved by (dx, dy), keeping its place in the drawing order."""
+        if self.kind in ("square", "rect", "oval"):
+            x, y, width, height = self.geometry
+            geometry = (x + dx, y + dy, width, height)
+        elif self.kind == "circle":
+            x, y, radius = self.geometry
+            geometry = (x + dx, y + dy, radius)
+        else:
+            geometry = tuple((x + dx, y + dy) for x, y in self.geometry)
+        return VectorShape(self.kind, geometry, self.pen_color, self.fill_color, self.line_width, self.shape_width, self.serial)
+
+    def sprite(self):
+        """Returns the shape drawn with premultiplied colors on a surface the size of rect."""
+        if self._sprite is None:
+            self._sprite = pygame.Surface(self.rect.size, pygame.SRCALPHA)
+            self.draw(self._sprite, (-self.rect.x, -self.rect.y))
+        return self._sprite
+
+    def draw(self, surface, offset=(0, 0)):
+        """Draws the shape on surface the same way draw_shape in project.py does, moved by offset."""
+        pen_color = premultiply_color(self.pen_color)
+        fill_color = premultiply_color(self.fill_color)
+        dx, dy = offset
+        if self.kind == "polyline":
+            points = [(x + dx, y + dy) for x, y in self.geometry]
+            # The segments overwrite each other on the sprite, so the joints of a half transparent line aren't darker
+            for start, end in zip(points, points[1:]):
+                pygame.draw.line(surface, pen_color, start, end, self.line_width)
+            return
+
+        if self.kind in ("square", "rect", "oval"):
+            rect = pygame.Rect(self.geometry).move(dx, dy)
+            draw = pygame.draw.ellipse if self.kind == "oval" else pygame.draw.rect
+            outline = lambda color, width: draw(surface, color, rect, width)
+        elif self.kind == "circle":
+            x, y, radius = self.geometry
+            outline = lambda color, width: pygame.draw.circle(surface, color, (x + dx, y + dy), radius, width)
+        else:
+            points = [(x + dx, y + dy) for x, y in self.geometry]
+            outline = lambda color, width: pygame.draw.polygon(surface, color, points, width)
+        outline(fill_color, self.shape_width)
+        if pen_color != fill_color:
+            outline(pen_color, self.line_width)
+
+    def hit(self, rect):
+        """Returns whether the shape draws any pixel inside rect."""
+        area = self.rect.clip(rect)
+        if area.width == 0 or area.height == 0:
+            return False
+        area.move_ip(-self.rect.x, -self.rect.y)
+        return self.sprite().subsurface(area).get_bounding_rect().width > 0
+
+    def release(self):
+        """Drops the cached sprite.  It is drawn again when next needed."""
+        self._sprite = None
+
+    def nbytes(self):
+        if self._sprite is None:
+            return 0
+        return self._sprite.get_width() * self._sprite.get_height() * 4
+
+class _Node:
+    """A node of an RTree.  A leaf holds (rect, item) entries, any other node holds child nodes."""
+
+    __slots__ = ("leaf", "entries", "rect")
+
+    def __init__(self, leaf, entries):
+        self.leaf = leaf
+        self.entries = entries
+        self.rect = None
+        self.update_rect()
+
+    def entry_rect(self, entry):
+        return entry[0] if self.leaf else entry.rect
+
+    def update_rect(self):
+        rects = [self.entry_rect(entry) for entry in self.entries]
+        self.rect = rects[0].unionall(rects[1:]) if rects else None
+
+def _area(rect):
+    return rect.width * rect.height
+
+class RTree:
+    """
+    An R-tree of items with rects.  Finding the items whose rects touch an area only looks into the nodes whose bounding
+    rects touch it, so it takes about log(n) steps for n items instead of checking every item.
+
+    Nodes are split with Guttman's quadratic split.  Nodes left under-full by a removal are kept rather than reinserted,
+    which leaves the tree a little less tight but still correct.
+    """
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.min_entries = max_entries // 2
+        self.root = _Node(True, [])
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def insert(self, rect, item):
+        split = self._insert(self.root, pygame.Rect(rect), item)
+        if split is not None:
+            self.root = _Node(False, [self.root, split])
+        self.count += 1
+
+    def _insert(self, node, rect, item):
+        """Inserts under node.  Returns the new sibling of node if it had to be split."""
+        if node.leaf:
+            node.entries.append((rect, item))
+        else:
+            # The child whose rect grows the least, and the smallest of those
+            child = min(node.entries, key=lambda child: (_area(child.rect.union(rect)) - _area(child.rect), _area(child.rect)))
+            split = self._insert(child, rect, item)
+            if split is not None:
+                node.entries.append(split)
+        if len(node.entries) > self.max_entries:
+            return self._split(node)
+        node.update_rect()
+        return None
+
+    def _split(self, node):
+        """Splits the entries of node between node and a new node, which is returned."""
+        entries = node.entries
+        rects = [node.entry_rect(entry) for entry in entries]
+
+        # The two entries that would waste the most area in one node start the two groups
+        seeds = max(((i, j) for i in range(len(entries)) for j in range(i + 1, len(entries))),
+                    key=lambda pair: _area(rects[pair[0]].union(rects[pair[1]])) - _area(rects[pair[0]]) - _area(rects[pair[1]]))
+        groups = [[seeds[0]], [seeds[1]]]
+        group_rects = [rects[seeds[0]], rects[seeds[1]]]
+        remaining = [i for i in range(len(entries)) if i not in seeds]
+        while remaining:
+            # A group that needs all the remaining entries to be full enough gets them
+            for g in (0, 1):
+                if len(groups[g]) + len(remaining) == self.min_entries:
+                    groups[g].extend(remaining)
+                    remaining = []
+            if not remaining:
+                break
+            # Otherwise the entry with the strongest preference goes to the group whose rect grows the least for it
+            growths = [(_area(group_rects[0].union(rects[i])) - _area(group_rects[0]), _area(group_rects[1].union(rects[i])) - _area(group_rects[1]), i) for i in remaining]
+            growth0, growth1, i = max(growths, key=lambda growth: abs(growth[0] - growth[1]))
+            g = 0 if (growth0, _area(group_rects[0]), len(groups[0])) <= (growth1, _area(group_rects[1]), len(groups[1])) else 1
+            groups[g].append(i)
+            group_rects[g] = group_rects[g].union(rects[i])
+            remaining.remove(i)
+
+        node.entries = [entries[i] for i in groups[0]]
+        node.update_rect()
+        return _Node(node.leaf, [entries[i] for i in groups[1]])
+
+    def remove(self, rect, item):
+        """Removes item, which was inserted with rect.  Returns whether it was found."""
+        if not self._remove(self.root, pygame.Rect(rect), item):
+            return False
+        self.count -= 1
+        # A root with a single child isn't needed
+        while not self.root.leaf and len(self.root.entries) == 1:
+            self.root = self.root.entries[0]
+        if not self.root.leaf and not self.root.entries:
+            self.root = _Node(True, [])
+        return True
+
+    def _remove(self, node, rect, item):
+        if node.leaf:
+            for index, entry in enumerate(node.entries):
+                if entry[1] is item:
+                    del node.entries[index]
+                    node.update_rect()
+                    return True
+            return False
+        for child in node.entries:
+            if child.rect.contains(rect) and self._remove(child, rect, item):
+                if not child.entries:
+                    node.entries.remove(child)
+                node.update_rect()
+                return True
+        return False
+
+    def search(self, rect):
+        """Returns the items whose rects overlap rect."""
+        rect = pygame.Rect(rect)
+        found = []
+        if self.root.rect is None:
+            return found
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.leaf:
+                found.extend(item for item_rect, item in node.entries if item_rect.colliderect(rect))
+            else:
+                stack.extend(child for child in node.entries if child.rect.colliderect(rect))
+        return found
+
+class VectorLayer:
+    """
+    The shapes of a vector layer, kept in an RTree by their rects.
+
+    The layer's surface stays the raster cache of the shapes.  A change to the shapes marks the tiles under them, and
+    render() rasterizes only those tiles again, from the shapes the tree finds there.  Each shape keeps its own sprite, so
+    a tile is redrawn by blitting sprites rather than drawing the shapes again.
+    """
+
+    def __init__(self, size, tile_size=VECTOR_TILE_SIZE):
+        """
+        Initializes an empty vector layer.
+
+        :param size: The (width, height) of the layer's surface.
+        :param tile_size: The size of the squares the surface is rasterized again in.
+        """
+
+        self.size = size
+        self.tile_size = tile_size
+        self.tree = RTree()
+        self.shapes = []  # In drawing order
+        self.next_serial = 0
+        self.dirty_tiles = set()
+        self.tiles_rendered = 0  # Counted for the benchmark
+
+    def copy(self):
+        """Returns a vector layer with the same shapes, for a copy of the layer whose surface was copied too."""
+        vector = VectorLayer(self.size, self.tile_size)
+        vector.next_serial = self.next_serial
+        for shape in self.shapes:
+            vector._insert(shape)
+        return vector
+
+    def __contains__(self, shape):
+        return any(other is shape for other in self.tree.search(shape.rect))
+
+    def _insert(self, shape):
+        self.tree.insert(shape.rect, shape)
+        self.shapes.append(shape)
+
+    def _remove(self, shape):
+        self.tree.remove(shape.rect, shape)
+        self.shapes.remove(shape)
+        shape.release()  # Only needed again if the removal is undone
+
+    def mark(self, rect):
+        """Marks the tiles under rect to be rasterized again."""
+        rect = pygame.Rect(rect).clip((0, 0) + tuple(self.size))
+        if rect.width == 0 or rect.height == 0:
+            return
+        size = self.tile_size
+        for ty in range(rect.y // size, (rect.bottom - 1) // size + 1):
+            for tx in range(rect.x // size, (rect.right - 1) // size + 1):
+                self.dirty_tiles.add((tx, ty))
+
+    def add(self, shape):
+        """Adds shape on top of the others."""
+        shape.serial = self.next_serial
+        self.next_serial += 1
+        self._insert(shape)
+        self.mark(shape.rect)
+
+    def remove(self, shape):
+        self._remove(shape)
+        self.mark(shape.rect)
+
+    def replace(self, shape, new_shape):
+        """Puts new_shape in the place of shape, e.g. a moved copy of it."""
+        index = self.shapes.index(shape)
+        self.remove(shape)
+        self.tree.insert(new_shape.rect, new_shape)
+        self.shapes.insert(index, new_shape)
+        self.mark(new_shape.rect)
+
+    def set_shapes(self, shapes):
+        """Makes shapes the layer's shapes, e.g. when undoing.  Only the tiles of shapes that came or went are marked."""
+        kept = {id(shape) for shape in shapes}
+        for shape in list(self.shapes):
+            if id(shape) not in kept:
+                self.remove(shape)
+        current = {id(shape) for shape in self.shapes}
+        for shape in shapes:
+            if id(shape) not in current:
+                self._insert(shape)
+                self.mark(shape.rect)
+        self.shapes.sort(key=lambda shape: shape.serial)
+
+    def shape_at(self, pos, tolerance=3):
+        """Returns the topmost shape that draws a pixel within tolerance of pos, or None."""
+        rect = pygame.Rect(pos, (1, 1)).inflate(tolerance*2, tolerance*2)
+        for shape in sorted(self.tree.search(rect), key=lambda shape: shape.serial, reverse=True):
+            if shape.hit(rect):
+                return shape
+        return None
+
+    def render(self, surface):
+        """Rasterizes the marked tiles of surface again, and returns their rects."""
+        rendered = []
+        surface_rect = surface.get_rect()
+        clip = surface.get_clip()
+        for tx, ty in self.dirty_tiles:
+            tile = pygame.Rect(tx * self.tile_size, ty * self.tile_size, self.tile_size, self.tile_size).clip(surface_rect)
+            surface.set_clip(tile)
+            surface.fill((0, 0, 0, 0), tile)
+            for shape in sorted(self.tree.search(tile), key=lambda shape: shape.serial):
+                surface.blit(shape.sprite(), shape.rect, special_flags=pygame.BLEND_PREMULTIPLIED)
+            rendered.append(tile)
+        surface.set_clip(clip)
+        self.dirty_tiles.clear()
+        self.tiles_rendered += len(rendered)
+        return rendered
+
+    def release_sprites(self):
+        """Drops the cached sprites of the shapes.  Returns False when none were cached."""
+        released = False
+        for shape in self.shapes:
+            if shape.nbytes() > 0:
+                shape.release()
+                released = True
+        return released
+
+    def nbytes(self):
+        return sum(shape.nbytes() for shape in self.shapes)
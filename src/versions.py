@@ -0,0 +1,416 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+import weakref
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pygame
+
+from filebrowser import draw_button
+
+VERSION_TILE_SIZE = 128  # The layers are stored in squares of this size, and only the changed ones are written
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (id INTEGER PRIMARY KEY, time REAL, label TEXT, width INTEGER, height INTEGER, layers TEXT);
+CREATE TABLE IF NOT EXISTS tiles (version INTEGER, layer INTEGER, x INTEGER, y INTEGER, data BLOB, PRIMARY KEY (layer, x, y, version));
+CREATE TABLE IF NOT EXISTS checkpoints (layer INTEGER, version INTEGER, PRIMARY KEY (layer, version));
+"""
+
+class VersionStore:
+    """
+    Keeps every version of the drawing in a SQLite database, so that any earlier state can be brought back, also after
+    the program was closed.
+
+    A version is recorded after each finished edit: a stroke, a shape, a layer operation, an undo, ...  Only the tiles of
+    the layers that changed are stored (zlib-compressed), and every checkpoint_interval versions all the tiles of the
+    layers are stored again as a checkpoint.  A version is rebuilt from the nearest checkpoint of each of its layers,
+    with the tiles changed after it laid over it.
+
+    The main loop only copies the changed pixels.  They are compressed and written on a background thread, in one
+    transaction for all the versions made within batch_seconds, to a database in WAL mode.
+    """
+
+    def __init__(self, path, checkpoint_interval=50, batch_seconds=0.5):
+        """
+        Opens the database, creating it if needed.
+
+        :param path: The database file.  Versions from earlier sessions in it are kept.
+        :param checkpoint_interval: The number of versions between two checkpoints.
+        :param batch_seconds: How long the writer waits for more versions before writing the ones it has.
+        """
+
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.batch_seconds = batch_seconds
+        connection = self.connect()
+        try:
+            connection.executescript(SCHEMA)
+            self.versions = connection.execute("SELECT id, time, label FROM versions ORDER BY id").fetchall()  # (id, time, label), oldest first
+            self.next_version = (connection.execute("SELECT MAX(id) FROM versions").fetchone()[0] or 0) + 1
+            self.next_layer_key = (connection.execute("SELECT MAX(layer) FROM checkpoints").fetchone()[0] or 0) + 1
+        finally:
+            connection.close()
+
+        # Each layer gets a key the first time it is seen, and all its tiles are written then
+        self.layer_keys = weakref.WeakKeyDictionary()
+        self.last_manifest = None
+        self.last_frame = None
+        self.since_checkpoint = 0
+        self.next_label = None  # Replaces the description of the next version
+        self.error = None
+        self.queue = queue.Queue()  # Versions waiting for the writer, and None to stop it
+        self.writer = threading.Thread(target=self.write_versions, daemon=True)
+        self.writer.start()
+        self.reader = ThreadPoolExecutor(max_workers=1)
+
+    def connect(self):
+        """Returns a new connection to the database.  Each thread uses its own."""
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")  # WAL keeps the database consistent without syncing every transaction
+        return connection
+
+    def commit(self, layers, frame_number):
+        """
+        Records a version if the layers changed since the last one.  Call once per frame, while no edit is in progress.
+
+        :param layers: The layers of the frame being drawn on, bottom first.
+        :param frame_number: The number of that animation frame, for the label.
+        :return: The id of the new version, or None if nothing changed.
+        """
+
+        manifest = []
+        changes = []  # (layer, its key, the rect that changed)
+        for layer in layers:
+            key = self.layer_keys.get(layer)
+            if key is None:
+                key = self.next_layer_key
+                self.next_layer_key += 1
+                self.layer_keys[layer] = key
+            dirty_rect = layer.take_dirty("versions")  # The whole layer the first time
+            if dirty_rect is not None:
+                changes.append((layer, key, dirty_rect))
+            manifest.append((key, layer.layer_button.text, layer.is_visible))
+        if not changes and manifest == self.last_manifest and frame_number == self.last_frame:
+            return None
+
+        label = self.describe(manifest, frame_number, [layer for layer, key, dirty_rect in changes])
+        self.since_checkpoint += 1
+        checkpoint = self.since_checkpoint >= self.checkpoint_interval
+        if checkpoint:
+            changes = [(layer, self.layer_keys[layer], layer.surface.get_rect()) for layer in layers]
+            self.since_checkpoint = 0
+        new_keys = {key for key, name, visible in manifest} - {key for key, name, visible in self.last_manifest or []}
+
+        regions = []
+        for layer, key, dirty_rect in changes:
+            region = tile_region(dirty_rect, layer.surface.get_rect())
+            if region.width == 0 or region.height == 0:
+                continue
+            full = checkpoint or (key in new_keys and region == layer.surface.get_rect())
+            data = pygame.image.tobytes(layer.surface.subsurface(region), "RGBA")
+            regions.append((key, full, tuple(region), data))
+
+        version_id = self.next_version
+        self.next_version += 1
+        now = time.time()
+        size = layers[0].surface.get_size()
+        self.queue.put((version_id, now, label, size, manifest, regions))
+        self.versions.append((version_id, now, label))
+        self.last_manifest = manifest
+        self.last_frame = frame_number
+        return version_id
+
+    def describe(self, manifest, frame_number, changed_layers):
+        """Returns a short description of what changed since the last version."""
+        if self.next_label is not None:
+            label = self.next_label
+            self.next_label = None
+            return label
+        if self.last_manifest is None:
+            return f"Frame {frame_number}: start of session"
+        if frame_number != self.last_frame:
+            return f"Frame {frame_number}"
+        last = {key: (name, visible) for key, name, visible in self.last_manifest}
+        keys = [key for key, name, visible in manifest]
+        if not any(key in last for key in keys):
+            return f"Frame {frame_number}: replaced the layers"
+        parts = [f"added layer {name}" for key, name, visible in manifest if key not in last]
+        parts += [f"removed layer {name}" for key, (name, visible) in last.items() if key not in keys]
+        for key, name, visible in manifest:
+            if key in last and last[key][1] != visible:
+                parts.append(f"{'showed' if visible else 'hid'} layer {name}")
+        if [key for key in keys if key in last] != [key for key, name, visible in self.last_manifest if key in keys]:
+            parts.append("moved layers")
+        if not parts:
+            parts.append("drew on layer " + ", ".join(layer.layer_button.text for layer in changed_layers))
+        return f"Frame {frame_number}: " + ", ".join(parts)
+
+    def restored(self, version_id):
+        """Notes that the layers were just replaced by those of an earlier version, for the description of the next one."""
+        self.next_label = f"Restored version {version_id}"
+
+    def write_versions(self):
+        # Runs on the writer thread
+        connection = self.connect()
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.batch_seconds
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            try:
+                self.write_batch(connection, [item for item in batch if item is not None])
+            except Exception as e:
+                self.error = e
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+        connection.close()
+
+    def write_batch(self, connection, batch):
+        """Compresses the changed tiles of the versions in batch and writes them in one transaction."""
+        version_rows = []
+        tile_rows = []
+        checkpoint_rows = []
+        for version_id, now, label, (width, height), manifest, regions in batch:
+            version_rows.append((version_id, now, label, width, height, json.dumps(manifest)))
+            for key, full, (x, y, w, h), data in regions:
+                pixels = np.frombuffer(data, np.uint8).reshape(h, w, 4)
+                for tile_y in range(y, y + h, VERSION_TILE_SIZE):
+                    for tile_x in range(x, x + w, VERSION_TILE_SIZE):
+                        tile = pixels[tile_y - y:tile_y - y + VERSION_TILE_SIZE, tile_x - x:tile_x - x + VERSION_TILE_SIZE]
+                        if tile.any():
+                            tile_rows.append((version_id, key, tile_x, tile_y, zlib.compress(tile.tobytes(), 1)))
+                        elif not full:
+                            tile_rows.append((version_id, key, tile_x, tile_y, None))  # Cleared since the last version
+                if full:
+                    checkpoint_rows.append((key, version_id))
+        with connection:
+            connection.executemany("INSERT INTO versions VALUES (?, ?, ?, ?, ?, ?)", version_rows)
+            connection.executemany("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)", tile_rows)
+            connection.executemany("INSERT OR REPLACE INTO checkpoints VALUES (?, ?)", checkpoint_rows)
+
+    def load(self, version_id):
+        """Rebuilds a version on a worker thread.  Returns a Future of its (name, is_visible, surface) layers, bottom first."""
+        return self.reader.submit(self.read_version, version_id)
+
+    def read_version(self, version_id):
+        # Runs on the reader thread
+        self.queue.join()  # The version may still be waiting for the writer
+        connection = self.connect()
+        try:
+            width, height, manifest = connection.execute("SELECT width, height, layers FROM versions WHERE id = ?", (version_id,)).fetchone()
+            layers = []
+            for key, name, visible in json.loads(manifest):
+                checkpoint = connection.execute("SELECT MAX(version) FROM checkpoints WHERE layer = ? AND version <= ?", (key, version_id)).fetchone()[0]
+                tiles = {}
+                rows = connection.execute("SELECT x, y, data FROM tiles WHERE layer = ? AND version BETWEEN ? AND ? ORDER BY version", (key, checkpoint or 0, version_id))
+                for x, y, data in rows:
+                    tiles[(x, y)] = data  # Later versions of a tile replace earlier ones
+                pixels = np.zeros((height, width, 4), np.uint8)
+                for (x, y), data in tiles.items():
+                    if data is not None:
+                        tile = pixels[y:y + VERSION_TILE_SIZE, x:x + VERSION_TILE_SIZE]
+                        tile[...] = np.frombuffer(zlib.decompress(data), np.uint8).reshape(tile.shape)
+                layers.append((name, visible, pygame.image.frombytes(pixels.tobytes(), (width, height), "RGBA")))
+            return layers
+        finally:
+            connection.close()
+
+    def close(self):
+        """Writes the versions still waiting and closes the database, e.g. before quitting."""
+        self.queue.put(None)
+        self.writer.join()
+        self.reader.shutdown()
+
+    def nbytes(self):
+        """Returns the memory held by the copied pixels still waiting for the writer."""
+        return sum(len(data) for item in list(self.queue.queue) if item is not None for key, full, region, data in item[5])
+
+def tile_region(rect, bounds):
+    """Returns rect grown out to whole tiles, clipped to bounds."""
+    left = rect.x // VERSION_TILE_SIZE * VERSION_TILE_SIZE
+    top = rect.y // VERSION_TILE_SIZE * VERSION_TILE_SIZE
+    right = -(-rect.right // VERSION_TILE_SIZE) * VERSION_TILE_SIZE
+    bottom = -(-rect.bottom // VERSION_TILE_SIZE) * VERSION_TILE_SIZE
+    return pygame.Rect(left, top, right - left, bottom - top).clip(bounds)
+
+class VersionBrowser:
+    """
+    Lists the versions of a VersionStore, newest first, with a preview of the one picked.  Restoring it replaces the
+    layers of the current frame with the layers of that version.
+    """
+
+    def __init__(self, rect, preview_background):
+        """
+        Initializes the browser.
+
+        :param rect: The screen rect of the browser.
+        :param preview_background: The color the layers are shown over in the preview, e.g. the canvas color.
+        """
+
+        self.rect = pygame.Rect(rect)
+        self.preview_background = preview_background
+        self.is_open = False
+        self.store = None
+        self.on_restore = None
+        self.selected = 0  # Index into store.versions, counting from the newest
+        self.scroll = 0
+        self.job = None  # (version id, Future) of the version being rebuilt
+        self.loaded = None  # (version id, layers) of the last version rebuilt
+        self.preview = None
+        self.restore_pending = False
+        self.message = ""
+
+    def open(self, store, on_restore):
+        """
+        Opens the browser on the newest version.
+
+        :param store: The VersionStore.
+        :param on_restore: Called with the (name, is_visible, surface) layers of the version to bring back, bottom first.
+        """
+
+        self.is_open = True
+        self.store = store
+        self.on_restore = on_restore
+        self.selected = 0
+        self.scroll = 0
+        self.restore_pending = False
+        self.message = ""
+
+    def close(self):
+        self.is_open = False
+        self.loaded = None
+        self.preview = None
+
+    def selected_version(self):
+        versions = self.store.versions
+        if not versions:
+            return None
+        return versions[len(versions) - 1 - self.selected]
+
+    def list_rect(self):
+        return pygame.Rect(self.rect.x + 10, self.rect.y + 36, self.rect.width - 400, self.rect.height - 82)
+
+    def preview_rect(self):
+        return pygame.Rect(self.rect.right - 380, self.rect.y + 36, 370, 216)
+
+    def visible_rows(self):
+        return self.list_rect().height // 20
+
+    def restore_rect(self):
+        return pygame.Rect(self.rect.right - 180, self.rect.bottom - 36, 80, 26)
+
+    def close_rect(self):
+        return pygame.Rect(self.rect.right - 90, self.rect.bottom - 36, 80, 26)
+
+    def select(self, index):
+        self.selected = max(0, min(len(self.store.versions) - 1, index))
+        rows = self.visible_rows()
+        if self.selected < self.scroll:
+            self.scroll = self.selected
+        elif self.selected >= self.scroll + rows:
+            self.scroll = self.selected - rows + 1
+
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_ESCAPE:
+                self.close()
+            elif event.key == pygame.K_UP:
+                self.select(self.selected - 1)
+            elif event.key == pygame.K_DOWN:
+                self.select(self.selected + 1)
+            elif event.key == pygame.K_PAGEUP:
+                self.select(self.selected - self.visible_rows())
+            elif event.key == pygame.K_PAGEDOWN:
+                self.select(self.selected + self.visible_rows())
+            elif event.key in (pygame.K_RETURN, pygame.K_KP_ENTER):
+                self.restore_pending = True
+        elif event.type == pygame.MOUSEWHEEL:
+            self.scroll = max(0, min(len(self.store.versions) - self.visible_rows(), self.scroll - event.y * 3))
+        elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            list_rect = self.list_rect()
+            if list_rect.collidepoint(event.pos):
+                self.select(self.scroll + (event.pos[1] - list_rect.y) // 20)
+            elif self.restore_rect().collidepoint(event.pos):
+                self.restore_pending = True
+            elif self.close_rect().collidepoint(event.pos):
+                self.close()
+
+    def update(self):
+        """Rebuilds the picked version on the reader thread, and restores it once it is ready if asked to.  Call once per frame."""
+        version = self.selected_version()
+        if version is None:
+            return
+        version_id = version[0]
+        if self.job is not None and self.job[1].done():
+            job_id, future = self.job
+            self.job = None
+            if future.exception() is not None:
+                self.message = f"Couldn't read version {job_id}: {future.exception()}"
+            else:
+                self.loaded = (job_id, future.result())
+                self.preview = self.make_preview(self.loaded[1])
+        loaded_id = self.loaded[0] if self.loaded is not None else None
+        if self.job is None and loaded_id != version_id:
+            # Only one version is rebuilt at a time, so moving through the list quickly doesn't queue up work
+            self.job = (version_id, self.store.load(version_id))
+        if self.restore_pending and loaded_id == version_id:
+            self.on_restore(self.loaded[1])
+            self.store.restored(version_id)
+            self.close()
+
+    def make_preview(self, layers):
+        size = layers[0][2].get_size() if layers else self.preview_rect().size
+        canvas = pygame.Surface(size)
+        canvas.fill(self.preview_background)
+        for name, visible, surface in layers:
+            if visible:
+                canvas.blit(surface, (0, 0), special_flags=pygame.BLEND_PREMULTIPLIED)
+        preview_rect = self.preview_rect()
+        scale = min(preview_rect.width / size[0], preview_rect.height / size[1])
+        return pygame.transform.smoothscale(canvas, (max(1, int(size[0] * scale)), max(1, int(size[1] * scale))))
+
+    def draw(self, screen, font, text_color, background_color, highlight_color):
+        """Draws the browser and returns its rect."""
+        pygame.draw.rect(screen, background_color, self.rect)
+        pygame.draw.rect(screen, text_color, self.rect, 1)
+        screen.blit(font.render(f"Version history: {len(self.store.versions)} versions  (Up/Down: pick, Enter: restore, Esc: close)", True, text_color), (self.rect.x + 10, self.rect.y + 10))
+
+        list_rect = self.list_rect()
+        versions = self.store.versions
+        for row in range(self.visible_rows()):
+            index = self.scroll + row
+            if index >= len(versions):
+                break
+            version_id, timestamp, label = versions[len(versions) - 1 - index]
+            row_rect = pygame.Rect(list_rect.x, list_rect.y + row * 20, list_rect.width, 20)
+            if index == self.selected:
+                pygame.draw.rect(screen, highlight_color, row_rect)
+            text = f"{version_id:>5}   {time.strftime('%b %d %H:%M:%S', time.localtime(timestamp))}   {label}"
+            screen.blit(font.render(text, True, text_color), (row_rect.x + 4, row_rect.y + 3))
+        pygame.draw.rect(screen, text_color, list_rect, 1)
+
+        preview_rect = self.preview_rect()
+        if self.preview is not None:
+            screen.blit(self.preview, self.preview.get_rect(center=preview_rect.center))
+        if self.job is not None or (self.restore_pending and self.loaded is None):
+            loading_text = font.render("Loading...", True, text_color)
+            screen.blit(loading_text, loading_text.get_rect(center=preview_rect.center))
+        pygame.draw.rect(screen, text_color, preview_rect, 1)
+
+        message = self.message or (f"Couldn't write the history: {self.store.error}" if self.store.error is not None else "")
+        if message:
+            screen.blit(font.render(message, True, text_color), (self.rect.x + 10, self.rect.bottom - 30))
+        draw_button(screen, self.restore_rect(), "Restore", font, text_color, background_color)
+        draw_button(screen, self.close_rect(), "Close", font, text_color, background_color)
+        return self.rect